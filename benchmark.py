@@ -0,0 +1,341 @@
+"""
+Benchmarks for the transform and upload hot paths.
+
+Times the row-level helpers in utilities, the full transform_product and an
+end-to-end run against the local Shopify stub, on the WooCommerce exports in
+the repo and synthetically scaled copies of them.
+
+    python benchmark.py
+    python benchmark.py --datasets full.csv --scales 1 10 100 --json bench.json
+
+The end-to-end runs can be recorded to a cassette (--record) and replayed
+from it later (--replay), so a change to spUtilities is measured against
+the same responses and latencies every time (see cassette.py).
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+DEFAULT_DATASETS = ['short.csv', 'full.csv']
+DEFAULT_SCALES = [1, 10, 100]
+
+
+def load_modules():
+    import utilities
+    import spUtilities
+    import migrate
+    return utilities, spUtilities, migrate
+
+
+def point_at_stub(stub):
+    """Make the stub the active store; the benchmarks never need real credentials"""
+    from config import Config, set_config
+    return set_config(Config.load(store=stub.store, access_token='benchmark', admin_url=stub.url))
+
+
+def scale_export(df, factor):
+    """Repeat the export factor times, suffixing IDs and SKUs so every copy stays unique"""
+    import pandas as pd
+
+    if factor <= 1:
+        return df
+
+    copies = [df]
+    for n in range(1, factor):
+        copy = df.copy()
+        suffix = f"-x{n}"
+        for column in ('ID', 'SKU', 'Parent'):
+            if column in copy:
+                copy[column] = copy[column].where(copy[column] == '', copy[column] + suffix)
+        copies.append(copy)
+    return pd.concat(copies, ignore_index=True)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def peak_rss_mb():
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak = peak / 1024
+    return round(peak / 1024, 1)
+
+
+def time_calls(name, func, args_list):
+    """Call func once per argument tuple and return timing stats"""
+    start = time.perf_counter()
+    for args in args_list:
+        func(*args)
+    elapsed = time.perf_counter() - start
+    calls = len(args_list)
+    return {
+        "benchmark": name,
+        "calls": calls,
+        "seconds": round(elapsed, 4),
+        "us_per_call": round(elapsed / calls * 1e6, 2) if calls else None
+    }
+
+
+def bench_functions(df, utilities, migrate, sample):
+    """Time each hot-path helper over (a sample of) the rows of df"""
+    rows = [row for _, row in df.head(sample).iterrows()] if sample else [row for _, row in df.iterrows()]
+    results = []
+
+    decade_values = []
+    for row in rows:
+        for tag in (row.get('Categories', '') or '').replace('>', ',').split(','):
+            if tag.strip():
+                decade_values.append((tag,))
+    results.append(time_calls('parse_decade', utilities.parse_decade, decade_values))
+
+    dimension_values = []
+    for row in rows:
+        for col in row.index:
+            if col.startswith('Attribute') and 'name' in col and str(row[col]).strip().lower() == 'dimensions':
+                attr_num = col.split(' ')[1]
+                dimension_values.append((row.get(f'Attribute {attr_num} value(s)', ''),))
+    results.append(time_calls('parse_dimensions', utilities.parse_dimensions, dimension_values))
+
+    results.append(time_calls('process_categories', utilities.process_categories,
+                              [(row.get('Categories', ''),) for row in rows]))
+
+    attribute_results = [utilities.process_attributes(row) for row in rows]
+    results.append(time_calls('process_attributes', utilities.process_attributes, [(row,) for row in rows]))
+
+    results.append(time_calls('format_description', utilities.format_description,
+                              [(row.get('Short description', ''), attrs[3]) for row, attrs in zip(rows, attribute_results)]))
+
+    # Each lookup is a full scan of the export, so only time a handful of parents
+    parents = [row.get('SKU', '') for row in rows if utilities.check_parent(row)][:20]
+    results.append(time_calls('get_child_products', utilities.get_child_products, [(sku, df) for sku in parents]))
+    # What migrate_rows uses instead: one pass over the export for every parent
+    results.append(time_calls('ProductGraph', migrate.ProductGraph, [(df,)]))
+    # Every pre-flight check over the whole export
+    import preflight
+    results.append(time_calls('Preflight', preflight.Preflight, [(df, migrate.ProductGraph(df))]))
+
+    results.append(time_calls('transform_product', migrate.transform_product, [(row,) for row in rows]))
+
+    return results
+
+
+class LatencyRecorder:
+    """Wraps requests' Session.request, which every request spUtilities sends goes through, to record per-request latency"""
+
+    def __init__(self, requests_module):
+        self.requests = requests_module
+        self.latencies = []
+        self.original = None
+
+    def __enter__(self):
+        self.original = self.requests.Session.request
+        self.requests.Session.request = self.wrap(self.original)
+        return self
+
+    def __exit__(self, *exc):
+        self.requests.Session.request = self.original
+
+    def wrap(self, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.latencies.append(time.perf_counter() - start)
+        return timed
+
+
+def bench_end_to_end(df, utilities, spUtilities, migrate, limit):
+    """Run the migrate.main product loop against the stub and report throughput"""
+    import requests
+
+    products = 0
+    failures = {}
+
+    with LatencyRecorder(requests) as recorder:
+        start = time.perf_counter()
+        graph = migrate.ProductGraph(df)
+        for label in graph.products:
+            if limit and products >= limit:
+                break
+
+            products += 1
+            row = df.loc[label]
+            try:
+                variations = graph.variants(graph.keys[label], df)
+                product_data = migrate.transform_product(row, variations=variations)
+                result, product_id = spUtilities.create_product(product_data)
+                migrate.METAFIELDS.add(product_id, product_data.get('metafields'))
+                children = [
+                    migrate.transform_product(child, product_data, parent_id=product_id, lookup=False)
+                    for child in variations
+                ]
+                if children:
+                    spUtilities.add_variants(product_id, children, parent_product=product_data)
+            except Exception as e:
+                failures[type(e).__name__] = failures.get(type(e).__name__, 0) + 1
+        migrate.METAFIELDS.flush()
+        elapsed = time.perf_counter() - start
+
+    latencies_ms = [latency * 1000 for latency in recorder.latencies]
+    return {
+        "benchmark": "end_to_end",
+        "products": products,
+        "failures": sum(failures.values()),
+        "failure_classes": failures,
+        "requests": len(latencies_ms),
+        "seconds": round(elapsed, 4),
+        "products_per_sec": round(products / elapsed, 2) if elapsed else None,
+        "p50_ms": round(statistics.median(latencies_ms), 3) if latencies_ms else None,
+        "p99_ms": round(percentile(latencies_ms, 99), 3) if latencies_ms else None,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+
+STARTUP_COMMANDS = {
+    'cli --help': ['cli.py', '--help'],
+    'cli verify': ['cli.py', 'verify'],
+    'import migrate': ['-c', 'import migrate'],
+    'import pandas': ['-c', 'import pandas'],
+}
+
+
+def bench_startup(runs=5):
+    """Median cold-start wall time of the CLI entry points in a fresh interpreter"""
+    import subprocess
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for name, argv in STARTUP_COMMANDS.items():
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + argv, cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            timings.append(time.perf_counter() - start)
+        median = statistics.median(timings)
+        results.append({"benchmark": f"startup: {name}", "dataset": "startup", "calls": runs, "seconds": round(median, 4), "us_per_call": round(median * 1e6, 2)})
+    return results
+
+
+def run(datasets, scales, sample, e2e_limit, latency, bucket_size, record=None, replay=None, latency_scale=1.0):
+    import pandas as pd
+    from shopify_stub import ShopifyStub
+
+    from export_cache import ExportCache
+    from log import configure_logging
+
+    report = bench_startup()
+    print_results('startup', 0, report)
+
+    utilities, spUtilities, migrate = load_modules()
+
+    # Keep the migration's own logging in the measurement but out of the report
+    devnull = open(os.devnull, 'w')
+    configure_logging(stream=devnull)
+
+    if record or replay:
+        import cassette
+        cassette.open_cassette(record=record, replay=replay, latency_scale=latency_scale)
+        spUtilities.reset_http()
+
+    with ShopifyStub(latency=latency, bucket_size=bucket_size) as stub:
+        point_at_stub(stub)
+
+        for dataset in datasets:
+            base = pd.read_csv(dataset, dtype=str).fillna('')
+            for factor in scales:
+                df = scale_export(base, factor)
+                label = f"{dataset} x{factor}"
+
+                # Time the CSV read on a materialised copy of the scaled export
+                with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+                    scaled_path = f.name
+                df.to_csv(scaled_path, index=False)
+                cache_dir = tempfile.mkdtemp()
+                try:
+                    start = time.perf_counter()
+                    pd.read_csv(scaled_path, dtype=str).fillna('')
+                    read_seconds = time.perf_counter() - start
+
+                    # And from the export cache: the first read builds it, the second is a normal run's
+                    cache = ExportCache(cache_dir)
+                    cache_seconds = []
+                    for _ in range(2):
+                        start = time.perf_counter()
+                        cache.read(scaled_path, utilities.parse_export)
+                        cache_seconds.append(time.perf_counter() - start)
+                finally:
+                    os.remove(scaled_path)
+                    shutil.rmtree(cache_dir, ignore_errors=True)
+
+                results = [
+                    {"benchmark": "read_csv", "calls": 1, "seconds": round(read_seconds, 4), "us_per_call": round(read_seconds * 1e6, 2)},
+                    {"benchmark": "read_export (cold cache)", "calls": 1, "seconds": round(cache_seconds[0], 4), "us_per_call": round(cache_seconds[0] * 1e6, 2)},
+                    {"benchmark": "read_export (cached)", "calls": 1, "seconds": round(cache_seconds[1], 4), "us_per_call": round(cache_seconds[1] * 1e6, 2)}
+                ]
+
+                results.extend(bench_functions(df, utilities, migrate, sample))
+                results.append(bench_end_to_end(df, utilities, spUtilities, migrate, e2e_limit))
+
+                for result in results:
+                    result["dataset"] = label
+                    result["rows"] = len(df)
+                report.extend(results)
+                print_results(label, len(df), results)
+
+    if record or replay:
+        cassette.close_cassette()
+        spUtilities.reset_http()
+    return report
+
+
+def print_results(label, rows, results):
+    print(f"\n📊 {label}" + (f" ({rows} rows)" if rows else ''))
+    for result in results:
+        if result["benchmark"] == "end_to_end":
+            print(f"  {'end_to_end':<20} {result['products']} products in {result['seconds']}s "
+                  f"({result['products_per_sec']}/s, {result['failures']} failed), "
+                  f"p50 {result['p50_ms']}ms, p99 {result['p99_ms']}ms, peak RSS {result['peak_rss_mb']}MB")
+        else:
+            print(f"  {result['benchmark']:<20} {result['calls']:>7} calls {result['seconds']:>9}s "
+                  f"{result['us_per_call'] if result['us_per_call'] is not None else '-':>10} us/call")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--datasets', nargs='+', default=DEFAULT_DATASETS, help='WooCommerce exports to benchmark')
+    parser.add_argument('--scales', nargs='+', type=int, default=DEFAULT_SCALES, help='Synthetic scale factors')
+    parser.add_argument('--sample', type=int, default=2000, help='Rows per function benchmark (0 for all)')
+    parser.add_argument('--e2e-limit', type=int, default=200, help='Products per end-to-end run (0 for all)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Simulated Shopify latency in seconds')
+    parser.add_argument('--bucket-size', type=int, default=10 ** 9,
+                        help='Stub query cost bucket (default effectively unthrottled; 2000 models a standard plan)')
+    parser.add_argument('--record', help='Record the end-to-end requests to this cassette')
+    parser.add_argument('--replay', help='Replay the end-to-end requests from this cassette instead of the stub')
+    parser.add_argument('--replay-latency-scale', type=float, default=1.0, help='Scale the recorded latencies when replaying')
+    parser.add_argument('--json', help='Write the results to this file as JSON')
+    args = parser.parse_args()
+
+    report = run(args.datasets, args.scales, args.sample, args.e2e_limit, args.latency, args.bucket_size,
+                 record=args.record, replay=args.replay, latency_scale=args.replay_latency_scale)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n✅ Wrote {len(report)} results to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
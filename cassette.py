@@ -0,0 +1,258 @@
+"""
+Recording the run's HTTP traffic to a cassette and replaying it offline.
+
+    python cli.py --record run.jsonl.gz migrate
+    python cli.py --replay run.jsonl.gz [--replay-latency-scale 0.5] migrate
+
+Recording keeps every request made through new_session() and the response
+it got: the GraphQL and REST calls to Shopify, staged uploads, bulk
+results and the WooCommerce REST API. Each one is a gzipped JSON line with
+the method, path, JSON body (never the headers, so no tokens), status,
+response headers and body, and how long the response took.
+
+Replaying answers each request from the cassette without touching the
+network, after waiting as long as the recorded response took (times
+REPLAY_LATENCY_SCALE; 0 doesn't wait at all). Requests are matched on
+method, path and query, and JSON body, not on the host, so a cassette
+recorded against a live store replays under any store URL. Query
+parameters that change from run to run (VOLATILE_PARAMS, such as the
+modified_after of an incremental pull) are left out, so an incremental
+pull replays too. Identical
+requests get their recorded responses in order, throttled ones included,
+so a run that changed how it sends requests still meets the store's
+recorded latency and throttling. A request that isn't in the cassette
+raises CassetteMiss, like a dropped connection.
+
+Image downloads from the WooCommerce host are not recorded; replay with
+the image cache in place (or without --rehost-images).
+"""
+import base64
+import gzip
+import hashlib
+import io
+import json
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from log import get_logger
+
+logger = get_logger('cassette')
+
+# Connections each session keeps open per host
+POOL_SIZE = 10
+# Response headers that describe the bytes on the wire rather than the body kept
+SKIPPED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection', 'set-cookie'}
+# Query parameters left out of the match; they hold the time of the run (or of the last one)
+VOLATILE_PARAMS = {'modified_after'}
+
+
+class CassetteMiss(requests.ConnectionError):
+    """A request the cassette being replayed has no response for"""
+
+
+def request_key(method, url, body):
+    """What a request is matched on: method, path and query (without VOLATILE_PARAMS), and the JSON body if there is one"""
+    parts = urlsplit(url)
+    query = urlencode([(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                       if name not in VOLATILE_PARAMS])
+    path = parts.path + (f"?{query}" if query else '')
+    payload = json_body(body)
+    digest = hashlib.sha1(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest() if payload is not None else ''
+    return f"{method} {path} {digest}"
+
+
+def json_body(body):
+    """A request body as JSON, or None (no body, a form or a file upload)"""
+    if not body:
+        return None
+    try:
+        return json.loads(body)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        return None
+
+
+class Recorder:
+    """Appends requests and their responses to a gzipped JSONL cassette"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = gzip.open(path, 'wt', encoding='utf-8')
+        self.started = time.perf_counter()
+        self.count = 0
+
+    def record(self, request, response, seconds):
+        content = response.content
+        try:
+            body, encoding = content.decode('utf-8'), None
+        except UnicodeDecodeError:
+            body, encoding = base64.b64encode(content).decode('ascii'), 'base64'
+        entry = {
+            "key": request_key(request.method, request.url, request.body),
+            "method": request.method,
+            "url": request.url,
+            "request": json_body(request.body),
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": {name: value for name, value in response.headers.items() if name.lower() not in SKIPPED_HEADERS},
+            "body": body,
+            "encoding": encoding,
+            "seconds": round(seconds, 6),
+            "at": round(time.perf_counter() - self.started - seconds, 6)
+        }
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            if self.file is not None:
+                self.file.write(line)
+                self.count += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.close()
+            self.file = None
+        logger.info(f"📼 Recorded {self.count} requests to {self.path}")
+
+
+class Cassette:
+    """Recorded responses by request key, handed out in the order they were recorded"""
+
+    def __init__(self, path, latency_scale=1.0):
+        self.path = path
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.count = 0
+        self.replayed = 0
+        self.missed = 0
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            try:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    # Keyed again rather than by the recorded key, so cassettes recorded before
+                    # a change to request_key (like VOLATILE_PARAMS) still match
+                    body = json.dumps(entry["request"]) if entry.get("request") is not None else None
+                    key = request_key(entry["method"], entry["url"], body)
+                    self.responses.setdefault(key, deque()).append(entry)
+                    self.count += 1
+            except EOFError:
+                # Recording stopped without closing the file; everything before is usable
+                logger.warning(f"⚠️ Cassette {path} is cut short, replaying the {self.count} requests before that")
+
+    def take(self, key):
+        """The next recorded response to key; the last one is repeated once they run out, None if there never was one"""
+        with self.lock:
+            entries = self.responses.get(key)
+            if not entries:
+                self.missed += 1
+                return None
+            self.replayed += 1
+            return entries.popleft() if len(entries) > 1 else entries[0]
+
+    def close(self):
+        logger.info(f"📼 Replayed {self.replayed} requests from {self.path}, {self.missed} not in it",
+                    extra={"recorded": self.count})
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Sends requests as usual and records each response"""
+
+    def __init__(self, recorder, **kwargs):
+        super().__init__(**kwargs)
+        self.recorder = recorder
+
+    def send(self, request, **kwargs):
+        start = time.perf_counter()
+        response = super().send(request, **kwargs)
+        # Reading the body here leaves it in response.content for streaming callers too
+        response.content
+        self.recorder.record(request, response, time.perf_counter() - start)
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """Answers requests from a cassette"""
+
+    def __init__(self, cassette):
+        super().__init__()
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        key = request_key(request.method, request.url, request.body)
+        entry = self.cassette.take(key)
+        if entry is None:
+            raise CassetteMiss(f"No recorded response for {key} in {self.cassette.path}", request=request)
+        seconds = entry["seconds"] * self.cassette.latency_scale
+        if seconds > 0:
+            time.sleep(seconds)
+
+        body = entry["body"].encode('utf-8') if entry.get("encoding") is None else base64.b64decode(entry["body"])
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.reason = entry.get("reason")
+        response.headers = CaseInsensitiveDict(entry.get("headers") or {})
+        response.url = request.url
+        response.request = request
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.elapsed = timedelta(seconds=seconds)
+        response.raw = io.BytesIO(body)
+        response._content = body
+        response._content_consumed = True
+        return response
+
+    def close(self):
+        pass
+
+
+_active = None
+_lock = threading.Lock()
+
+
+def open_cassette(record=None, replay=None, latency_scale=1.0):
+    """Record to or replay from a cassette in every session made from now on"""
+    global _active
+    close_cassette()
+    with _lock:
+        _active = Recorder(record) if record else Cassette(replay, latency_scale)
+    if replay:
+        logger.info(f"📼 Replaying {_active.count} recorded requests from {replay}", extra={"latency_scale": latency_scale})
+    return _active
+
+
+def close_cassette():
+    global _active
+    with _lock:
+        active, _active = _active, None
+    if active is not None:
+        active.close()
+
+
+def replaying():
+    return isinstance(_active, Cassette)
+
+
+def new_session(pool_size=POOL_SIZE):
+    """A requests session, going through the open cassette if there is one"""
+    with _lock:
+        active = _active
+    if isinstance(active, Cassette):
+        adapter = ReplayAdapter(active)
+    elif isinstance(active, Recorder):
+        adapter = RecordingAdapter(active, pool_maxsize=pool_size)
+    else:
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
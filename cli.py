@@ -0,0 +1,326 @@
+"""
+Command line entry point.
+
+    python cli.py migrate [--csv full.csv]
+    python cli.py migrate --stores [staging production ...]
+    python cli.py collections [--plan]
+    python cli.py images
+    python cli.py retry
+    python cli.py sync [--refresh-index]
+    python cli.py pull [--full]
+    python cli.py migrate --source woocommerce
+    python cli.py watch [--path exports/] [--interval 60] [--once] [--baseline]
+    python cli.py worker [--shards 16] [--lease-db shards.sqlite]
+    python cli.py rollback [--journal journals/<run>.jsonl ...] [--all-journals] [--by-metafield] [--dry-run]
+    python cli.py verify [--online] [--reconcile [--snapshot store_snapshot.jsonl]]
+    python cli.py --profile [--profile-kind cpu|memory] migrate ...
+    python cli.py --metrics-port 9464 migrate ...
+    python cli.py --record run.jsonl.gz migrate ...
+    python cli.py --replay run.jsonl.gz [--replay-latency-scale 0] migrate ...
+    python cli.py --store staging retry|rollback|sync|verify ...
+
+Running migrate.py directly is the same as `cli.py migrate`. Each command
+imports what it needs when it runs, so `--help` starts without loading
+pandas or requests.
+"""
+import argparse
+import sys
+from dataclasses import replace
+
+from config import Config, set_config
+from log import configure_logging, get_logger
+
+logger = get_logger('cli')
+
+
+def cmd_migrate(args, config):
+    if getattr(args, 'stores', None) is not None:
+        import stores
+        return stores.migrate_stores(args.stores)
+    import migrate
+    return migrate.main()
+
+
+def cmd_collections(args, config):
+    import migrate
+    migrate.sync_collections(plan=args.plan)
+
+
+def cmd_images(args, config):
+    import migrate
+    migrate.sync_images()
+
+
+def cmd_retry(args, config):
+    import migrate
+    return migrate.retry_failed()
+
+
+def cmd_sync(args, config):
+    import sync
+    return sync.sync_stock(refresh_index=args.refresh_index)
+
+
+def cmd_pull(args, config):
+    import woocommerce
+    if not config.woocommerce_url or not config.woocommerce_key:
+        logger.error("❌ Set WOOCOMMERCE_URL in vars.py and the REST API keys in keys.py first")
+        return 1
+    return 0 if woocommerce.refresh_export(full=args.full) else 1
+
+
+def cmd_watch(args, config):
+    import watch
+    return watch.watch(once=args.once, baseline=args.baseline)
+
+
+def cmd_worker(args, config):
+    import shards
+    if args.status:
+        return shards.show_status()
+    return shards.run_worker(worker_id=args.worker_id)
+
+
+def cmd_rollback(args, config):
+    import rollback
+    return rollback.rollback(journals=args.journal, all_journals=args.all_journals,
+                             by_metafield=args.by_metafield, dry_run=args.dry_run)
+
+
+def cmd_verify(args, config):
+    """Check the config and export are usable, optionally by talking to the store"""
+    ok = True
+    for problem in config.problems():
+        logger.error(f"❌ {problem}")
+        ok = False
+
+    if ok and config.source == 'woocommerce':
+        from woocommerce import refresh_export
+        ok = refresh_export() is not None
+
+    if ok:
+        import csv
+        with open(config.csv_file, newline='', encoding='utf-8-sig') as f:
+            header = next(csv.reader(f), [])
+        missing = [column for column in ('ID', 'Type', 'SKU', 'Name', 'Parent', 'Categories') if column not in header]
+        if missing:
+            logger.error(f"❌ Export {config.csv_file} is missing columns: {', '.join(missing)}")
+            ok = False
+        else:
+            logger.info(f"✅ Export {config.csv_file} has {len(header)} columns")
+
+    # Errors in the export don't stop a reconciliation of what's already in the store
+    export_ok = True
+    if ok:
+        from preflight import Preflight
+        from product_graph import ProductGraph
+        from utilities import read_export
+        df = read_export(config.csv_file)
+        preflight = Preflight(df, ProductGraph(df))
+        preflight.log()
+        preflight.write(config.preflight_report_file)
+        if preflight.errors:
+            logger.error(f"❌ The export has {preflight.errors} errors, see {config.preflight_report_file}")
+            export_ok = False
+
+    if ok and args.online:
+        from spUtilities import get_locations
+        location_id = get_locations()
+        if location_id:
+            logger.info(f"✅ Connected to {config.store}, location {location_id}")
+        else:
+            logger.error(f"❌ Could not reach {config.store} or it has no locations")
+            ok = False
+
+    if ok:
+        logger.info("✅ Config looks good")
+
+    if ok and args.reconcile:
+        import reconcile
+        ok = reconcile.reconcile_store(snapshot=args.snapshot) == 0
+    return 0 if ok and export_ok else 1
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Migrate a WooCommerce product export to Shopify')
+    parser.add_argument('--log-level', help='DEBUG, INFO, WARNING or ERROR (default from vars.py)')
+    parser.add_argument('--log-format', choices=['json', 'text'], help='Log output format (default from vars.py)')
+    parser.add_argument('--store', dest='store_name', help='Work on this store from SHOPIFY_STORES instead of SHOPIFY_STORE')
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this port while running (see metrics.py)')
+    parser.add_argument('--metrics-host', help='Address to serve metrics on (default 127.0.0.1)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile every stage with cProfile and tracemalloc (see profiling.py)')
+    parser.add_argument('--profile-kind', choices=['cpu', 'memory', 'all'],
+                        help='Profile only CPU or only memory, while profiling (default all)')
+    parser.add_argument('--profile-dir', help='Where the per-stage stats go (default PROFILE_DIR in vars.py)')
+    parser.add_argument('--record', dest='record_file', metavar='CASSETTE',
+                        help='Record every request and response to this file (see cassette.py)')
+    parser.add_argument('--replay', dest='replay_file', metavar='CASSETTE',
+                        help='Answer requests from a recorded cassette instead of the network')
+    parser.add_argument('--replay-latency-scale', type=float,
+                        help='Wait this times the recorded latencies when replaying (default 1; 0 for none)')
+    subparsers = parser.add_subparsers(dest='command')
+
+    migrate_parser = subparsers.add_parser('migrate', help='Create products and variants from the export')
+    migrate_parser.add_argument('--csv', dest='csv_file', help='WooCommerce export (default CSV_FILE in vars.py)')
+    migrate_parser.add_argument('--source', choices=['csv', 'woocommerce'],
+                                help='Read the export file, or pull the catalogue from WOOCOMMERCE_URL first (default SOURCE in vars.py)')
+    migrate_parser.add_argument('--sync-images', action='store_true', default=None, help='Replace images of updated products')
+    migrate_parser.add_argument('--collections', dest='create_smart_collections', action='store_true', default=None,
+                                help='Create smart collections for the categories afterwards')
+    migrate_parser.add_argument('--rehost-images', action='store_true', default=None,
+                                help='Upload each distinct image to Shopify once instead of having it fetch every URL')
+    migrate_parser.add_argument('--max-concurrency', type=int,
+                                help='Most Shopify requests in flight at once (default MAX_CONCURRENCY in vars.py)')
+    migrate_parser.add_argument('--keep-invalid-rows', dest='skip_invalid_rows', action='store_false', default=None,
+                                help='Send rows that fail the pre-flight checks anyway')
+    migrate_parser.add_argument('--stores', nargs='*', metavar='NAME',
+                                help='Transform once and migrate into these stores from SHOPIFY_STORES at the same time (all of them if none are named)')
+    migrate_parser.set_defaults(func=cmd_migrate)
+
+    collections_parser = subparsers.add_parser('collections', help='Create smart collections for the export categories')
+    collections_parser.add_argument('--csv', dest='csv_file', help='WooCommerce export (default CSV_FILE in vars.py)')
+    collections_parser.add_argument('--plan', action='store_true', help='Only list the category hierarchy, create nothing')
+    collections_parser.set_defaults(func=cmd_collections)
+
+    images_parser = subparsers.add_parser('images', help='Resync the images of already-migrated products')
+    images_parser.add_argument('--csv', dest='csv_file', help='WooCommerce export (default CSV_FILE in vars.py)')
+    images_parser.add_argument('--rehost-images', action='store_true', default=None,
+                               help='Upload each distinct image to Shopify once instead of having it fetch every URL')
+    images_parser.set_defaults(func=cmd_images)
+
+    retry_parser = subparsers.add_parser('retry', help='Redo only the products that failed in earlier runs')
+    retry_parser.add_argument('--csv', dest='csv_file', help='WooCommerce export (default CSV_FILE in vars.py)')
+    retry_parser.add_argument('--rehost-images', action='store_true', default=None,
+                              help='Upload each distinct image to Shopify once instead of having it fetch every URL')
+    retry_parser.add_argument('--max-concurrency', type=int,
+                              help='Most Shopify requests in flight at once (default MAX_CONCURRENCY in vars.py)')
+    retry_parser.set_defaults(func=cmd_retry)
+
+    sync_parser = subparsers.add_parser('sync', help='Push only stock levels and prices for existing products')
+    sync_parser.add_argument('--csv', dest='csv_file', help='WooCommerce export (default CSV_FILE in vars.py)')
+    sync_parser.add_argument('--source', choices=['csv', 'woocommerce'],
+                             help='Read the export file, or pull the catalogue from WOOCOMMERCE_URL first (default SOURCE in vars.py)')
+    sync_parser.add_argument('--refresh-index', action='store_true', help='Rebuild the cached SKU index from the store first')
+    sync_parser.add_argument('--max-concurrency', type=int,
+                             help='Most Shopify requests in flight at once (default MAX_CONCURRENCY in vars.py)')
+    sync_parser.set_defaults(func=cmd_sync)
+
+    pull_parser = subparsers.add_parser('pull', help='Fetch the catalogue from the WooCommerce REST API into an export file')
+    pull_parser.add_argument('--csv', dest='csv_file', help='Where to write it (default WOOCOMMERCE_EXPORT_FILE in vars.py)')
+    pull_parser.add_argument('--full', action='store_true', help='Fetch everything again instead of only what changed')
+    pull_parser.set_defaults(func=cmd_pull, source='woocommerce')
+
+    watch_parser = subparsers.add_parser('watch', help='Keep running, sending only what changed whenever a new export appears')
+    watch_parser.add_argument('--path', dest='watch_path', help='Export file, or directory of exports, to watch (default CSV_FILE)')
+    watch_parser.add_argument('--interval', dest='watch_interval', type=int, help='Seconds between polls (default WATCH_INTERVAL in vars.py)')
+    watch_parser.add_argument('--workers', dest='watch_workers', type=int, help='Products sent at once (default WATCH_WORKERS in vars.py)')
+    watch_parser.add_argument('--source', choices=['csv', 'woocommerce'],
+                              help='Watch the export file, or pull the catalogue from WOOCOMMERCE_URL every poll (default SOURCE in vars.py)')
+    watch_parser.add_argument('--once', action='store_true', help='Process the current export and exit')
+    watch_parser.add_argument('--baseline', action='store_true',
+                              help="Without earlier state, only record the first export instead of sending all of it")
+    watch_parser.add_argument('--max-concurrency', type=int,
+                              help='Most Shopify requests in flight at once (default MAX_CONCURRENCY in vars.py)')
+    watch_parser.set_defaults(func=cmd_watch)
+
+    worker_parser = subparsers.add_parser('worker', help='Migrate shards of the export alongside other workers')
+    worker_parser.add_argument('--csv', dest='csv_file', help='WooCommerce export (default CSV_FILE in vars.py)')
+    worker_parser.add_argument('--shards', dest='shard_count', type=int, help='Number of shards (default SHARD_COUNT in vars.py)')
+    worker_parser.add_argument('--lease-db', dest='lease_db_file', help='Lease table shared by the workers (default LEASE_DB_FILE)')
+    worker_parser.add_argument('--lease-seconds', type=int, help='Hand a shard to another worker after this long without a heartbeat')
+    worker_parser.add_argument('--worker-id', help='Name in the lease table (default host-pid)')
+    worker_parser.add_argument('--status', action='store_true', help='Only show the state of each shard')
+    worker_parser.add_argument('--rehost-images', action='store_true', default=None,
+                               help='Upload each distinct image to Shopify once instead of having it fetch every URL')
+    worker_parser.add_argument('--max-concurrency', type=int,
+                               help='Most Shopify requests in flight at once (default MAX_CONCURRENCY in vars.py)')
+    worker_parser.add_argument('--keep-invalid-rows', dest='skip_invalid_rows', action='store_false', default=None,
+                               help='Send rows that fail the pre-flight checks anyway')
+    worker_parser.set_defaults(func=cmd_worker)
+
+    rollback_parser = subparsers.add_parser('rollback', help='Delete the products and collections a run created')
+    rollback_parser.add_argument('--journal', nargs='+', help='Journals to roll back (default the newest in JOURNAL_DIR)')
+    rollback_parser.add_argument('--all-journals', action='store_true', help='Roll back every journal in JOURNAL_DIR')
+    rollback_parser.add_argument('--by-metafield', action='store_true',
+                                 help='Also delete every product with a woocommerce_sku metafield, journalled or not')
+    rollback_parser.add_argument('--dry-run', action='store_true', help='Only count what would be deleted')
+    rollback_parser.add_argument('--max-concurrency', type=int,
+                                 help='Most Shopify requests in flight at once (default MAX_CONCURRENCY in vars.py)')
+    rollback_parser.set_defaults(func=cmd_rollback)
+
+    verify_parser = subparsers.add_parser('verify', help='Check the config and export before a run')
+    verify_parser.add_argument('--csv', dest='csv_file', help='WooCommerce export (default CSV_FILE in vars.py)')
+    verify_parser.add_argument('--online', action='store_true', help='Also check the store can be reached')
+    verify_parser.add_argument('--reconcile', action='store_true',
+                               help='Compare the whole store with the export (missing, extra and drifted products and variants)')
+    verify_parser.add_argument('--snapshot', help='Reconcile against a saved catalogue (JSONL) instead of running a bulk query')
+    verify_parser.set_defaults(func=cmd_verify)
+
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not args.command:
+        # Plain `python migrate.py` keeps running the migration
+        args.func = cmd_migrate
+
+    # --profile turns profiling on like PROFILE in vars.py does; --profile-kind only picks what it records
+    config = Config.load(**dict(vars(args), profile=None))
+    if args.profile or config.profile:
+        config = replace(config, profile=args.profile_kind or config.profile or 'all')
+    config = set_config(config)
+    configure_logging()
+    if config.store_name:
+        try:
+            config = set_config(config.for_store(config.store_name))
+        except ValueError as e:
+            logger.error(f"❌ {e}")
+            return 1
+
+    if config.record_file and config.replay_file:
+        logger.error("❌ Record to a cassette or replay one, not both")
+        return 1
+    if not config.record_file and not config.replay_file:
+        return serve_metrics(args, config)
+
+    import cassette
+    cassette.open_cassette(record=config.record_file, replay=config.replay_file,
+                           latency_scale=config.replay_latency_scale)
+    try:
+        return serve_metrics(args, config)
+    finally:
+        cassette.close_cassette()
+
+
+def serve_metrics(args, config):
+    if not config.metrics_port:
+        return run_command(args, config)
+
+    from metrics import MetricsServer
+    server = MetricsServer(config.metrics_port, config.metrics_host).start()
+    try:
+        return run_command(args, config)
+    finally:
+        server.stop()
+
+
+def run_command(args, config):
+    if not config.profile:
+        return args.func(args, config)
+
+    from profiling import StageProfiler
+    profiler = StageProfiler(config.profile_dir, cpu=config.profile in ('cpu', 'all'), memory=config.profile in ('memory', 'all'))
+    profiler.start()
+    try:
+        # Whatever runs outside the stages is profiled as 'run'
+        with profiler.stage('run'):
+            return args.func(args, config)
+    finally:
+        profiler.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,304 @@
+"""
+Run configuration.
+
+Settings come from vars.py and credentials from keys.py (copy keys.py.bak),
+with SHOPIFY_STORE, SHOPIFY_API_ACCESS_TOKEN and SHOPIFY_ADMIN_URL
+environment variables taking precedence. Everything else reads the active
+config through get_config().
+
+Further stores are named in SHOPIFY_STORES (keys.py, or JSON in the
+environment). Config.for_store() gives the config of one of them, and
+while a thread works on a store (see stores.py) get_config() returns that
+store's config.
+
+With SOURCE = 'woocommerce' the export is pulled from WOOCOMMERCE_URL
+(see woocommerce.py) into WOOCOMMERCE_EXPORT_FILE, which is then the
+csv_file every command reads.
+"""
+import contextvars
+import json
+import os
+import threading
+from dataclasses import dataclass, fields, replace
+
+# The REST endpoints we still use (image deletion, collection publishing)
+REST_API_VERSION = '2023-07'
+
+PLACEHOLDER_STORE = 'your-store-name.myshopify.com'
+PLACEHOLDER_TOKEN = 'your access token'
+
+
+@dataclass
+class Config:
+    store: str = ''
+    access_token: str = ''
+    # Which of SHOPIFY_STORES this is; empty for the store in SHOPIFY_STORE
+    store_name: str = ''
+    api_version: str = '2024-07'
+    # Defaults to https://<store>; the benchmarks point it at the local stub
+    admin_url: str = None
+    csv_file: str = 'short.csv'
+    # 'csv' reads csv_file as it is; 'woocommerce' pulls it from the store's REST API first
+    source: str = 'csv'
+    woocommerce_url: str = ''
+    woocommerce_key: str = ''
+    woocommerce_secret: str = ''
+    woocommerce_export_file: str = 'woocommerce_export.csv'
+    woocommerce_cache_dir: str = '.woocommerce_cache'
+    woocommerce_workers: int = 8
+    sync_images: bool = False
+    # Upload images to Shopify ourselves instead of having it fetch them (see images.py)
+    rehost_images: bool = False
+    image_cache_dir: str = '.image_cache'
+    image_workers: int = 8
+    create_smart_collections: bool = False
+    # Parents whose variants are being created at the same time
+    variant_workers: int = 8
+    # GraphQL requests in flight: starts at concurrency and is tuned up to max_concurrency
+    concurrency: int = 2
+    max_concurrency: int = 8
+    dimensions_log_file: str = 'dimensions_to_process.csv'
+    image_errors_log_file: str = 'image_errors.csv'
+    run_report_file: str = 'run_report.json'
+    failure_index_file: str = 'failures.json'
+    sku_index_file: str = 'sku_index.json'
+    journal_dir: str = 'journals'
+    store_snapshot_file: str = 'store_snapshot.jsonl'
+    preflight_report_file: str = 'preflight_report.csv'
+    # Leave rows that fail the pre-flight checks out of the run
+    skip_invalid_rows: bool = True
+    verify_report_file: str = 'verify_report.json'
+    # Parsed exports are cached here; empty to always parse the CSV
+    export_cache_dir: str = '.export_cache'
+    # `cli.py watch`: an export file or a directory of them; empty watches csv_file
+    watch_path: str = ''
+    watch_interval: int = 60
+    watch_workers: int = 4
+    watch_state_file: str = 'watch_state.json'
+    # Sharded runs (cli.py worker): every worker must use the same shard count and lease file
+    shard_count: int = 16
+    lease_db_file: str = 'shards.sqlite'
+    lease_seconds: int = 120
+    log_level: str = 'INFO'
+    log_format: str = 'json'
+    # Empty styles the description attribute table inline
+    description_table_class: str = ''
+    # Port for the Prometheus endpoint (see metrics.py); 0 serves nothing
+    metrics_port: int = 0
+    metrics_host: str = '127.0.0.1'
+    # 'cpu', 'memory' or 'all' to profile every stage into profile_dir (see profiling.py)
+    profile: str = ''
+    profile_dir: str = 'profile'
+    # Record every request to this cassette, or answer them from it instead of the network (see cassette.py)
+    record_file: str = ''
+    replay_file: str = ''
+    # Recorded latencies are waited out times this when replaying; 0 doesn't wait
+    replay_latency_scale: float = 1.0
+    # Resolved from the store at the start of a run
+    location_id: str = None
+
+    @property
+    def base_url(self):
+        return (self.admin_url or f"https://{self.store}").rstrip('/')
+
+    @property
+    def graphql_url(self):
+        return f"{self.base_url}/admin/api/{self.api_version}/graphql.json"
+
+    def rest_url(self, path):
+        return f"{self.base_url}/admin/api/{REST_API_VERSION}/{path}"
+
+    @property
+    def headers(self):
+        return {
+            'Content-Type': 'application/json',
+            'X-Shopify-Access-Token': self.access_token
+        }
+
+    @property
+    def rest_headers(self):
+        return {'X-Shopify-Access-Token': self.access_token}
+
+    def for_store(self, name):
+        """
+        This config pointed at the store called name in SHOPIFY_STORES. Its
+        run report, failure index, SKU index, reconcile and watch state files
+        get the name as a suffix, and its journals go in a subdirectory, so nothing
+        mixes up IDs from different stores.
+        """
+        stores = configured_stores()
+        if name not in stores:
+            raise ValueError(f"No store called {name} in SHOPIFY_STORES ({', '.join(stores) or 'none configured'})")
+        entry = stores[name]
+        return replace(
+            self,
+            store_name=name,
+            store=entry.get('store', ''),
+            access_token=entry.get('access_token', ''),
+            admin_url=entry.get('admin_url'),
+            run_report_file=store_file(self.run_report_file, name),
+            failure_index_file=store_file(self.failure_index_file, name),
+            sku_index_file=store_file(self.sku_index_file, name),
+            watch_state_file=store_file(self.watch_state_file, name),
+            store_snapshot_file=store_file(self.store_snapshot_file, name),
+            verify_report_file=store_file(self.verify_report_file, name),
+            journal_dir=os.path.join(self.journal_dir, name),
+            location_id=None
+        )
+
+    def problems(self):
+        """Anything that would stop a run before it starts"""
+        problems = []
+        if not self.store or self.store == PLACEHOLDER_STORE:
+            problems.append("SHOPIFY_STORE is not set (copy keys.py.bak to keys.py and fill it in)")
+        if not self.access_token or self.access_token == PLACEHOLDER_TOKEN:
+            problems.append("SHOPIFY_API_ACCESS_TOKEN is not set")
+        if self.source == 'woocommerce':
+            # The export is written by the pull
+            if not self.woocommerce_url:
+                problems.append("WOOCOMMERCE_URL is not set")
+            if not self.woocommerce_key or not self.woocommerce_secret:
+                problems.append("WOOCOMMERCE_CONSUMER_KEY and WOOCOMMERCE_CONSUMER_SECRET are not set (in keys.py)")
+        elif self.csv_file and not os.path.exists(self.csv_file):
+            problems.append(f"Export file {self.csv_file} does not exist")
+        return problems
+
+    @classmethod
+    def load(cls, **overrides):
+        """Build a config from vars.py, keys.py and the environment; None overrides are ignored"""
+        import vars as settings
+
+        try:
+            import keys
+            store = getattr(keys, 'SHOPIFY_STORE', '')
+            access_token = getattr(keys, 'SHOPIFY_API_ACCESS_TOKEN', '')
+            woocommerce_key = getattr(keys, 'WOOCOMMERCE_CONSUMER_KEY', '')
+            woocommerce_secret = getattr(keys, 'WOOCOMMERCE_CONSUMER_SECRET', '')
+        except ImportError:
+            store = access_token = woocommerce_key = woocommerce_secret = ''
+
+        config = cls(
+            store=os.environ.get('SHOPIFY_STORE', store),
+            access_token=os.environ.get('SHOPIFY_API_ACCESS_TOKEN', access_token),
+            api_version=settings.API_VERSION,
+            admin_url=os.environ.get('SHOPIFY_ADMIN_URL'),
+            csv_file=settings.CSV_FILE,
+            source=os.environ.get('MIGRATE_SOURCE', settings.SOURCE),
+            woocommerce_url=os.environ.get('WOOCOMMERCE_URL', settings.WOOCOMMERCE_URL),
+            woocommerce_key=os.environ.get('WOOCOMMERCE_CONSUMER_KEY', woocommerce_key),
+            woocommerce_secret=os.environ.get('WOOCOMMERCE_CONSUMER_SECRET', woocommerce_secret),
+            woocommerce_export_file=settings.WOOCOMMERCE_EXPORT_FILE,
+            woocommerce_cache_dir=settings.WOOCOMMERCE_CACHE_DIR,
+            woocommerce_workers=settings.WOOCOMMERCE_WORKERS,
+            sync_images=settings.SYNC_IMAGES,
+            rehost_images=settings.REHOST_IMAGES,
+            image_cache_dir=settings.IMAGE_CACHE_DIR,
+            image_workers=settings.IMAGE_WORKERS,
+            create_smart_collections=settings.CREATE_SMART_COLLECTIONS,
+            variant_workers=settings.VARIANT_WORKERS,
+            concurrency=settings.CONCURRENCY,
+            max_concurrency=settings.MAX_CONCURRENCY,
+            dimensions_log_file=settings.DIMENSIONS_LOG_FILE,
+            image_errors_log_file=settings.IMAGE_ERRORS_LOG_FILE,
+            run_report_file=settings.RUN_REPORT_FILE,
+            failure_index_file=settings.FAILURE_INDEX_FILE,
+            sku_index_file=settings.SKU_INDEX_FILE,
+            journal_dir=settings.JOURNAL_DIR,
+            store_snapshot_file=settings.STORE_SNAPSHOT_FILE,
+            preflight_report_file=settings.PREFLIGHT_REPORT_FILE,
+            skip_invalid_rows=settings.SKIP_INVALID_ROWS,
+            verify_report_file=settings.VERIFY_REPORT_FILE,
+            export_cache_dir=settings.EXPORT_CACHE_DIR,
+            watch_path=settings.WATCH_PATH,
+            watch_interval=settings.WATCH_INTERVAL,
+            watch_workers=settings.WATCH_WORKERS,
+            watch_state_file=settings.WATCH_STATE_FILE,
+            shard_count=settings.SHARD_COUNT,
+            lease_db_file=settings.LEASE_DB_FILE,
+            lease_seconds=settings.LEASE_SECONDS,
+            log_level=os.environ.get('MIGRATE_LOG_LEVEL', settings.LOG_LEVEL),
+            log_format=os.environ.get('MIGRATE_LOG_FORMAT', settings.LOG_FORMAT),
+            description_table_class=settings.DESCRIPTION_TABLE_CLASS,
+            metrics_port=settings.METRICS_PORT,
+            metrics_host=settings.METRICS_HOST,
+            profile=settings.PROFILE,
+            profile_dir=settings.PROFILE_DIR,
+            record_file=settings.RECORD_FILE,
+            replay_file=settings.REPLAY_FILE,
+            replay_latency_scale=settings.REPLAY_LATENCY_SCALE
+        )
+        names = {f.name for f in fields(cls)}
+        config = replace(config, **{key: value for key, value in overrides.items() if key in names and value is not None})
+        if config.source == 'woocommerce' and overrides.get('csv_file') is None:
+            config = replace(config, csv_file=config.woocommerce_export_file)
+        return config
+
+
+def configured_stores():
+    """SHOPIFY_STORES: name -> {"store", "access_token"[, "admin_url"]}"""
+    if os.environ.get('SHOPIFY_STORES'):
+        return json.loads(os.environ['SHOPIFY_STORES'])
+    try:
+        import keys
+        return dict(getattr(keys, 'SHOPIFY_STORES', {}))
+    except ImportError:
+        return {}
+
+
+def store_file(path, name):
+    """path for the store called name, e.g. failures-staging.json"""
+    root, ext = os.path.splitext(path)
+    return f"{root}-{name}{ext}"
+
+
+_config = None
+
+# The store the current thread (or task) is working on, when one export goes to several
+STORE = contextvars.ContextVar('store', default=None)
+
+
+def get_config():
+    """The active store's config, or the active config, loaded from vars.py/keys.py on first use"""
+    global _config
+    store = STORE.get()
+    if store is not None:
+        return store.config
+    if _config is None:
+        _config = Config.load()
+    return _config
+
+
+def set_config(config):
+    global _config
+    _config = config
+    return config
+
+
+class StoreLocal:
+    """
+    A run-wide object (FAILURES, JOURNAL, ...) that each store gets its own
+    of: attributes are looked up on the active store's instance, made by
+    factory the first time that store uses it, or on the default instance
+    outside of any store.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._default = factory()
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def current(self):
+        store = STORE.get()
+        if store is None:
+            return self._default
+        with self._lock:
+            if store.name not in self._instances:
+                self._instances[store.name] = self._factory()
+            return self._instances[store.name]
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+    def __len__(self):
+        return len(self.current())
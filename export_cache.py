@@ -0,0 +1,158 @@
+"""
+On-disk columnar cache of parsed WooCommerce exports.
+
+Parsing the export (multi-KB HTML descriptions and all) is the slowest part
+of starting a run, and the file rarely changes between runs. The parsed
+frame is stored once per export content and read back from then on, only
+the columns a mode asks for.
+
+An entry is a directory with the whole frame's text as one UTF-8 buffer
+(text.npy: column after column, cells joined by NUL) and the byte offset
+where each column ends (ends.npy). The buffer is memory-mapped on read
+(np.load(mmap_mode='r')) and only the columns a mode asks for are sliced
+out, decoded and split, so the others are never read, and nothing is
+unpickled. Exports smaller than MIN_CACHED_SIZE parse faster than the
+cache could help with and aren't cached.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+
+from log import get_logger
+
+logger = get_logger('export_cache')
+
+# Between cells in the cached text; an export with it in a cell isn't cached
+SEPARATOR = '\x00'
+# Smaller exports are parsed every time
+MIN_CACHED_SIZE = 1 << 20
+
+
+def file_key(path):
+    """Content hash and size of a file; the cache entry is only reused while both match"""
+    digest = hashlib.blake2b(digest_size=16)
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return f"{digest.hexdigest()}-{size}"
+
+
+class MissingColumns(ValueError):
+    pass
+
+
+def check_columns(available, columns):
+    missing = [column for column in columns if column not in available]
+    if missing:
+        raise MissingColumns(f"Export is missing columns: {', '.join(missing)}")
+
+
+def project(df, columns):
+    """df limited to columns (all of them when None)"""
+    if columns is None:
+        return df
+    check_columns(df.columns, columns)
+    return df[list(columns)]
+
+
+class ExportCache:
+    """Cached, parsed exports in directory, one entry per export file name"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def entry_path(self, csv_file, key):
+        return os.path.join(self.directory, f"{os.path.basename(csv_file)}.{key}")
+
+    def read(self, csv_file, parse, columns=None):
+        """
+        The export as parse(csv_file) would return it, from the cache when
+        the file hasn't changed. A missing entry is built from the whole file,
+        so later runs can project any columns from it.
+        """
+        if os.path.getsize(csv_file) < MIN_CACHED_SIZE:
+            return project(parse(csv_file), columns)
+
+        path = self.entry_path(csv_file, file_key(csv_file))
+        if os.path.exists(path):
+            try:
+                return self.load(path, columns)
+            except MissingColumns:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ Export cache {path} is unreadable, rebuilding it: {e}")
+                self.remove(path)
+
+        df = parse(csv_file)
+        try:
+            self.store(csv_file, path, df)
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Could not write the export cache: {e}")
+        return project(df, columns)
+
+    def load(self, path, columns):
+        import numpy as np
+        import pandas as pd
+
+        with open(os.path.join(path, 'columns.json')) as f:
+            layout = json.load(f)
+        names, rows = layout["columns"], layout["rows"]
+        if columns is not None:
+            check_columns(names, columns)
+        selected = names if columns is None else list(columns)
+
+        text = np.load(os.path.join(path, 'text.npy'), mmap_mode='r')
+        ends = np.load(os.path.join(path, 'ends.npy')).tolist()
+        data = {}
+        for name in selected:
+            number = names.index(name)
+            start = ends[number - 1] if number else 0
+            # Only this column's bytes are read from the mapping
+            data[name] = text[start:ends[number]].tobytes().decode('utf-8').split(SEPARATOR) if rows else []
+            if len(data[name]) != rows:
+                raise ValueError(f"column {name} has {len(data[name])} cells, expected {rows}")
+        return pd.DataFrame(data, columns=selected, dtype=object)
+
+    def store(self, csv_file, path, df):
+        import numpy as np
+
+        texts = []
+        for name in df.columns:
+            values = df[name].tolist()
+            if any(SEPARATOR in value for value in values):
+                raise ValueError(f"column {name} has NUL characters")
+            texts.append(SEPARATOR.join(values).encode('utf-8'))
+
+        os.makedirs(self.directory, exist_ok=True)
+        # Sharded workers may build the same entry at once; each writes its own copy
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, 'text.npy'), np.frombuffer(b''.join(texts), dtype=np.uint8))
+        np.save(os.path.join(tmp_path, 'ends.npy'), np.cumsum([len(text) for text in texts], dtype=np.int64))
+        with open(os.path.join(tmp_path, 'columns.json'), 'w') as f:
+            json.dump({"columns": list(df.columns), "rows": len(df)}, f)
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # Another worker got there first (a directory can't be replaced)
+            self.remove(tmp_path)
+            if not os.path.exists(path):
+                raise
+
+        # Entries for earlier versions of this export won't be read again
+        entry = re.compile(re.escape(os.path.basename(csv_file)) + r'\.[0-9a-f]{32}-\d+')
+        for name in os.listdir(self.directory):
+            if entry.fullmatch(name) and name != os.path.basename(path):
+                self.remove(os.path.join(self.directory, name))
+        logger.debug(f"Cached parsed export at {path}")
+
+    @staticmethod
+    def remove(path):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
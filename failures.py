@@ -0,0 +1,230 @@
+"""
+What failed in a run, kept on disk so `cli.py retry` can redo just that.
+
+Failures are recorded per SKU and stage ('product', 'variants', 'media' or
+'metafields')
+with the error class and message. The retry reads only the failed products
+(and their variants) back from the export through a byte-offset index, so
+the CSV isn't parsed again.
+"""
+import csv
+import glob
+import json
+import os
+import threading
+import time
+
+from config import StoreLocal
+from log import get_logger, current_context
+from metrics import FAILED, PRODUCTS, ROWS_READ
+
+logger = get_logger('failures')
+
+
+class FailureIndex:
+    """
+    SKU -> {stage: {"error", "message", "line", "time"}} for one run.
+
+    Safe to record into from the variant workers. Records take the SKU and
+    export line from the current log context unless given.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = None
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def open(self, path, keep=False):
+        """Record into path from now on, starting empty unless keep (which loads it and its per-worker siblings)"""
+        with self.lock:
+            self.path = path
+            self.entries = {}
+        if keep:
+            for source in [path] + self.worker_files(path):
+                if os.path.exists(source):
+                    with open(source) as f:
+                        for sku, stages in json.load(f).items():
+                            self.entries.setdefault(sku, {}).update(stages)
+        return self
+
+    @staticmethod
+    def worker_files(path):
+        """The failure files sharded workers wrote next to path"""
+        root, ext = os.path.splitext(path)
+        return sorted(glob.glob(f"{glob.escape(root)}.*{ext}"))
+
+    def record(self, stage, error, message='', sku=None):
+        context = current_context()
+        sku = sku or context.get('sku')
+        FAILED.inc(stage=stage, error=error)
+        if not sku:
+            return
+        with self.lock:
+            if stage == 'product' and 'product' not in self.entries.get(sku, {}):
+                PRODUCTS.inc(outcome='failed')
+            self.entries.setdefault(sku, {})[stage] = {
+                "error": error,
+                "message": str(message)[:500],
+                "line": context.get('line'),
+                "time": time.strftime('%Y-%m-%dT%H:%M:%S')
+            }
+
+    def skus(self):
+        with self.lock:
+            return set(self.entries)
+
+    def discard(self, skus):
+        """Forget the failures of skus, which are about to be tried again"""
+        with self.lock:
+            for sku in skus:
+                self.entries.pop(sku, None)
+
+    def take(self):
+        """Remove and return every entry; a retry re-records whatever fails again"""
+        with self.lock:
+            entries, self.entries = self.entries, {}
+        return entries
+
+    def summary(self):
+        """Failure counts by stage and error class"""
+        counts = {}
+        with self.lock:
+            for stages in self.entries.values():
+                for stage, entry in stages.items():
+                    key = f"{stage}:{entry['error']}"
+                    counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def save(self, remove_worker_files=False):
+        if not self.path:
+            return
+        with self.lock:
+            data = dict(self.entries)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, self.path)
+        if remove_worker_files:
+            # Merged into path by open(keep=True)
+            for worker_file in self.worker_files(self.path):
+                os.remove(worker_file)
+        if data:
+            logger.warning(f"⚠️ {len(data)} products had failures, see {self.path} (`cli.py retry` redoes them)",
+                           extra={"failures": self.summary()})
+
+
+# The active run's failures (each store's own when migrating to several)
+FAILURES = StoreLocal(FailureIndex)
+
+
+def scan_records(f):
+    """
+    Yield (byte offset, values) for each record of a CSV opened in binary
+    mode. Records can span lines (descriptions), so offsets are taken
+    between the records the csv module returns.
+    """
+    position = f.tell()
+    consumed = [position]
+
+    def lines():
+        # Only the start of the file has the byte order mark
+        encoding = 'utf-8-sig' if position == 0 else 'utf-8'
+        for line in f:
+            consumed[0] += len(line)
+            yield line.decode(encoding)
+            encoding = 'utf-8'
+
+    reader = csv.reader(lines())
+    start = position
+    for values in reader:
+        yield start, values
+        start = consumed[0]
+
+
+class RowOffsets:
+    """
+    Byte offset of every product row in an export, by the product's key (its
+    SKU, or id:<ID> without one), plus the offsets of each parent's
+    variations. Cached next to the parsed export and rebuilt when the file
+    changes.
+    """
+
+    def __init__(self, csv_file, cache_dir=None):
+        self.csv_file = csv_file
+        self.cache_dir = cache_dir
+        self.header = []
+        self.rows = {}
+        self.children = {}
+
+    def ensure(self):
+        from export_cache import file_key
+
+        path = None
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, f"{os.path.basename(self.csv_file)}.{file_key(self.csv_file)}.offsets.json")
+            if os.path.exists(path):
+                with open(path) as f:
+                    data = json.load(f)
+                self.header, self.rows, self.children = data["header"], data["rows"], data["children"]
+                return self
+
+        self.build()
+        if path:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump({"header": self.header, "rows": self.rows, "children": self.children}, f)
+        return self
+
+    def build(self):
+        with open(self.csv_file, 'rb') as f:
+            records = scan_records(f)
+            _, self.header = next(records)
+            column = {name: number for number, name in enumerate(self.header)}
+
+            def value(values, name):
+                number = column.get(name)
+                return values[number].strip() if number is not None and number < len(values) else ''
+
+            variations = []
+            key_by_id = {}
+            for row_number, (offset, values) in enumerate(records):
+                sku = value(values, 'SKU')
+                key = sku or f"id:{value(values, 'ID')}"
+                key_by_id[f"id:{value(values, 'ID')}"] = key
+                if value(values, 'Type').lower() == 'variation':
+                    variations.append((value(values, 'Parent'), offset, row_number))
+                if sku or value(values, 'Type').lower() == 'variable':
+                    self.rows.setdefault(key, [offset, row_number])
+
+        # Parents are referenced by SKU or id:<ID>; file both under the parent's key
+        self.children = {}
+        for parent, offset, row_number in variations:
+            if parent:
+                self.children.setdefault(key_by_id.get(parent, parent), []).append([offset, row_number])
+
+    def frame(self, keys):
+        """
+        A DataFrame of the rows for keys and all their variations, indexed by
+        their row number in the export (so line numbers in logs still match).
+        """
+        import pandas as pd
+
+        wanted = {}
+        for key in keys:
+            for offset, row_number in [self.rows[key]] if key in self.rows else []:
+                wanted[row_number] = offset
+            for offset, row_number in self.children.get(key, []):
+                wanted[row_number] = offset
+
+        values = {}
+        with open(self.csv_file, 'rb') as f:
+            for row_number, offset in sorted(wanted.items()):
+                f.seek(offset)
+                _, row = next(scan_records(f))
+                values[row_number] = row + [''] * (len(self.header) - len(row))
+
+        ROWS_READ.inc(len(values))
+        return pd.DataFrame(list(values.values()), columns=self.header, index=list(values.keys()), dtype=str)
@@ -0,0 +1,273 @@
+"""
+Rehosting product images through Shopify staged uploads.
+
+Left alone, Shopify fetches every image from the WooCommerce host, once per
+product that uses it. With REHOST_IMAGES on, images are instead downloaded
+concurrently into a local content-addressed cache, each distinct file is
+uploaded once with stagedUploadsCreate, and products reference the
+resulting resource URL. Images that can't be downloaded or uploaded fall
+back to their original URL.
+"""
+import contextvars
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlparse
+
+from config import get_config
+from instrumentation import RUN_STATS
+from log import get_logger
+from metrics import IMAGES, IMAGE_QUEUE
+
+logger = get_logger('images')
+
+# Shopify drops staged files that were never attached after a while, so an
+# upload is only reused for this long
+RESOURCE_MAX_AGE = 24 * 3600
+# Downloads started ahead of the products that need them, per download worker
+PREFETCH_AHEAD = 8
+
+
+class ImagePipeline:
+    """
+    Downloads images ahead of time on a thread pool, keyed by URL and deduped
+    by the SHA-256 of their content, and uploads each file the first time a
+    product needs it. Uploads cost API budget, so they aren't run ahead, and
+    they have a pool of their own so they never wait behind downloads.
+    Prefetching stays at most PREFETCH_AHEAD downloads per worker ahead of
+    the products asking for their sources; the rest of the URLs wait in a
+    backlog.
+
+    The cache directory holds the files (as <hash[:2]>/<hash>) and index.json,
+    which maps URLs to hashes and hashes to their uploaded resource URLs (per
+    store, as "<store>/<hash>") so later runs skip both steps.
+    """
+
+    def __init__(self, cache_dir, max_workers=8):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='images')
+        self.upload_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='image-uploads')
+        self.ahead = max_workers * PREFETCH_AHEAD
+        # Download futures by URL; those no product has asked for yet; URLs not started yet
+        self.pending = {}
+        self.unclaimed = set()
+        self.backlog = deque()
+        self.upload_lock = threading.Lock()
+        self.urls = {}
+        self.files = {}
+        self.resources = {}
+        self.load()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.cache_dir, 'index.json')
+
+    def load(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                data = json.load(f)
+            self.urls = data.get("urls", {})
+            self.resources = data.get("resources", {})
+            self.files = {entry["hash"]: entry for entry in self.urls.values()}
+
+    def save(self):
+        with self.lock:
+            data = {"urls": dict(self.urls), "resources": dict(self.resources)}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.index_path)
+
+    def blob_path(self, digest):
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def start(self, url):
+        """Submit url's download; the caller holds the lock"""
+        # Keep the caller's log context for anything the worker logs
+        context = contextvars.copy_context()
+        IMAGE_QUEUE.inc()
+        self.pending[url] = self.executor.submit(context.run, self.fetch, url)
+
+    def fill(self):
+        """Start backlogged downloads until the prefetch is self.ahead downloads ahead; the caller holds the lock"""
+        while self.backlog and len(self.unclaimed) < self.ahead:
+            url = self.backlog.popleft()
+            if url not in self.pending:
+                self.start(url)
+                self.unclaimed.add(url)
+
+    def prefetch(self, urls):
+        """Download urls in the background, in order, ahead of the products that need them"""
+        with self.lock:
+            self.backlog.extend(url for url in urls if url not in self.pending)
+            self.fill()
+
+    def sources(self, urls):
+        """
+        The originalSource to use for each of urls, in order. Waits for their
+        downloads, uploads the files Shopify doesn't have yet in one batch and
+        drops repeats of the same file.
+        """
+        with self.lock:
+            for url in urls:
+                if url in self.pending:
+                    self.unclaimed.discard(url)
+                else:
+                    self.start(url)
+            self.fill()
+        digests = []
+        for url in urls:
+            with self.lock:
+                future = self.pending[url]
+            digests.append(future.result())
+
+        # One upload per distinct file, shared by every URL and product that has it
+        with self.upload_lock:
+            self.upload([digest for digest in dict.fromkeys(digests) if digest and not self.resource_url(digest)])
+
+        sources = []
+        seen = set()
+        for url, digest in zip(urls, digests):
+            if digest in seen:
+                continue
+            if digest:
+                seen.add(digest)
+            sources.append(self.resource_url(digest) or url)
+        return sources
+
+    @staticmethod
+    def resource_key(digest):
+        # A staged upload can only be attached in the store it was made for
+        return f"{get_config().store}/{digest}"
+
+    def resource_url(self, digest):
+        """The uploaded file's resource URL in the current store, if it was uploaded recently enough to reuse"""
+        resource = self.resources.get(self.resource_key(digest))
+        if resource and time.time() - resource["uploaded"] < RESOURCE_MAX_AGE:
+            return resource["url"]
+        return None
+
+    def fetch(self, url):
+        try:
+            return self.download(url)
+        except Exception as e:
+            logger.warning(f"⚠️ Could not download image, Shopify will fetch it from the original URL: {e}", extra={"url": url})
+            return None
+        finally:
+            IMAGE_QUEUE.dec()
+
+    def download(self, url):
+        """Download url into the cache unless it is already there; returns its content hash"""
+        entry = self.urls.get(url)
+        if entry and os.path.exists(self.blob_path(entry["hash"])):
+            IMAGES.inc(step='cached')
+            return entry["hash"]
+
+        import requests
+
+        with RUN_STATS.stage('image_download'):
+            response = requests.get(url, timeout=60)
+        response.raise_for_status()
+        IMAGES.inc(step='downloaded')
+        data = response.content
+        digest = hashlib.sha256(data).hexdigest()
+
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+        filename = os.path.basename(unquote(urlparse(url).path)) or digest
+        mime_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+        if not mime_type.startswith('image/'):
+            mime_type = mimetypes.guess_type(filename)[0] or 'image/jpeg'
+        with self.lock:
+            self.urls[url] = {"hash": digest, "filename": filename, "mime_type": mime_type}
+            self.files[digest] = self.urls[url]
+        return digest
+
+    def upload(self, digests):
+        """Upload cached files: one stagedUploadsCreate per batch, then the files in parallel"""
+        from spUtilities import staged_upload_targets, upload_to_target, STAGED_UPLOAD_BATCH_SIZE
+
+        for start in range(0, len(digests), STAGED_UPLOAD_BATCH_SIZE):
+            batch = digests[start:start + STAGED_UPLOAD_BATCH_SIZE]
+            files = []
+            for digest in batch:
+                with open(self.blob_path(digest), 'rb') as f:
+                    files.append((self.files[digest]["filename"], self.files[digest]["mime_type"], f.read()))
+
+            targets = staged_upload_targets([(filename, mime_type, len(data)) for filename, mime_type, data in files])
+            futures = {
+                digest: self.upload_executor.submit(contextvars.copy_context().run, upload_to_target, target, *file)
+                for digest, target, file in zip(batch, targets, files) if target
+            }
+            for digest, future in futures.items():
+                try:
+                    resource_url = future.result()
+                except Exception as e:
+                    logger.warning(f"⚠️ Could not upload image, Shopify will fetch it from the original URL: {e}")
+                    continue
+                if resource_url:
+                    IMAGES.inc(step='uploaded')
+                    with self.lock:
+                        self.resources[self.resource_key(digest)] = {"url": resource_url, "uploaded": time.time()}
+
+    def close(self):
+        # Prefetches nobody waited for belong to products that weren't migrated
+        self.backlog.clear()
+        self.executor.shutdown(cancel_futures=True)
+        self.upload_executor.shutdown()
+        # Cancelled downloads never reach fetch() to take themselves off the queue
+        IMAGE_QUEUE.set(0)
+        self.save()
+        logger.info(f"🖼️ {len(self.urls)} image URLs, {len(self.files)} distinct files, {len(self.resources)} uploaded",
+                    extra={"cache": self.cache_dir})
+
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def get_pipeline():
+    """The run's image pipeline, or None when REHOST_IMAGES is off"""
+    global _pipeline
+    config = get_config()
+    if not config.rehost_images:
+        return None
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = ImagePipeline(config.image_cache_dir, max_workers=config.image_workers)
+        return _pipeline
+
+
+def image_sources(urls):
+    """The originalSource values for a product's image URLs"""
+    pipeline = get_pipeline()
+    return pipeline.sources(urls) if pipeline and urls else urls
+
+
+def prefetch_images(urls):
+    """Start downloading urls ahead of the products that need them (nothing when rehosting is off)"""
+    pipeline = get_pipeline()
+    if pipeline:
+        pipeline.prefetch(urls)
+
+
+def close_pipeline():
+    """Stop any downloads still running and save the cache index"""
+    global _pipeline
+    with _pipeline_lock:
+        pipeline, _pipeline = _pipeline, None
+    if pipeline:
+        pipeline.close()
@@ -0,0 +1,212 @@
+"""
+Per-stage timing and API cost tracking for a migration run.
+"""
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from log import get_logger
+from metrics import REGISTRY, WAIT_SECONDS
+
+logger = get_logger('stats')
+
+
+class RunStats:
+    """
+    Collects stage wall times, GraphQL query costs and throttle waits for one run.
+
+    Safe to share between threads. Stages can nest (e.g. sku_lookup happens
+    inside transform), so stage times are not additive.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # A profiling.StageProfiler while `--profile` is on
+        self.profiler = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.start_clock = time.perf_counter()
+            self.stages = {}
+            self.mutations = {}
+            self.waits = {}
+            self.total = 0
+            self.done = 0
+            self.unit = 'products'
+            self.last_progress = 0.0
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as one call of the named stage (and profile it while profiling)"""
+        profiler = self.profiler
+        start = time.perf_counter()
+        try:
+            with profiler.stage(name) if profiler else nullcontext():
+                yield
+        finally:
+            self.record_stage(name, time.perf_counter() - start)
+
+    def record_stage(self, name, seconds):
+        with self.lock:
+            stage = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0})
+            stage["calls"] += 1
+            stage["seconds"] += seconds
+            stage["max_seconds"] = max(stage["max_seconds"], seconds)
+
+    def record_cost(self, operation, cost, seconds=None):
+        """Record the extensions.cost block of a GraphQL response"""
+        with self.lock:
+            mutation = self.mutations.setdefault(operation, {
+                "calls": 0,
+                "requested_cost": 0,
+                "actual_cost": 0,
+                "seconds": 0.0,
+                "throttled": 0,
+                "min_available": None
+            })
+            mutation["calls"] += 1
+            if seconds is not None:
+                mutation["seconds"] += seconds
+            if not cost:
+                return
+            mutation["requested_cost"] += cost.get("requestedQueryCost") or 0
+            mutation["actual_cost"] += cost.get("actualQueryCost") or 0
+            available = (cost.get("throttleStatus") or {}).get("currentlyAvailable")
+            if available is not None:
+                if mutation["min_available"] is None or available < mutation["min_available"]:
+                    mutation["min_available"] = available
+
+    def record_throttle(self, operation):
+        with self.lock:
+            if operation in self.mutations:
+                self.mutations[operation]["throttled"] += 1
+
+    def record_wait(self, reason, seconds):
+        WAIT_SECONDS.inc(seconds, reason=reason)
+        with self.lock:
+            wait = self.waits.setdefault(reason, {"count": 0, "seconds": 0.0})
+            wait["count"] += 1
+            wait["seconds"] += seconds
+
+    def sleep(self, seconds, reason='pacing'):
+        """Sleep and account for it as a throttle wait"""
+        time.sleep(seconds)
+        self.record_wait(reason, seconds)
+
+    def set_total(self, total, unit='products', restart=False):
+        """Count towards total; restart counts from zero again, for a second batch of work in the same run"""
+        with self.lock:
+            self.total = total
+            self.unit = unit
+            if restart:
+                self.done = 0
+
+    def advance(self, count=1, min_interval=1.0):
+        """Mark items done and print a progress line with an ETA (at most every min_interval seconds)"""
+        with self.lock:
+            self.done += count
+            now = time.perf_counter()
+            if now - self.last_progress < min_interval and self.done < self.total:
+                return
+            self.last_progress = now
+            line = self.progress_line(now)
+            fields = {"done": self.done, "total": self.total}
+        logger.info(line, extra=fields)
+
+    def progress_line(self, now=None):
+        elapsed = (now or time.perf_counter()) - self.start_clock
+        rate = self.done / elapsed if elapsed > 0 else 0
+        line = f"⏱️ {self.done}/{self.total or '?'} {self.unit}, {rate:.2f}/s"
+        if rate and self.total:
+            remaining = max(self.total - self.done, 0) / rate
+            line += f", ETA {format_duration(remaining)}"
+        return line
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.perf_counter() - self.start_clock
+            return {
+                "started": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                "elapsed_seconds": round(elapsed, 3),
+                "products_total": self.total,
+                "products_done": self.done,
+                "products_per_sec": round(self.done / elapsed, 3) if elapsed > 0 else None,
+                "stages": {
+                    name: {
+                        "calls": stage["calls"],
+                        "seconds": round(stage["seconds"], 4),
+                        "avg_ms": round(stage["seconds"] / stage["calls"] * 1000, 3),
+                        "max_ms": round(stage["max_seconds"] * 1000, 3)
+                    }
+                    for name, stage in self.stages.items()
+                },
+                "mutations": {
+                    name: dict(mutation, seconds=round(mutation["seconds"], 4))
+                    for name, mutation in self.mutations.items()
+                },
+                "throttle_waits": {
+                    reason: {"count": wait["count"], "seconds": round(wait["seconds"], 3)}
+                    for reason, wait in self.waits.items()
+                },
+                "total_requested_cost": sum(m["requested_cost"] for m in self.mutations.values()),
+                "total_actual_cost": sum(m["actual_cost"] for m in self.mutations.values())
+            }
+
+    def write_report(self, path, **sections):
+        """Write the run summary (plus any extra sections) as JSON and print a short version of it"""
+        summary = dict(self.summary(), **sections)
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+        logger.info(f"📈 Run summary ({summary['elapsed_seconds']}s, {summary['products_done']} {self.unit})")
+        for name, stage in sorted(summary["stages"].items(), key=lambda item: -item[1]["seconds"]):
+            logger.info(f"  {name:<14} {stage['calls']:>6} calls {stage['seconds']:>10.3f}s  avg {stage['avg_ms']:.1f}ms")
+        logger.info(f"  query cost: {summary['total_actual_cost']} actual / {summary['total_requested_cost']} requested")
+        for reason, wait in summary["throttle_waits"].items():
+            logger.info(f"  waited {wait['seconds']}s for {reason} ({wait['count']} times)")
+        logger.info(f"✅ Run report written to {path}")
+        return summary
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+def timed(stage_name):
+    """Decorator recording each call of a function as a stage in RUN_STATS"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with RUN_STATS.stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profiled(stage_name):
+    """Like timed, but only a stage while profiling, for calls too small or frequent to time on every run"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if RUN_STATS.profiler is None:
+                return func(*args, **kwargs)
+            with RUN_STATS.stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Stats for the current run
+RUN_STATS = RunStats()
+
+REGISTRY.gauge('migrate_progress_done', 'Items done in the current run', ['unit'], collect=lambda: {RUN_STATS.unit: RUN_STATS.done})
+REGISTRY.gauge('migrate_progress_total', 'Items the current run expects to do', ['unit'], collect=lambda: {RUN_STATS.unit: RUN_STATS.total})
@@ -0,0 +1,97 @@
+"""
+What each run created in the store, so `cli.py rollback` can take it out.
+
+Every product and collection is appended to the run's journal (one JSON
+line with its kind, ID and SKU or title) as soon as Shopify returns its ID.
+Lines are flushed as they're written, so a run that crashed still leaves a
+complete journal. Journals are files in JOURNAL_DIR named after the time the
+run started and a random suffix, so runs started in the same second (by
+two processes, or one watch processing two exports) get a journal each
+(sharded runs are told apart by worker instead).
+"""
+import glob
+import json
+import os
+import secrets
+import threading
+import time
+
+from config import StoreLocal
+from log import get_logger
+
+logger = get_logger('journal')
+
+
+class RunJournal:
+    """The journal of the active run; recording is a no-op until open() is called"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = None
+        self.file = None
+
+    def open(self, directory, name=None):
+        """
+        Start a new journal in directory, named after the current time (and a
+        random suffix) unless name is given. The file is only created once
+        there's something in it.
+        """
+        self.close()
+        name = name or f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}"
+        with self.lock:
+            self.path = os.path.join(directory, f"{name}.jsonl")
+        return self
+
+    def record(self, kind, object_id, sku=None, title=None):
+        if not object_id:
+            return
+        entry = {"kind": kind, "id": object_id, "sku": sku, "title": title, "time": time.strftime('%Y-%m-%dT%H:%M:%S')}
+        with self.lock:
+            if self.path is None:
+                return
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                # Line buffered, so every entry is on disk before the next request goes out
+                self.file = open(self.path, 'a', encoding='utf-8', buffering=1)
+            self.file.write(json.dumps(entry) + '\n')
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                logger.info(f"📒 Created objects journalled in {self.path} (`cli.py rollback` removes them)")
+            self.file = None
+            self.path = None
+
+
+# The active run's journal (each store's own when migrating to several)
+JOURNAL = StoreLocal(RunJournal)
+
+
+def journal_files(directory):
+    """The journals in directory, oldest first"""
+    return sorted(glob.glob(os.path.join(glob.escape(directory), '*.jsonl')), key=os.path.getmtime)
+
+
+def read_journal(path):
+    """The entries of a journal; a line cut short by a crash is skipped"""
+    entries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                logger.warning("⚠️ Skipping an unreadable journal line", extra={"journal": path})
+    return entries
+
+
+def rewrite_journal(path, entries):
+    """Keep only entries in the journal, or retire it once it's empty"""
+    if not entries:
+        os.replace(path, f"{path[:-len('.jsonl')]}.rolledback")
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+    os.replace(tmp_path, path)
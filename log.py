@@ -0,0 +1,114 @@
+"""
+Structured logging for the migration.
+
+Everything logs through get_logger(). Records are written as JSON lines (or
+plain text) and carry whatever per-product context is active, e.g.
+
+    with log_context(sku='WPcon7', line=3):
+        logger.info("Created product", extra={"product_id": product_id})
+
+Full GraphQL payloads are only serialised at debug level (see log_payload).
+"""
+import contextvars
+import json
+import logging
+import sys
+import time
+from contextlib import contextmanager
+
+LOG_CONTEXT = contextvars.ContextVar('log_context', default={})
+
+# Attributes every LogRecord has; anything else came from extra={...}
+RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+def record_fields(record):
+    """The context and extra fields attached to a record"""
+    fields = dict(LOG_CONTEXT.get())
+    for key, value in vars(record).items():
+        if key not in RESERVED_ATTRS:
+            fields[key] = value
+    return fields
+
+
+class JsonLineFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        entry.update(record_fields(record))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable lines prefixed with the CSV line and SKU being processed"""
+
+    def format(self, record):
+        fields = record_fields(record)
+        prefix = ''
+        if 'line' in fields:
+            prefix += f"{fields.pop('line')} "
+        if 'sku' in fields:
+            prefix += f"[{fields.pop('sku')}] "
+        payload = fields.pop('payload', None)
+        line = prefix + record.getMessage()
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        if payload is not None:
+            line += '\n' + json.dumps(payload, indent=2, ensure_ascii=False, default=str)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+def configure_logging(level=None, fmt=None, stream=None):
+    """
+    Set up the migration's log handler.
+
+    level and fmt default to the active config (LOG_LEVEL / LOG_FORMAT in
+    vars.py, or the MIGRATE_LOG_LEVEL / MIGRATE_LOG_FORMAT environment variables).
+    """
+    from config import get_config
+
+    level = level or get_config().log_level
+    fmt = fmt or get_config().log_format
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JsonLineFormatter() if fmt == 'json' else TextFormatter())
+
+    root = logging.getLogger('migrate')
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    root.propagate = False
+    return root
+
+
+def get_logger(name):
+    return logging.getLogger(f"migrate.{name}")
+
+
+@contextmanager
+def log_context(**fields):
+    """Attach fields (sku, line, ...) to every record logged inside the block"""
+    token = LOG_CONTEXT.set({**LOG_CONTEXT.get(), **fields})
+    try:
+        yield
+    finally:
+        LOG_CONTEXT.reset(token)
+
+
+def current_context():
+    return LOG_CONTEXT.get()
+
+
+def log_payload(logger, message, payload):
+    """Log a full request/response payload, only paying for it at debug level"""
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(message, extra={"payload": payload})
@@ -0,0 +1,168 @@
+"""
+Product and variant metafields, written in batches apart from the products
+and variants they belong to.
+
+Products and variants are created with only their woocommerce_sku metafield,
+so they can always be found again. Everything else the transform produces
+(the dimensions from process_attributes) is queued with the product's or
+variant's ID and sent in metafieldsSet calls of METAFIELDS_BATCH_SIZE metafields, taken from
+as many products as it takes to fill them, from a background thread.
+
+The custom.* definitions are looked up once per store before the first
+write, and whichever are missing are created.
+"""
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import get_config, StoreLocal
+from failures import FAILURES
+from log import get_logger, current_context, log_context
+from metrics import METAFIELDS_WRITTEN
+from spUtilities import METAFIELDS_BATCH_SIZE, get_metafield_definitions, create_metafield_definition, set_metafields
+
+logger = get_logger('metafields')
+
+NAMESPACE = 'custom'
+METAFIELD_TYPE = 'single_line_text_field'
+# (key, name) of everything the migration writes, defined for products and variants alike
+DEFINITIONS = [
+    ('woocommerce_sku', 'WooCommerce SKU'),
+    ('width', 'Width'),
+    ('height', 'Height'),
+    ('depth', 'Depth')
+]
+OWNER_TYPES = ('PRODUCT', 'PRODUCTVARIANT')
+
+# Batches in flight at once; each one is a single request
+WRITER_WORKERS = 2
+
+
+def rejected_entries(errors, batch_size):
+    """Positions in the batch that the errors point at (field ["metafields", "3", "value"])"""
+    positions = set()
+    for error in errors:
+        field = error.get("field") or []
+        if len(field) > 1 and field[0] == "metafields" and str(field[1]).isdigit() and int(field[1]) < batch_size:
+            positions.add(int(field[1]))
+    return positions
+
+
+class MetafieldWriter:
+    """
+    Queues metafields by owner and writes them in full batches as they fill
+    up; flush() sends the rest and waits for everything sent. Safe to add to
+    from the variant workers.
+    """
+
+    def __init__(self, max_workers=WRITER_WORKERS):
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        # (MetafieldsSetInput, SKU and export line of its product) in the order they were added
+        self.pending = []
+        self.futures = []
+        self.executor = None
+        self.definition_lock = threading.Lock()
+        # GraphQL URLs of the stores whose definitions are in place
+        self.defined = set()
+
+    def add(self, owner_id, metafields, sku=None):
+        if not owner_id or not metafields:
+            return
+        context = current_context()
+        # Where a failure is recorded against
+        product = {"sku": sku or context.get('sku'), "line": context.get('line')}
+        with self.lock:
+            self.pending.extend((dict(metafield, ownerId=owner_id), product) for metafield in metafields)
+            batches = self.take(full_only=True)
+        for batch in batches:
+            self.submit(batch)
+
+    def take(self, full_only):
+        """Cut the pending metafields into batches (called holding the lock)"""
+        end = len(self.pending) - len(self.pending) % METAFIELDS_BATCH_SIZE if full_only else len(self.pending)
+        batches = [self.pending[start:start + METAFIELDS_BATCH_SIZE] for start in range(0, end, METAFIELDS_BATCH_SIZE)]
+        del self.pending[:end]
+        return batches
+
+    def submit(self, batch):
+        # With the caller's context, so the batch goes to the caller's store and logs with its context
+        context = contextvars.copy_context()
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='metafields')
+            self.futures.append(self.executor.submit(context.run, self.write, batch))
+
+    def flush(self):
+        """Send whatever is pending, however few, and wait for every batch sent so far"""
+        with self.lock:
+            batches = self.take(full_only=False)
+        for batch in batches:
+            self.submit(batch)
+        with self.lock:
+            futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def ensure_definitions(self):
+        """Create whichever of DEFINITIONS the current store doesn't have yet, once per store"""
+        store = get_config().graphql_url
+        with self.definition_lock:
+            if store in self.defined:
+                return
+            created = 0
+            for owner_type in OWNER_TYPES:
+                existing = get_metafield_definitions(owner_type, NAMESPACE)
+                for key, name in DEFINITIONS:
+                    if key in existing:
+                        continue
+                    errors = create_metafield_definition({
+                        "name": name,
+                        "namespace": NAMESPACE,
+                        "key": key,
+                        "type": METAFIELD_TYPE,
+                        "ownerType": owner_type
+                    })
+                    created += not errors
+            if created:
+                logger.info(f"🏷️ Created {created} metafield definitions")
+            # Metafields can be written without a definition, so failing to create one doesn't stop anything
+            self.defined.add(store)
+
+    def write(self, batch):
+        try:
+            self.ensure_definitions()
+            errors = set_metafields([metafield for metafield, _ in batch])
+            if errors:
+                # Shopify writes none of a batch with errors, so the entries they don't point at go again
+                rejected = rejected_entries(errors, len(batch))
+                self.record(errors, [batch[position] for position in sorted(rejected)] if rejected else batch)
+                batch = [entry for position, entry in enumerate(batch) if position not in rejected] if rejected else []
+                if batch:
+                    errors = set_metafields([metafield for metafield, _ in batch])
+                    if errors:
+                        self.record(errors, batch)
+                        return
+            METAFIELDS_WRITTEN.inc(len(batch))
+        except Exception as e:
+            logger.exception("❌ Writing metafields failed")
+            self.record([{"message": str(e)}], batch, error=type(e).__name__)
+
+    @staticmethod
+    def record(errors, entries, error='UserError'):
+        logger.error(f"❌ Errors writing {len(entries)} metafields: {errors[0]['message']}", extra={"errors": errors[:5]})
+        products = {product["sku"]: product for _, product in entries if product["sku"]}
+        for product in products.values():
+            with log_context(**product):
+                FAILURES.record('metafields', error, errors[0]['message'])
+
+
+# Shared by everything that creates or updates products in a store
+METAFIELDS = StoreLocal(MetafieldWriter)
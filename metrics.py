@@ -0,0 +1,218 @@
+"""
+Live metrics for long runs, served in the Prometheus text format.
+
+    python cli.py --metrics-port 9464 migrate
+    curl localhost:9464/metrics
+
+Counters and histograms are updated where things happen (rows read,
+products created or updated, failures, variants, media, every GraphQL
+request); gauges such as progress and queue depths are read when scraped.
+Nothing is served unless a port is given, and updating the metrics costs a
+lock and an addition, so they are always collected.
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from log import get_logger
+
+logger = get_logger('metrics')
+
+# Seconds; GraphQL calls run from tens of milliseconds to several seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        # Without labels there's one series, exposed as 0 before anything happens
+        self.values = {} if self.labels else {(): 0}
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def samples(self):
+        """(suffix, label values, extra labels, value) for each sample to expose"""
+        with self.lock:
+            return [('', key, (), value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.labels, key, extra)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that is set, or read from collect() (a number, or {label values: number}) when scraped"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.collect is None:
+            return super().samples()
+        value = self.collect()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [('', key if isinstance(key, tuple) else (key,), (), number) for key, number in sorted(value.items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.values = {}
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for number, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[number] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    samples.append(('_bucket', key, (('le', format_value(bound)),), count))
+                samples.append(('_sum', key, (), total))
+                samples.append(('_count', key, (), counts[-1]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=(), collect=None):
+        return self.register(Gauge(name, documentation, labels, collect))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # A broken gauge shouldn't take the whole scrape down
+                logger.warning(f"⚠️ Could not collect {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+ROWS_READ = REGISTRY.counter('migrate_rows_read_total', 'Export rows read')
+PRODUCTS = REGISTRY.counter('migrate_products_total', 'Products written to Shopify, by outcome', ['outcome'])
+FAILED = REGISTRY.counter('migrate_failures_total', 'Failures recorded for retry, by stage and error', ['stage', 'error'])
+VARIANTS = REGISTRY.counter('migrate_variants_created_total', 'Variants created')
+METAFIELDS_WRITTEN = REGISTRY.counter('migrate_metafields_written_total', 'Product metafields written by metafieldsSet')
+MEDIA = REGISTRY.counter('migrate_media_total', 'Images attached to products, by where Shopify fetches them from', ['source'])
+IMAGES = REGISTRY.counter('migrate_images_total', 'Image files handled by the rehosting pipeline', ['step'])
+REQUEST_SECONDS = REGISTRY.histogram('shopify_request_duration_seconds', 'GraphQL request latency', ['operation'])
+QUERY_COST = REGISTRY.counter('shopify_query_cost_total', 'Actual GraphQL query cost', ['operation'])
+THROTTLED = REGISTRY.counter('shopify_throttled_total', 'THROTTLED responses', ['operation'])
+DELETED = REGISTRY.counter('migrate_deleted_total', 'Products and collections deleted by rollback', ['kind'])
+WAIT_SECONDS = REGISTRY.counter('migrate_wait_seconds_total', 'Time spent waiting on purpose, by reason', ['reason'])
+VARIANT_QUEUE = REGISTRY.gauge('migrate_variant_queue_depth', 'Parents whose variants are queued or being created')
+IMAGE_QUEUE = REGISTRY.gauge('migrate_image_queue_depth', 'Image downloads queued or running')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown the run's own log
+        pass
+
+
+class MetricsServer:
+    """Serves a registry on /metrics from a daemon thread"""
+
+    def __init__(self, port, host='127.0.0.1', registry=REGISTRY):
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.registry = registry
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def start(self):
+        self.thread.start()
+        logger.info(f"📊 Serving metrics on {self.url}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
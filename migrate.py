@@ -1,18 +1,24 @@
-import pandas as pd
-
-import time
 from spUtilities import delete_all_product_images, create_media
 from utilities import parse_tags, open_log_files, format_description, check_variant, check_parent, parse_decade, process_categories, process_attributes
-from spUtilities import get_product_by_sku, get_locations, get_publication_ids, create_product, create_variable_product, update_product, create_smart_collection, add_variants
-from vars import *
-from keys import *
-from utilities import get_child_products, check_parent, add_child_product
+from spUtilities import get_product_by_sku, get_locations, get_publication_ids, create_product, create_variable_product, update_product, create_smart_collection, add_variants, get_product_variants, existing_variant, VariantScheduler, CONCURRENCY
+from utilities import check_parent, add_child_product, get_line_number, read_export, read_export_rows, parse_images, TAGS, CATEGORIES
+from config import get_config
+from instrumentation import RUN_STATS, timed
+from log import get_logger, log_context
+from failures import FAILURES, RowOffsets
+from journal import JOURNAL
+from metafields import METAFIELDS
+from images import prefetch_images, close_pipeline
+from product_graph import ProductGraph, product_rows
+from woocommerce import refresh_export
+
+logger = get_logger('main')
 
 def resync_images(image_field, product_id, sku=None, name=None):
     if not image_field:
         return
 
-    image_urls = [url.strip() for url in image_field.split(",") if url.strip()]
+    image_urls = parse_images(image_field)
     if not image_urls:
         return
 
@@ -20,25 +26,35 @@ def resync_images(image_field, product_id, sku=None, name=None):
     delete_all_product_images(product_id)
     
     # Then upload new images
-    create_media(product_id, image_urls, sku=sku, name=name, line_number=line_number)
-
-
-def transform_product(row, parent_product=None):
-    existing_product_id = get_product_by_sku(row.get('SKU', ''))
+    create_media(product_id, image_urls, sku=sku, name=name)
+
+
+@timed('transform')
+def transform_product(row, parent_product=None, parent_id=None, lookup=True, variations=None):
+    """
+    The Shopify product (or variant) input for an export row. Variants of a
+    parent that was just created are passed its ID and lookup=False, so no
+    store lookups are made for them. With lookup=False and no parent_id
+    nothing is looked up at all, and the store's IDs are left unset. A
+    parent's variation rows give it the options they set.
+    """
+    # An empty sku: search would match any product
+    sku = row.get('SKU', '').strip()
+    existing_product_id = get_product_by_sku(sku) if lookup and sku else None
 
     # Process categories into unique tags and get designer name
     categories = row.get('Categories', '')
     tag_list, category_designer = process_categories(categories)
     
     # Process attributes and get dimensions and designer name
-    attr_tags, dimension_metafields, attr_designer, product_attributes, variant_attributes = process_attributes(row, parent_product)
+    attr_tags, dimension_metafields, attr_designer, product_attributes, variant_attributes = process_attributes(row, parent_product, variations)
     
     # Determine the vendor (designer name)
     vendor = row.get('Brand', 'Vampt Vintage Design')
     
     # Use designer name from attributes or categories if available
     if attr_designer:
-        ALL_CATEGORIES.add(attr_designer)
+        TAGS.add_categories([attr_designer])
         vendor = attr_designer
     elif category_designer:
         vendor = category_designer
@@ -59,11 +75,11 @@ def transform_product(row, parent_product=None):
     # Check if this is a variant
     parent_product_id = None
     if check_variant(row):
-        parent_product_id = get_product_by_sku(row.get('Parent', ''))
+        parent_product_id = parent_id or (get_product_by_sku(row.get('Parent', '')) if lookup else None)
 
 
-    # Format description with proper HTML tags
-    description = format_description(row.get('Short description', ''), product_attributes)
+    # Format description with proper HTML tags (variants don't have one of their own in Shopify)
+    description = '' if check_variant(row) else format_description(row.get('Short description', ''), product_attributes)
 
     # Set product status based on WooCommerce Published column
     published_value = row.get('Published', '0')
@@ -102,14 +118,14 @@ def upload_to_shopify(product, images_str=None):
         response, productId = create_product(product)
 
         if response.status_code != 200:
-            print(f"{line_number} ❌ Failed to create product: {response.text}")
+            logger.error("❌ Failed to create product", extra={"status": response.status_code, "body": response.text})
             return
 
     # Update existing product
     if not product.get("isNew") and not product.get("isVariant"):
         response = update_product(product)
         if response.status_code != 200:
-            print(f"{line_number} ❌ Failed to update product: {response.text}")
+            logger.error("❌ Failed to update product", extra={"status": response.status_code, "body": response.text})
             return
 
     if response.status_code == 200:
@@ -118,9 +134,7 @@ def upload_to_shopify(product, images_str=None):
         errors = data.get('errors', [])
 
         if errors:
-            print(f"{line_number} ❌ Errors for {product.get('title', product.get('sku', 'Unknown'))}:")
-            for error in errors:
-                print(f"{error['message']}")
+            logger.error(f"❌ Errors for {product.get('title', product.get('sku', 'Unknown'))}", extra={"errors": [error['message'] for error in errors]})
             return
 
         if "productId" in product:
@@ -138,84 +152,297 @@ def upload_to_shopify(product, images_str=None):
         user_errors = result.get('userErrors', [])
         
         if user_errors:
-            print(f"{line_number} ❌ Errors for {product.get('title', product.get('sku', 'Unknown'))}:")
-            for error in user_errors:
-                print(f"  - {error['field']}: {error['message']}")
+            logger.error(f"❌ Errors for {product.get('title', product.get('sku', 'Unknown'))}", extra={"errors": user_errors})
         else:
-            print(f"{line_number} ✅ {action}: {product.get('title', product.get('sku', 'Unknown'))} (ID: {product.get('id', 'N/A')})")
+            logger.info(f"✅ {action}: {product.get('title', product.get('sku', 'Unknown'))}", extra={"product_id": product.get('id', 'N/A')})
             
             # Process images if this is a parent product
             if "productId" not in product and product.get('id'):
-                if SYNC_IMAGES:
-                    resync_images(images_str, product.get('id'), sku=product.get('variants', [{}])[0].get('sku', ''), name=product.get('title', ''), line_number=line_number)
+                if get_config().sync_images:
+                    resync_images(images_str, product.get('id'), sku=product.get('variants', [{}])[0].get('sku', ''), name=product.get('title', ''))
 
     else:
-        print(f"{line_number} ❌ Failed to process {product.get('title', product.get('sku', 'Unknown'))}")
-        print(response.status_code, response.text)
+        logger.error(f"❌ Failed to process {product.get('title', product.get('sku', 'Unknown'))}", extra={"status": response.status_code, "body": response.text})
 
     return result
 
 
-def main():
-    # Get the default location ID
-    global DEFAULT_LOCATION_ID
-    DEFAULT_LOCATION_ID = get_locations()
-    
-    if not DEFAULT_LOCATION_ID:
-        print("❌ Could not find a valid location ID. Please check your Shopify store settings.")
+def create_collections(categories):
+    """Create (and publish) a smart collection for each category tag"""
+    logger.info("Creating smart collections for categories...")
+    publication_ids = get_publication_ids()
+    # Decades are tagged in their normalised form (see parse_tags), so e.g. 50s and 1950s share a collection
+    titles = dict.fromkeys(TAGS.normalize(category) for category in sorted(categories))
+    titles.pop(None, None)
+    for category in titles:
+        create_smart_collection(category, publication_ids)
+
+
+def collect_categories(rows):
+    """
+    Gather the collection categories for an export without transforming or
+    uploading anything (the same tags transform_product registers).
+    """
+    for row in rows:
+        process_categories(row.get('Categories', ''))
+        designer = process_attributes(row)[2]
+        if designer:
+            TAGS.add_categories([designer])
+    return TAGS.categories()
+
+
+def plan_collections():
+    """Log the category hierarchy seen so far, with product counts, one collection per line"""
+    counts = TAGS.category_counts
+
+    def walk(node, depth):
+        for name, children in sorted(node.items()):
+            title = TAGS.normalize(name)
+            count = counts.get(name)
+            logger.info(f"{'  ' * depth}{title} ({count} products)" if count else f"{'  ' * depth}{title}")
+            walk(children, depth + 1)
+
+    walk(CATEGORIES.hierarchy(), 0)
+
+
+def sync_collections(csv_file=None, plan=False):
+    """Create smart collections for every category in the export (or only list them with plan)"""
+    categories = collect_categories(read_export_rows(csv_file or get_config().csv_file))
+    if plan:
+        plan_collections()
         return
-    
-    print(f"✅ Using location ID: {DEFAULT_LOCATION_ID}")
+    JOURNAL.open(get_config().journal_dir)
+    create_collections(categories)
+    JOURNAL.close()
 
-    open_log_files()
 
-    # Read CSV with all columns as strings to avoid type conversion issues
-    df = pd.read_csv(CSV_FILE, dtype=str).fillna('')
-    
-    for index, row in df.iterrows():    
+def sync_images(csv_file=None):
+    """Replace the images of every already-migrated product with those in the export"""
+    for row in read_export_rows(csv_file or get_config().csv_file):
         sku = row.get('SKU', '').strip()
-        is_parent = check_parent(row)
-
-        if not sku and not is_parent:
-            continue
-
-        if not sku and is_parent:
-            sku = 'id:' + row.get('ID', '').strip()
-            
-        # Skip variants in first pass
-        if check_variant(row):
+        if not sku or check_variant(row) or not row.get('Images'):
             continue
 
-        product_data = transform_product(row)
-
+        with log_context(sku=sku):
+            product_id = get_product_by_sku(sku)
+            if not product_id:
+                logger.warning("⚠️ Product not found in Shopify, skipping images")
+                continue
+            resync_images(row.get('Images'), product_id, sku=sku, name=row.get('Name', ''))
+    close_pipeline()
+
+
+def count_products(df):
+    """How many products migrate_rows will create for an export, so progress can show an ETA"""
+    return int(product_rows(df).sum())
+
+
+def migrate_product(row, df, graph, variant_scheduler, update_existing=True):
+    """
+    Create (or update) the product for a row and submit its variants, which
+    graph finds in df. Returns the transformed product and its Shopify ID.
+    """
+    variants = graph.variants(graph.keys[row.name], df)
+    product_data = transform_product(row, variations=variants)
+
+    if not product_data.get('shopifyExistingId') and not product_data.get('sku'):
+        # A parent without a SKU of its own is found through the first of its variants that has one
+        variant_sku = next((sku for sku in (variant.get('SKU', '').strip() for variant in variants) if sku), None)
+        if variant_sku:
+            product_data['shopifyExistingId'] = get_product_by_sku(variant_sku)
+            product_data['isNew'] = not product_data['shopifyExistingId']
+    existed = bool(product_data.get('shopifyExistingId'))
+
+    # Re-runs (and reclaimed shards) update what an earlier attempt created
+    if existed:
+        if update_existing:
+            update_product(product_data)
+        product_id = product_data['shopifyExistingId']
+    else:
         result, product_id = create_product(product_data)
 
-        child_products = get_child_products(product_data.get('sku'), df)
-        
-        children = []
-        for child_product in child_products:
-            # Now transform the dictionary
-            child_product_data = transform_product(child_product, product_data)
-            # add_child_product(child_product_data)
-            children.append(child_product_data)
+    if not product_id:
+        return product_data, product_id
+    if not existed or update_existing:
+        METAFIELDS.add(product_id, product_data.get('metafields'))
+
+    children = []
+    for child_product in variants:
+        with log_context(sku=child_product.get('SKU', ''), line=get_line_number(child_product)):
+            child_product_data = transform_product(child_product, product_data, parent_id=product_id, lookup=False)
+        children.append(child_product_data)
+
+    # A new parent has no variants yet. An existing one's are read once, and only
+    # the children that aren't among them (by SKU, or by option values) are added
+    if existed and children:
+        existing_variants = get_product_variants(product_id)
+        children = [child for child in children if not existing_variant(child, existing_variants)]
+
+    # Variants go out in the background while we carry on with the next parent
+    if children:
+        variant_scheduler.submit(product_id, children, parent_product=product_data)
+
+    return product_data, product_id
+
+
+def migrate_rows(df, variant_scheduler, stop=None, graph=None):
+    """
+    Create or update every product in df, handing each parent's variants to
+    variant_scheduler as soon as the parent's ID is known. df must hold the
+    variants of the parents in it; graph is built from it (reporting any
+    orphaned variations) unless given. Stops between products once the stop
+    event is set.
+    """
+    if graph is None:
+        graph = ProductGraph(df)
+        graph.report_orphans(df)
+
+    if get_config().rehost_images:
+        # Images download and upload while the products ahead of them are created
+        prefetch_images([url for images in df.loc[graph.products, 'Images'] for url in parse_images(images)])
+
+    for label in graph.products:
+        if stop is not None and stop.is_set():
+            return False
+
+        row = df.loc[label]
+        with log_context(sku=graph.keys[label], line=get_line_number(row)):
+            try:
+                migrate_product(row, df, graph, variant_scheduler)
+            except Exception as e:
+                # One broken product shouldn't stop the rest of the export
+                logger.exception("❌ Failed to migrate product")
+                FAILURES.record('product', type(e).__name__, e)
+
+        RUN_STATS.advance()
+    return True
+
+
+def preflight_export(df, graph):
+    """Run the pre-flight checks; returns df and graph without the rows they leave out, and the Preflight"""
+    from preflight import check_export
+
+    with RUN_STATS.stage('preflight'):
+        preflight = check_export(df, graph)
+        if preflight.rejected:
+            df = df.drop(index=preflight.rejected)
+            graph = ProductGraph(df)
+    return df, graph, preflight
+
+
+def start_run(keep_failures=False):
+    """Resolve the location and reset the per-run logs and stats; False if the store isn't usable"""
+    config = get_config()
+
+    # Get the default location ID
+    config.location_id = get_locations()
     
-        if children:
-            add_variants(product_id, children, parent_product=result)
+    if not config.location_id:
+        logger.error("❌ Could not find a valid location ID. Please check your Shopify store settings.")
+        return False
+    
+    logger.info(f"✅ Using location ID: {config.location_id}")
+
+    open_log_files()
+    RUN_STATS.reset()
+    CONCURRENCY.reset(config.concurrency, config.max_concurrency)
+    TAGS.reset()
+    FAILURES.open(config.failure_index_file, keep=keep_failures)
+    JOURNAL.open(config.journal_dir)
+    return True
+
+
+def retry_failed(csv_file=None):
+    """
+    Redo only what failed in earlier runs: the failed products (and their
+    variants) are read back from the export by byte offset and the failed
+    stages run again. Whatever still fails stays in the failure index.
+    """
+    config = get_config()
+    csv_file = csv_file or config.csv_file
+    if not start_run(keep_failures=True):
+        return 1
+
+    failed = FAILURES.take()
+    if not failed:
+        logger.info("✅ Nothing to retry")
+        FAILURES.save(remove_worker_files=True)
+        return 0
+
+    with RUN_STATS.stage('read_csv'):
+        df = RowOffsets(csv_file, config.export_cache_dir).ensure().frame(failed)
+    graph = ProductGraph(df)
+    rows = {key: df.loc[label] for label, key in graph.keys.items()}
+    RUN_STATS.set_total(len(failed))
+
+    with VariantScheduler(max_workers=config.variant_workers) as variant_scheduler:
+        for sku, stages in failed.items():
+            row = rows.get(sku)
+            with log_context(sku=sku, line=get_line_number(row) if row is not None else None):
+                if row is None:
+                    logger.warning("⚠️ No longer in the export, dropping its failures")
+                    RUN_STATS.advance()
+                    continue
+
+                logger.info(f"🔁 Retrying {', '.join(stages)}")
+                try:
+                    # Variants that are still missing are always resubmitted, so 'variants' needs nothing extra
+                    product_data, product_id = migrate_product(row, df, graph, variant_scheduler, update_existing='product' in stages)
+                    if 'media' in stages and product_data.get('shopifyExistingId'):
+                        resync_images(row.get('Images'), product_id, sku=sku, name=row.get('Name', ''))
+                    if 'metafields' in stages and 'product' not in stages and product_data.get('shopifyExistingId'):
+                        METAFIELDS.add(product_id, product_data.get('metafields'))
+                except Exception as e:
+                    logger.exception("❌ Retry failed")
+                    FAILURES.record('product', type(e).__name__, e)
+
+            RUN_STATS.advance()
+
+    close_pipeline()
+    METAFIELDS.close()
+    JOURNAL.close()
+    logger.info(f"🔁 Retried {len(failed)} products, {len(FAILURES)} still failing")
+    FAILURES.save(remove_worker_files=True)
+    RUN_STATS.write_report(config.run_report_file, concurrency=CONCURRENCY.log_operating_point())
+    return 1 if len(FAILURES) else 0
 
-        # else:       
-        # result = upload_to_shopify(product_data, row.get('Images', ''))
 
-        time.sleep(0.2)  # Throttle requests
+def main():
+    """Migrate the export into the store; returns 1 if it couldn't run or anything failed"""
+    config = get_config()
+    if not start_run():
+        return 1
+    csv_file = refresh_export()
+    if not csv_file:
+        return 1
+
+    with RUN_STATS.stage('read_csv'):
+        df = read_export(csv_file)
+
+    with RUN_STATS.stage('product_graph'):
+        graph = ProductGraph(df)
+    orphans = graph.report_orphans(df)
+    df, graph, preflight = preflight_export(df, graph)
+    RUN_STATS.set_total(len(graph))
+    
+    # Parents are created in order; each one's variants are created concurrently
+    # as soon as its product ID comes back
+    with VariantScheduler(max_workers=config.variant_workers) as variant_scheduler:
+        migrate_rows(df, variant_scheduler, graph=graph)
     
-    if CREATE_SMART_COLLECTIONS:
+    if config.create_smart_collections:
         # Create smart collections for each unique category
-        print("\nCreating smart collections for categories...")
-        publication_ids = get_publication_ids()
-        for category in sorted(ALL_CATEGORIES):
-            category = parse_decade(category)
-            create_smart_collection(category,publication_ids)
-            time.sleep(0.2)  # Throttle requests
+        create_collections(TAGS.categories())
+
+    close_pipeline()
+    METAFIELDS.close()
+    JOURNAL.close()
+    FAILURES.save()
+    RUN_STATS.write_report(config.run_report_file, tag_vocabulary=TAGS.vocabulary(), orphans=orphans,
+                           preflight=preflight.summary(), concurrency=CONCURRENCY.log_operating_point())
+    return 1 if len(FAILURES) else 0
 
 
 if __name__ == "__main__":
-    main()
+    from cli import main as cli_main
+    cli_main()
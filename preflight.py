@@ -0,0 +1,199 @@
+"""
+Pre-flight checks of an export, run before anything is sent to Shopify.
+
+Every check is one vectorised expression over a column of the whole export,
+so the full export is checked in a fraction of a second, and every problem
+is found up front rather than one failed mutation at a time. Problems are
+written to PREFLIGHT_REPORT_FILE (a CSV with the export line of each) and
+summarised in the log.
+
+Rows with errors would fail in Shopify or corrupt what's there, so with
+SKIP_INVALID_ROWS on they are left out of the run, together with the
+variations of a parent that is left out. Only the first row of a duplicated
+SKU is kept. Warnings are reported and migrated as they are.
+"""
+import os
+
+from config import get_config
+from log import get_logger
+from product_graph import product_rows
+from spUtilities import MAX_OPTIONS, MAX_VARIANTS
+from utilities import variation_options
+
+logger = get_logger('preflight')
+
+ERROR = 'error'
+WARNING = 'warning'
+
+# Shopify rejects longer product titles
+MAX_TITLE_LENGTH = 255
+GTIN_COLUMN = 'GTIN, UPC, EAN, or ISBN'
+# What a spreadsheet makes of a long barcode, e.g. 3.50809E+15; the digits are gone
+SCIENTIFIC_NOTATION = r'\d+(?:\.\d+)?[eE][+-]?\d+'
+# add_variants sends stock as an int
+WHOLE_NUMBER = r'-?\d+'
+# Examples logged per check; the report has every row
+LOG_EXAMPLES = 5
+
+REPORT_COLUMNS = ['line', 'sku', 'check', 'severity', 'column', 'value', 'message']
+
+
+class Preflight:
+    """
+    The problems found in df (issues, a DataFrame with REPORT_COLUMNS, indexed
+    by row label) and the labels of the rows that shouldn't be migrated.
+    """
+
+    def __init__(self, df, graph):
+        import pandas as pd
+
+        self.df = df
+        self.graph = graph
+        self.found = []
+        self.duplicates = []
+
+        skus = self.column('SKU')
+        types = self.column('Type').str.lower()
+        variations = types == 'variation'
+        products = product_rows(df)
+        # Rows that become a variant of their own and so need a price and stock
+        sellable = variations | products & (types != 'variable')
+
+        duplicated = (skus != '') & skus.duplicated(keep=False)
+        self.add(duplicated, 'duplicate_sku', ERROR, 'SKU', 'SKU is on more than one row, only the first is migrated')
+        self.duplicates = list(skus.index[(skus != '') & skus.duplicated(keep='first')])
+
+        orphans = pd.Series(False, index=df.index)
+        orphans[[label for label, _, _ in graph.orphans]] = True
+        self.add(orphans, 'missing_parent', WARNING, 'Parent', "Variation's parent isn't in the export, it is skipped")
+
+        for column in ('Regular price', 'Sale price'):
+            values = self.column(column)
+            amounts = pd.to_numeric(values, errors='coerce')
+            self.add((values != '') & amounts.isna(), 'price', ERROR, column, 'Not a number')
+            self.add(amounts < 0, 'price', ERROR, column, 'Negative price')
+        self.add(sellable & (self.column('Regular price') == ''), 'price', WARNING, 'Regular price',
+                 'No price, it would be created at 0.00')
+
+        stock = self.column('Stock')
+        self.add((stock != '') & ~stock.str.fullmatch(WHOLE_NUMBER), 'stock', ERROR, 'Stock', 'Not a whole number')
+
+        self.add(self.column(GTIN_COLUMN).str.fullmatch(SCIENTIFIC_NOTATION), 'gtin', WARNING, GTIN_COLUMN,
+                 'In scientific notation, the real digits are lost; re-export the column as text')
+
+        names = self.column('Name')
+        self.add(products & (names == ''), 'title', ERROR, 'Name', 'Product has no name')
+        self.add(products & (names.str.len() > MAX_TITLE_LENGTH), 'title', ERROR, 'Name',
+                 f'Longer than the {MAX_TITLE_LENGTH} characters Shopify allows')
+
+        # A parent's options are its attributes not shown on the product page and
+        # those its variations set (see process_attributes)
+        numbers = [column.split(' ')[1] for column in df.columns if column.startswith('Attribute ') and column.endswith(' name')]
+        options = pd.Series(0, index=df.index)
+        for label in types.index[types == 'variable']:
+            row = df.loc[label]
+            hidden = {row[f'Attribute {number} name'].strip() for number in numbers
+                      if row[f'Attribute {number} name'].strip() and row[f'Attribute {number} visible'].strip() == '0'}
+            variations = graph.variants(graph.keys[label], df) if label in graph.keys else []
+            options[label] = len(hidden | set(variation_options(variations)))
+        self.add((types == 'variable') & (options > MAX_OPTIONS), 'options', ERROR, '',
+                 f'More than the {MAX_OPTIONS} options Shopify allows', value=options)
+
+        variant_counts = pd.Series(
+            {label: len(graph.children.get(key, ())) for label, key in graph.keys.items()}, dtype=int
+        ).reindex(df.index, fill_value=0)
+        self.add(variant_counts > MAX_VARIANTS, 'variants', ERROR, '',
+                 f'More than the {MAX_VARIANTS} variations Shopify allows', value=variant_counts)
+
+        self.issues = pd.concat(self.found) if self.found else pd.DataFrame(columns=REPORT_COLUMNS)
+        self.rejected = self.rows_to_skip()
+
+    def column(self, name):
+        """A column of the export, stripped; empty if the export doesn't have it"""
+        import pandas as pd
+
+        if name not in self.df.columns:
+            return pd.Series('', index=self.df.index)
+        return self.df[name].str.strip()
+
+    def add(self, mask, check, severity, column, message, value=None):
+        """Record an issue for every row in mask; value (aligned with df) defaults to the row's column"""
+        import pandas as pd
+
+        mask = mask.fillna(False).astype(bool)
+        if not mask.any():
+            return
+        rows = self.df[mask]
+        self.found.append(pd.DataFrame({
+            'line': rows.index + 2,
+            'sku': self.column('SKU')[mask],
+            'check': check,
+            'severity': severity,
+            'column': column,
+            'value': (value if value is not None else self.column(column))[mask],
+            'message': message
+        }, index=rows.index, columns=REPORT_COLUMNS))
+
+    def rows_to_skip(self):
+        """Rows with errors and the variations of parents among them, and the repeats of duplicated SKUs"""
+        errors = self.issues[(self.issues['severity'] == ERROR) & (self.issues['check'] != 'duplicate_sku')]
+        skipped = set(errors.index)
+        for label in list(skipped):
+            key = self.graph.keys.get(label)
+            if key is not None:
+                skipped.update(self.graph.children.get(key, ()))
+        # The variations under a duplicated SKU go with its first row, which is kept
+        skipped.update(self.duplicates)
+        return sorted(skipped)
+
+    @property
+    def errors(self):
+        return int((self.issues['severity'] == ERROR).sum())
+
+    @property
+    def warnings(self):
+        return int((self.issues['severity'] == WARNING).sum())
+
+    def summary(self):
+        """Counts for the run report"""
+        counts = self.issues.groupby(['severity', 'check']).size()
+        return {
+            "errors": self.errors,
+            "warnings": self.warnings,
+            "skipped_rows": len(self.rejected),
+            "checks": {f"{check} ({severity})": int(count) for (severity, check), count in counts.items()}
+        }
+
+    def log(self):
+        for (severity, check, message), rows in self.issues.groupby(['severity', 'check', 'message'], sort=False):
+            examples = [f"{sku or '?'} (line {line})" for sku, line in zip(rows['sku'][:LOG_EXAMPLES], rows['line'][:LOG_EXAMPLES])]
+            log = logger.error if severity == ERROR else logger.warning
+            log(f"{'❌' if severity == ERROR else '⚠️'} {check}: {message} ({len(rows)} rows)", extra={"examples": examples})
+
+        if self.issues.empty:
+            logger.info(f"✅ Pre-flight checks found nothing in {len(self.df)} rows")
+        else:
+            logger.info(f"📋 Pre-flight checks: {self.errors} errors, {self.warnings} warnings in {len(self.df)} rows")
+
+    def write(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        self.issues.sort_values('line', kind='stable').to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+
+def check_export(df, graph):
+    """
+    Run the checks on df, log them and write the report. The returned
+    Preflight's rejected rows are empty when SKIP_INVALID_ROWS is off.
+    """
+    config = get_config()
+    preflight = Preflight(df, graph)
+    preflight.log()
+    preflight.write(config.preflight_report_file)
+    if preflight.rejected:
+        if config.skip_invalid_rows:
+            logger.warning(f"⚠️ Skipping {len(preflight.rejected)} rows that would fail, see {config.preflight_report_file}")
+        else:
+            logger.warning(f"⚠️ Sending {len(preflight.rejected)} rows with errors anyway (SKIP_INVALID_ROWS is off)")
+            preflight.rejected = []
+    return preflight
@@ -0,0 +1,73 @@
+"""
+The parent/variant structure of an export, worked out once before a run.
+
+WooCommerce variations name their parent in the Parent column, either by
+SKU or as id:<ID> (parents exported without a SKU are only reachable that
+way). Every product row gets a key (its SKU, or id:<ID>), every variation
+is filed under its parent's key, and variations whose parent isn't in the
+export are reported instead of being silently left out.
+"""
+from log import get_logger
+
+logger = get_logger('product_graph')
+
+
+def product_rows(df):
+    """Mask of the rows that become products: anything with a SKU that isn't a variation, and every variable parent"""
+    types = df['Type'].str.strip().str.lower()
+    return (df['SKU'].str.strip() != '') & (types != 'variation') | (types == 'variable')
+
+
+class ProductGraph:
+    """
+    products: the labels of product rows in df, in export order
+    keys: product row label -> key (SKU, or id:<ID> for parents without one)
+    children: parent key -> labels of its variations, in export order
+    orphans: (label, Parent value, reason) for variations with no parent to go under
+    """
+
+    def __init__(self, df):
+        ids = df['ID'].str.strip()
+        skus = df['SKU'].str.strip()
+        types = df['Type'].str.strip().str.lower()
+
+        is_product = product_rows(df)
+        own_keys = skus.where(skus != '', 'id:' + ids)[is_product]
+
+        self.products = list(own_keys.index)
+        self.keys = dict(own_keys.items())
+        known = set(own_keys)
+        # id:<ID> references resolve to the parent's key (its SKU when it has one)
+        key_by_id = dict(zip('id:' + ids[is_product], own_keys))
+
+        self.children = {}
+        self.orphans = []
+        variations = types == 'variation'
+        for label, parent in df.loc[variations, 'Parent'].str.strip().items():
+            if not parent:
+                self.orphans.append((label, parent, 'no parent'))
+                continue
+            key = key_by_id.get(parent, parent)
+            if key not in known:
+                self.orphans.append((label, parent, 'parent not in export'))
+                continue
+            self.children.setdefault(key, []).append(label)
+
+    def __len__(self):
+        return len(self.products)
+
+    def variants(self, key, df):
+        """The variation rows of the product with key"""
+        return [df.loc[label] for label in self.children.get(key, [])]
+
+    def report_orphans(self, df):
+        """Log every orphaned variation; returns them as dicts for the run report"""
+        from utilities import get_line_number
+
+        orphans = []
+        for label, parent, reason in self.orphans:
+            row = df.loc[label]
+            orphan = {"sku": row.get('SKU', '').strip(), "line": get_line_number(row), "parent": parent, "reason": reason}
+            logger.warning(f"⚠️ Variation skipped, {reason}", extra=orphan)
+            orphans.append(orphan)
+        return orphans
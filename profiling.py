@@ -0,0 +1,268 @@
+"""
+Per-stage CPU and memory profiling (`cli.py --profile`).
+
+Every RUN_STATS stage (and the calls marked @profiled, which only count as
+stages while profiling) gets its own cProfile profile and, with memory
+profiling on, tracemalloc accounting. At the end of the run each stage's
+stats are written to the profile directory and the hottest functions and
+top allocators are logged:
+
+    <stage>.prof          cProfile stats (pstats, snakeviz, ...)
+    <stage>.txt           the same, as text sorted by own time
+    <stage>.memory.txt    source lines allocating the most in that stage
+    memory.tracemalloc    snapshot at the end of the run (tracemalloc.Snapshot.load)
+    summary.json          everything that's logged
+
+Stages nest (transform calls sku_lookup, which calls graphql), and time in
+a nested stage is profiled in that stage only, so each function's time
+shows up once. Memory is counted inclusive of nested stages. Net growth is
+measured on every call; which lines allocate is sampled, by comparing
+snapshots around the first call of a stage and then every SNAPSHOT_EVERY-th
+(at most MAX_SAMPLES per stage), since each snapshot of a process holding
+an export takes a fraction of a second. Allocations by other threads during
+a sampled call are counted too.
+
+Allocations are put down to the innermost line of this project's code on
+their stack (falling back to the line that made them), which says more than
+the pandas or stdlib internals that end up calling malloc.
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+from instrumentation import RUN_STATS
+from log import get_logger
+
+logger = get_logger('profiling')
+
+SNAPSHOT_EVERY = 100
+MAX_SAMPLES = 5
+TOP = 15
+# Stack depth kept per allocation, enough to get from pandas back to our code
+TRACE_FRAMES = 12
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+# On the stack of everything profiled, so never the interesting line
+OWN_FILES = {os.path.abspath(__file__), os.path.join(PROJECT_DIR, 'instrumentation.py')}
+
+
+def raw_traces(snapshot):
+    """(domain, size, frames most recent first, ...) for each trace in snapshot"""
+    traces = getattr(snapshot.traces, '_traces', None)
+    if traces is not None:
+        # Much faster to count and diff than Trace objects (or Snapshot.compare_to, which groups both snapshots)
+        return traces
+    return [
+        (trace.domain, trace.size, tuple((frame.filename, frame.lineno) for frame in reversed(trace.traceback)))
+        for trace in snapshot.traces
+    ]
+
+
+def allocation_site(frames):
+    """filename:line an allocation is put down to"""
+    for filename, lineno in frames:
+        if filename.startswith(PROJECT_DIR) and filename not in OWN_FILES:
+            return f"{os.path.relpath(filename, PROJECT_DIR)}:{lineno}"
+    filename, lineno = frames[0]
+    return f"{filename}:{lineno}"
+
+
+def allocation_sites(snapshot, since=None):
+    """(bytes, blocks) by allocation site for the traces in snapshot, leaving out those already in since"""
+    counts = Counter(raw_traces(snapshot))
+    if since is not None:
+        counts.subtract(Counter(raw_traces(since)))
+
+    sizes, blocks = Counter(), Counter()
+    for trace, count in counts.items():
+        if count > 0:
+            site = allocation_site(trace[2])
+            sizes[site] += trace[1] * count
+            blocks[site] += count
+    return sizes, blocks
+
+
+def stage_file_name(stage):
+    return ''.join(c if c.isalnum() or c in '-_.' else '_' for c in stage)
+
+
+class StageProfiler:
+    """Profiles of every stage of a run; see the module docstring"""
+
+    def __init__(self, directory, cpu=True, memory=True):
+        self.directory = directory
+        self.cpu = cpu
+        self.memory = memory
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiles = {}
+        self.calls = Counter()
+        self.net_bytes = Counter()
+        self.allocations = {}
+        self.unavailable = False
+
+    def start(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+        RUN_STATS.profiler = self
+        logger.info(f"🔬 Profiling {' and '.join(kind for kind, on in (('CPU', self.cpu), ('memory', self.memory)) if on)} "
+                    f"per stage into {self.directory}")
+        return self
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+            self.local.profiles = {}
+        return self.local.stack
+
+    def profile_for(self, name):
+        """This thread's profile for a stage (profiles can only be enabled on the thread that owns them)"""
+        profile = self.local.profiles.get(name)
+        if profile is None:
+            profile = self.local.profiles[name] = cProfile.Profile()
+            with self.lock:
+                self.profiles.setdefault(name, []).append(profile)
+        return profile
+
+    def enable(self, profile):
+        try:
+            profile.enable()
+            return True
+        except ValueError:
+            # Only one profiler can run at a time on some Pythons (3.12+ across threads)
+            if not self.unavailable:
+                self.unavailable = True
+                logger.warning("⚠️ Another profiler is active, some stage calls weren't profiled")
+            return False
+
+    @contextmanager
+    def stage(self, name):
+        stack = self.stack()
+        # The outer stage's profile is paused for the inner stage and for our own bookkeeping
+        if stack and stack[-1]:
+            stack[-1].disable()
+
+        with self.lock:
+            self.calls[name] += 1
+            calls = self.calls[name]
+
+        before = before_bytes = None
+        if self.memory:
+            before_bytes = tracemalloc.get_traced_memory()[0]
+            if (calls - 1) % SNAPSHOT_EVERY == 0 and (calls - 1) // SNAPSHOT_EVERY < MAX_SAMPLES:
+                before = tracemalloc.take_snapshot()
+
+        profile = self.profile_for(name) if self.cpu else None
+        if profile and not self.enable(profile):
+            profile = None
+        stack.append(profile)
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+            stack.pop()
+            if self.memory:
+                self.record_memory(name, before_bytes, before)
+            if stack and stack[-1]:
+                self.enable(stack[-1])
+
+    def record_memory(self, name, before_bytes, before):
+        after_bytes = tracemalloc.get_traced_memory()[0]
+        sizes = None
+        if before is not None:
+            sizes, _ = allocation_sites(tracemalloc.take_snapshot(), since=before)
+        with self.lock:
+            self.net_bytes[name] += after_bytes - before_bytes
+            allocations = self.allocations.setdefault(name, Counter())
+            if sizes:
+                allocations.update(sizes)
+
+    def stop(self):
+        """Write every stage's stats, log the hottest functions and top allocators and stop tracing"""
+        if RUN_STATS.profiler is self:
+            RUN_STATS.profiler = None
+        os.makedirs(self.directory, exist_ok=True)
+        summary = {"stages": {}, "hottest_functions": [], "top_allocators": []}
+
+        # Before writing the CPU stats, which allocate plenty themselves
+        if self.memory and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            snapshot.dump(os.path.join(self.directory, 'memory.tracemalloc'))
+            summary["traced_mb"] = round(current / 2 ** 20, 1)
+            summary["peak_traced_mb"] = round(peak / 2 ** 20, 1)
+            sizes, blocks = allocation_sites(snapshot)
+            summary["top_allocators"] = [
+                {"line": site, "kb": round(size / 1024, 1), "blocks": blocks[site]}
+                for site, size in sizes.most_common(TOP)
+            ]
+
+        with self.lock:
+            profiles = {name: list(items) for name, items in self.profiles.items()}
+            allocations = {name: Counter(counter) for name, counter in self.allocations.items()}
+
+        hottest = []
+        for name in sorted(set(profiles) | set(allocations)):
+            stage = summary["stages"][name] = {"calls": self.calls[name]}
+            if profiles.get(name):
+                stats = self.write_cpu(name, profiles[name])
+                stage["seconds"] = round(stats.total_tt, 4)
+                hottest.extend(
+                    (own_time, name, function, calls)
+                    for function, (_, calls, own_time, _, _) in stats.stats.items()
+                )
+            if name in allocations:
+                stage["net_kb"] = round(self.net_bytes[name] / 1024, 1)
+                stage["top_allocators"] = self.write_memory(name, allocations[name])
+
+        for own_time, name, (filename, line, function), calls in sorted(hottest, reverse=True)[:TOP]:
+            summary["hottest_functions"].append({
+                "function": f"{function} ({os.path.basename(filename)}:{line})",
+                "stage": name,
+                "own_seconds": round(own_time, 4),
+                "calls": calls
+            })
+
+        with open(os.path.join(self.directory, 'summary.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        self.log(summary)
+        return summary
+
+    def write_cpu(self, name, profiles):
+        stats = pstats.Stats(*profiles)
+        path = os.path.join(self.directory, stage_file_name(name))
+        stats.dump_stats(f"{path}.prof")
+        text = io.StringIO()
+        pstats.Stats(f"{path}.prof", stream=text).sort_stats('tottime').print_stats(40)
+        with open(f"{path}.txt", 'w') as f:
+            f.write(text.getvalue())
+        return stats
+
+    def write_memory(self, name, allocations):
+        top = [{"line": line, "kb": round(size / 1024, 1)} for line, size in allocations.most_common(TOP)]
+        samples = min(MAX_SAMPLES, (self.calls[name] + SNAPSHOT_EVERY - 1) // SNAPSHOT_EVERY)
+        with open(os.path.join(self.directory, f"{stage_file_name(name)}.memory.txt"), 'w') as f:
+            f.write(f"{name}: {self.calls[name]} calls, net {self.net_bytes[name] / 1024:.1f} KB, "
+                    f"allocations from {samples} sampled calls\n\n")
+            for entry in top:
+                f.write(f"{entry['kb']:>12.1f} KB  {entry['line']}\n")
+        return top
+
+    def log(self, summary):
+        if summary["hottest_functions"]:
+            logger.info("🔥 Hottest functions (own time)")
+            for entry in summary["hottest_functions"]:
+                logger.info(f"  {entry['own_seconds']:>9.3f}s {entry['calls']:>8} calls  {entry['function']}  [{entry['stage']}]")
+        if summary["top_allocators"]:
+            logger.info(f"🧠 Top allocators still holding memory (peak traced {summary['peak_traced_mb']} MB)")
+            for entry in summary["top_allocators"]:
+                logger.info(f"  {entry['kb']:>10.1f} KB {entry['blocks']:>8} blocks  {entry['line']}")
+        logger.info(f"✅ Stage profiles written to {self.directory}")
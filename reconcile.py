@@ -0,0 +1,320 @@
+"""
+Checking the store against the export (`cli.py verify --reconcile`).
+
+The whole catalogue is pulled with one bulk operation, saved as JSONL and
+read back in a single pass. What the export says the store should hold is
+put in dicts keyed by WooCommerce SKU first, so each product and variant in
+the snapshot is matched with one lookup on its custom.woocommerce_sku
+metafield (with the same fallbacks as SkuIndex). Whatever is still in the
+dicts at the end is missing from the store.
+
+    missing     in the export, not in the store
+    extra       in the store under a SKU the export doesn't have
+    duplicate   a second store product or variant with the same SKU
+    drift       product title or status, variant price, compare-at price or stock that differ,
+                or a variable product with a different number of variants than
+                the export has variations (the only check of variations without a SKU)
+
+Prices are expected the way `cli.py sync` pushes them (the sale price with
+the regular price as compare-at), so price and stock drift is what a sync
+would fix.
+"""
+import json
+import os
+
+from config import get_config
+from instrumentation import RUN_STATS
+from log import get_logger
+from sku_index import variant_sku
+from sync import sale_prices, same_amount
+
+logger = get_logger('reconcile')
+
+# The shape shopify_stub serves for any bulk query; products come before their variants
+CATALOGUE_QUERY = """
+{
+  products {
+    edges {
+      node {
+        id
+        title
+        status
+        metafield(namespace: "custom", key: "woocommerce_sku") {
+          value
+        }
+        variants {
+          edges {
+            node {
+              id
+              sku
+              price
+              compareAtPrice
+              inventoryQuantity
+              metafield(namespace: "custom", key: "woocommerce_sku") {
+                value
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+RECONCILE_COLUMNS = ['ID', 'Type', 'SKU', 'Name', 'Parent', 'Published', 'Stock', 'Regular price', 'Sale price']
+
+# Discrepancies of each kind that are logged; the report file has all of them
+LOG_LIMIT = 20
+
+
+def stock_level(value):
+    """The export's stock as a number, or None when it isn't managed"""
+    try:
+        return int(float(value))
+    except (ValueError, OverflowError):
+        return None
+
+
+def expected_variant(row, line):
+    price, compare_at = sale_prices(row)
+    return {"line": line, "price": price, "compare_at_price": compare_at, "stock": stock_level(row['Stock'].strip())}
+
+
+def expected_catalogue(df, graph):
+    """
+    (products, variants, families) the store should hold: products and
+    variants keyed by WooCommerce SKU, and for each variable product its key,
+    line, SKU and how many variants it should have, with its variations'
+    SKUs. A simple product is both a product and its own default variant; a
+    variable product's variants are its variations. Parents without a SKU can
+    only be checked through their variants.
+    """
+    rows = df.to_dict('index')
+    products = {}
+    variants = {}
+    families = []
+    for label in graph.products:
+        row = rows[label]
+        # Labels are positions in the export, whose header is line 1
+        line = label + 2
+        sku = row['SKU'].strip()
+        if sku:
+            products[sku] = {
+                "line": line,
+                "title": row['Name'],
+                "status": "ACTIVE" if row['Published'] == '1' else "DRAFT"
+            }
+
+        children = graph.children.get(graph.keys[label])
+        if children:
+            child_skus = [rows[child]['SKU'].strip() for child in children]
+            for child, child_sku in zip(children, child_skus):
+                if child_sku:
+                    variants[child_sku] = expected_variant(rows[child], child + 2)
+            families.append({"key": graph.keys[label], "line": line, "sku": sku, "variants": len(children),
+                             "variant_skus": [child_sku for child_sku in child_skus if child_sku]})
+        elif sku and row['Type'].strip().lower() != 'variable':
+            variants[sku] = expected_variant(row, line)
+    return products, variants, families
+
+
+class Reconciliation:
+    """Matches snapshot lines against the expected catalogue as they are read"""
+
+    def __init__(self, products, variants, families=()):
+        self.products = products
+        self.variants = variants
+        self.families = families
+        self.matched_products = {}
+        self.matched_variants = {}
+        # Store product ID -> how many variants it has, and the product of each matched variant's SKU
+        self.variant_counts = {}
+        self.variant_products = {}
+        # Product ID -> its woocommerce_sku metafield, for its variants that have none
+        self.product_metafields = {}
+        self.extra = []
+        self.duplicate = []
+        self.drift = []
+        self.unkeyed = 0
+
+    def add(self, node):
+        if '__parentId' in node:
+            self.add_variant(node)
+        elif '/Product/' in node.get('id', ''):
+            self.add_product(node)
+
+    def add_product(self, node):
+        self.product_metafields[node['id']] = node.get('metafield')
+        sku = (node.get('metafield') or {}).get('value')
+        if not sku:
+            # Parents exported without a SKU, or products that didn't come from the export
+            self.unkeyed += 1
+            return
+
+        expected = self.match(sku, node['id'], self.products, self.matched_products, 'product')
+        if expected is None:
+            return
+        for field, store_value in (('title', node.get('title')), ('status', node.get('status'))):
+            if expected[field] != store_value:
+                self.add_drift('product', sku, expected['line'], field, expected[field], store_value, node['id'])
+
+    def add_variant(self, node):
+        product_id = node['__parentId']
+        self.variant_counts[product_id] = self.variant_counts.get(product_id, 0) + 1
+        node = dict(node, product={"metafield": self.product_metafields.get(product_id)})
+        sku = variant_sku(node)
+        if not sku:
+            self.unkeyed += 1
+            return
+        self.variant_products.setdefault(sku, product_id)
+
+        expected = self.match(sku, node['id'], self.variants, self.matched_variants, 'variant')
+        if expected is None:
+            return
+        if expected['price']:
+            if not same_amount(expected['price'], node.get('price')):
+                self.add_drift('variant', sku, expected['line'], 'price', expected['price'], node.get('price'), node['id'])
+            if not same_amount(expected['compare_at_price'], node.get('compareAtPrice')):
+                self.add_drift('variant', sku, expected['line'], 'compare_at_price',
+                               expected['compare_at_price'], node.get('compareAtPrice'), node['id'])
+        if expected['stock'] is not None and expected['stock'] != node.get('inventoryQuantity'):
+            self.add_drift('variant', sku, expected['line'], 'stock', expected['stock'], node.get('inventoryQuantity'), node['id'])
+
+    def check_variant_counts(self):
+        """Once every line is read: variable products with more or fewer variants than the export has variations"""
+        for family in self.families:
+            # Found by its own SKU, or (without one) through its variations'
+            product_id = self.matched_products.get(family["sku"]) if family["sku"] else None
+            product_id = product_id or next(
+                (self.variant_products[sku] for sku in family["variant_skus"] if sku in self.variant_products), None)
+            if product_id is None:
+                # Missing, or nothing to find it by
+                continue
+            count = self.variant_counts.get(product_id, 0)
+            if count != family["variants"]:
+                self.add_drift('product', family["key"], family["line"], 'variants', family["variants"], count, product_id)
+
+    def match(self, sku, store_id, expected, matched, kind):
+        """The expected values for sku, taken out of expected so what's left is missing"""
+        entry = expected.pop(sku, None)
+        if entry is not None:
+            matched[sku] = store_id
+            return entry
+        if sku in matched:
+            self.duplicate.append({"kind": kind, "sku": sku, "id": store_id, "first_id": matched[sku]})
+        else:
+            self.extra.append({"kind": kind, "sku": sku, "id": store_id})
+        return None
+
+    def add_drift(self, kind, sku, line, field, export_value, store_value, store_id):
+        self.drift.append({
+            "kind": kind,
+            "sku": sku,
+            "line": line,
+            "field": field,
+            "export": export_value,
+            "store": store_value,
+            "id": store_id
+        })
+
+    def missing(self):
+        return (
+            [{"kind": "product", "sku": sku, "line": entry["line"]} for sku, entry in self.products.items()] +
+            [{"kind": "variant", "sku": sku, "line": entry["line"]} for sku, entry in self.variants.items()]
+        )
+
+    def report(self):
+        missing = self.missing()
+        return {
+            "summary": {
+                "products_matched": len(self.matched_products),
+                "variants_matched": len(self.matched_variants),
+                "missing": len(missing),
+                "extra": len(self.extra),
+                "duplicate": len(self.duplicate),
+                "drift": len(self.drift),
+                "unkeyed": self.unkeyed
+            },
+            "missing": missing,
+            "extra": self.extra,
+            "duplicate": self.duplicate,
+            "drift": self.drift
+        }
+
+
+def snapshot_store(path):
+    """Save the store's catalogue as JSONL in path with a bulk query"""
+    from spUtilities import run_bulk_query, download_bulk_result
+
+    url = run_bulk_query(CATALOGUE_QUERY)
+    if not url:
+        # Nothing matched, so Shopify has no file to give us
+        open(path, 'w').close()
+        return path
+    return download_bulk_result(url, path)
+
+
+def log_report(report):
+    for kind in ('missing', 'extra', 'duplicate', 'drift'):
+        entries = report[kind]
+        for entry in entries[:LOG_LIMIT]:
+            logger.warning(f"⚠️ {kind.capitalize()} {entry['kind']}", extra=entry)
+        if len(entries) > LOG_LIMIT:
+            logger.warning(f"⚠️ ... and {len(entries) - LOG_LIMIT} more {kind}")
+
+    summary = report["summary"]
+    message = (f"{summary['products_matched']} products and {summary['variants_matched']} variants matched; "
+               f"{summary['missing']} missing, {summary['extra']} extra, {summary['duplicate']} duplicate, {summary['drift']} drifted")
+    if any(report[kind] for kind in ('missing', 'extra', 'duplicate', 'drift')):
+        logger.warning(f"⚠️ {message}", extra={"unkeyed": summary['unkeyed']})
+        if any(entry['kind'] == 'variant' for entry in report['drift']):
+            logger.info("💡 `cli.py sync` sets prices and stock from the export")
+    else:
+        logger.info(f"✅ {message}", extra={"unkeyed": summary['unkeyed']})
+
+
+def reconcile_store(csv_file=None, snapshot=None):
+    """
+    Compare the store with the export and write the discrepancies to
+    VERIFY_REPORT_FILE. snapshot reuses a saved catalogue instead of running
+    a bulk query. Returns 0 if they match.
+    """
+    from product_graph import ProductGraph
+    from utilities import read_export
+
+    config = get_config()
+    RUN_STATS.reset()
+
+    with RUN_STATS.stage('read_csv'):
+        df = read_export(csv_file or config.csv_file, columns=RECONCILE_COLUMNS)
+    with RUN_STATS.stage('product_graph'):
+        graph = ProductGraph(df)
+        products, variants, families = expected_catalogue(df, graph)
+
+    if not snapshot:
+        snapshot = config.store_snapshot_file
+        try:
+            with RUN_STATS.stage('bulk_query'):
+                snapshot_store(snapshot)
+        except RuntimeError as e:
+            logger.error(f"❌ {e}")
+            return 1
+    elif not os.path.exists(snapshot):
+        logger.error(f"❌ Snapshot {snapshot} does not exist")
+        return 1
+
+    reconciliation = Reconciliation(products, variants, families)
+    with RUN_STATS.stage('reconcile'):
+        with open(snapshot, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    reconciliation.add(json.loads(line))
+        reconciliation.check_variant_counts()
+
+    report = reconciliation.report()
+    log_report(report)
+    with open(config.verify_report_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"📝 Reconciliation written to {config.verify_report_file}", extra={"snapshot": snapshot})
+    return 1 if any(report[kind] for kind in ('missing', 'extra', 'duplicate', 'drift')) else 0
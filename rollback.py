@@ -0,0 +1,114 @@
+"""
+Taking what migrations created back out of the store (`cli.py rollback`).
+
+By default the newest run journal (see journal.py) is rolled back; specific
+journals or all of them can be given instead. With --by-metafield every
+product carrying a custom.woocommerce_sku metafield (on itself or one of its
+variants) is found with a bulk query and deleted too, journalled or not.
+
+Deletes go out from a thread pool through graphql(), so the concurrency
+controller keeps them inside the store's rate limit while using all of it.
+Products go first, then collections. Whatever couldn't be deleted stays in
+its journal for the next rollback; a journal that is fully rolled back is
+renamed to <name>.rolledback.
+"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from config import get_config
+from instrumentation import RUN_STATS
+from journal import journal_files, read_journal, rewrite_journal
+from log import get_logger
+from metrics import DELETED
+
+logger = get_logger('rollback')
+
+# Collections are deleted once the products in them are gone
+ORDER = ('product', 'collection')
+
+
+def migrated_products(snapshot):
+    """IDs of the products in a catalogue snapshot that have a woocommerce_sku, themselves or on a variant"""
+    ids = set()
+    with open(snapshot, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            node = json.loads(line)
+            if (node.get('metafield') or {}).get('value'):
+                ids.add(node.get('__parentId') or node['id'])
+    return ids
+
+
+def delete_all(targets, max_workers):
+    """Delete (kind, ID) targets concurrently, kind by kind; returns the ones that failed"""
+    from spUtilities import delete_from_store
+
+    failed = set()
+    for kind in ORDER:
+        ids = [object_id for target_kind, object_id in targets if target_kind == kind]
+        if not ids:
+            continue
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='rollback') as executor:
+            futures = {object_id: executor.submit(delete_from_store, kind, object_id) for object_id in ids}
+            for object_id, future in futures.items():
+                try:
+                    errors = future.result()
+                except Exception as e:
+                    logger.error(f"❌ Deleting {kind} failed: {e}", extra={"id": object_id})
+                    errors = [e]
+                if errors:
+                    failed.add((kind, object_id))
+                else:
+                    DELETED.inc(kind=kind)
+                RUN_STATS.advance()
+    return failed
+
+
+def rollback(journals=None, all_journals=False, by_metafield=False, dry_run=False):
+    """Delete what the chosen journals list (and with by_metafield, every migrated product); returns 1 if anything is left"""
+    from spUtilities import CONCURRENCY
+
+    config = get_config()
+    RUN_STATS.reset()
+    CONCURRENCY.reset(config.concurrency, config.max_concurrency)
+
+    if not journals:
+        journals = journal_files(config.journal_dir)
+        if not (all_journals or by_metafield):
+            journals = journals[-1:]
+    entries = {path: read_journal(path) for path in journals}
+    targets = dict.fromkeys((entry["kind"], entry["id"]) for path in journals for entry in entries[path])
+
+    if by_metafield:
+        from reconcile import snapshot_store
+        try:
+            with RUN_STATS.stage('bulk_query'):
+                snapshot_store(config.store_snapshot_file)
+        except RuntimeError as e:
+            logger.error(f"❌ {e}")
+            return 1
+        targets.update(dict.fromkeys(('product', product_id) for product_id in sorted(migrated_products(config.store_snapshot_file))))
+
+    counts = {kind: sum(1 for target_kind, _ in targets if target_kind == kind) for kind in ORDER}
+    if not targets:
+        logger.info("✅ Nothing to roll back", extra={"journals": journals})
+        return 0
+    logger.info(f"🗑️ {'Would delete' if dry_run else 'Deleting'} {counts['product']} products and {counts['collection']} collections",
+                extra={"journals": journals})
+    if dry_run:
+        return 0
+
+    RUN_STATS.set_total(len(targets), unit='deletions')
+    with RUN_STATS.stage('rollback'):
+        failed = delete_all(list(targets), config.max_concurrency)
+
+    for path in journals:
+        rewrite_journal(path, [entry for entry in entries[path] if (entry["kind"], entry["id"]) in failed])
+
+    if failed:
+        logger.warning(f"⚠️ {len(failed)} of {len(targets)} could not be deleted; they stay in their journals for the next rollback")
+    else:
+        logger.info(f"✅ Deleted {counts['product']} products and {counts['collection']} collections")
+    RUN_STATS.write_report(config.run_report_file, concurrency=CONCURRENCY.log_operating_point())
+    return 1 if failed else 0
@@ -0,0 +1,323 @@
+"""
+Sharded migration across several worker processes or machines.
+
+Every product is assigned, together with its variants, to one of a fixed
+number of shards by a hash of its SKU. Workers claim shards through a lease
+table in a shared SQLite file and keep their lease alive with a heartbeat
+while they work; a shard whose lease runs out (its worker crashed or lost
+the network) is handed to the next worker that asks. Re-running a shard is
+safe: products and their variants are looked up by SKU (parents exported
+without one through their variants' SKUs, variations without one by their
+option values) and updated, not created again.
+
+    python cli.py worker --shards 16 --lease-db /shared/shards.sqlite
+
+Start as many workers as the store's API limit allows; each stops once
+every shard is done.
+"""
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from config import get_config
+from failures import FAILURES
+from instrumentation import RUN_STATS
+from journal import JOURNAL
+from log import get_logger, log_context
+
+logger = get_logger('shards')
+
+# A shard that fails this many times is left for someone to look at
+MAX_ATTEMPTS = 3
+
+
+def shard_of(key, shard_count):
+    """Stable shard number for a product key (the same in every process, unlike hash())"""
+    return zlib.crc32(key.encode('utf-8')) % shard_count
+
+
+def product_keys(df):
+    """
+    The key each row is sharded by: its own SKU for parents and simple
+    products, its parent's SKU for variations. Parents are referenced by SKU
+    or as id:<ID>; the latter are mapped to the parent's SKU so a family
+    always lands in one shard.
+    """
+    ids = df['ID'].str.strip()
+    skus = df['SKU'].str.strip()
+    own_keys = skus.where(skus != '', 'id:' + ids)
+    key_by_id = dict(zip('id:' + ids, own_keys))
+
+    def key(row):
+        if row['Type'].strip().lower() == 'variation' and row['Parent'].strip():
+            parent = row['Parent'].strip()
+            return key_by_id.get(parent, parent)
+        return own_keys[row.name]
+
+    return df.apply(key, axis=1)
+
+
+def split_shards(df, shard_count):
+    """{shard number: rows of the export in that shard}, keeping the export's order"""
+    shard_numbers = product_keys(df).map(lambda key: shard_of(key, shard_count))
+    return {shard: rows for shard, rows in df.groupby(shard_numbers, sort=True)}
+
+
+def export_identity(csv_file):
+    """Enough to tell whether two workers are reading the same export"""
+    stat = os.stat(csv_file)
+    return f"{os.path.basename(csv_file)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+
+class LeaseTable:
+    """
+    Shard leases in a SQLite file shared by all workers.
+
+    Each call opens its own connection, so the heartbeat thread and the
+    worker never share one. Claims run in an IMMEDIATE transaction so two
+    workers can't take the same shard.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS shards (
+                    shard INTEGER PRIMARY KEY,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    products INTEGER,
+                    error TEXT
+                )
+            """)
+
+    @contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def transaction(self):
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def setup(self, shard_count, export):
+        """
+        Create the shards on first use. Every worker must agree on the shard
+        count and export, otherwise products would move between shards.
+        """
+        with self.transaction() as db:
+            meta = dict(db.execute("SELECT key, value FROM meta"))
+            if not meta:
+                db.executemany("INSERT INTO meta (key, value) VALUES (?, ?)",
+                               [("shard_count", str(shard_count)), ("export", export)])
+                db.executemany("INSERT INTO shards (shard) VALUES (?)", [(shard,) for shard in range(shard_count)])
+                return
+            if meta.get("shard_count") != str(shard_count) or meta.get("export") != export:
+                raise ValueError(
+                    f"{self.path} was set up for {meta.get('shard_count')} shards of {meta.get('export')}, "
+                    f"not {shard_count} shards of {export}; use a new lease file for a new run"
+                )
+
+    def claim(self, worker, lease_seconds):
+        """Lease the next pending or expired shard to worker, or return None"""
+        now = time.time()
+        with self.transaction() as db:
+            row = db.execute("""
+                SELECT shard, status, worker FROM shards
+                WHERE attempts < ? AND (status = 'pending' OR (status = 'leased' AND expires < ?))
+                ORDER BY attempts, shard LIMIT 1
+            """, (MAX_ATTEMPTS, now)).fetchone()
+            if row is None:
+                return None
+            shard, status, previous_worker = row
+            db.execute("UPDATE shards SET status = 'leased', worker = ?, expires = ?, attempts = attempts + 1 WHERE shard = ?",
+                       (worker, now + lease_seconds, shard))
+
+        if status == 'leased':
+            logger.warning(f"♻️ Reclaiming shard {shard} from {previous_worker}, its lease expired")
+        return shard
+
+    def renew(self, shard, worker, lease_seconds):
+        """Extend a lease; False if worker no longer holds it"""
+        with self.connect() as db:
+            cursor = db.execute("UPDATE shards SET expires = ? WHERE shard = ? AND worker = ? AND status = 'leased'",
+                                (time.time() + lease_seconds, shard, worker))
+            return cursor.rowcount == 1
+
+    def complete(self, shard, worker, products):
+        with self.connect() as db:
+            cursor = db.execute("UPDATE shards SET status = 'done', expires = NULL, products = ?, error = NULL "
+                                "WHERE shard = ? AND worker = ? AND status = 'leased'", (products, shard, worker))
+            return cursor.rowcount == 1
+
+    def release(self, shard, worker, error=None):
+        """Give a shard back so another worker (or this one) can retry it"""
+        with self.connect() as db:
+            db.execute("UPDATE shards SET status = 'pending', worker = NULL, expires = NULL, error = ? "
+                       "WHERE shard = ? AND worker = ? AND status = 'leased'", (error, shard, worker))
+
+    def status(self):
+        """Counts of done, leased, pending and given-up shards, plus when the next lease runs out"""
+        now = time.time()
+        counts = {"done": 0, "leased": 0, "pending": 0, "failed": 0}
+        next_expiry = None
+        for shard, status, worker, expires, attempts, products, error in self.shards():
+            if status != 'done' and attempts >= MAX_ATTEMPTS and (status == 'pending' or expires < now):
+                status = 'failed'
+            elif status == 'leased':
+                next_expiry = expires if next_expiry is None else min(next_expiry, expires)
+            counts[status] += 1
+        return counts, next_expiry
+
+    def shards(self):
+        with self.connect() as db:
+            return db.execute("SELECT shard, status, worker, expires, attempts, products, error FROM shards ORDER BY shard").fetchall()
+
+
+class Heartbeat:
+    """Renews a lease in the background; sets lost if another worker has taken the shard"""
+
+    def __init__(self, table, shard, worker, lease_seconds):
+        self.table = table
+        self.shard = shard
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f"heartbeat-{shard}", daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            try:
+                renewed = self.table.renew(self.shard, self.worker, self.lease_seconds)
+            except sqlite3.Error as e:
+                # Keep trying; the lease only lapses if this goes on for a whole lease
+                logger.warning(f"⚠️ Heartbeat for shard {self.shard} failed: {e}")
+                continue
+            if not renewed:
+                logger.error(f"❌ Lost the lease on shard {self.shard}, stopping it")
+                self.lost.set()
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        return False
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def run_worker(csv_file=None, worker_id=None):
+    """Claim and migrate shards until none are left; returns 1 if any shard failed"""
+    from images import close_pipeline
+    from metafields import METAFIELDS
+    from migrate import start_run, migrate_rows, count_products, preflight_export
+    from product_graph import ProductGraph
+    from spUtilities import VariantScheduler, CONCURRENCY
+    from utilities import read_export
+
+    config = get_config()
+    csv_file = csv_file or config.csv_file
+    worker_id = worker_id or default_worker_id()
+
+    table = LeaseTable(config.lease_db_file)
+    table.setup(config.shard_count, export_identity(csv_file))
+
+    if not start_run():
+        return 1
+    # Workers can't share one failure file; `cli.py retry` merges them
+    root, ext = os.path.splitext(config.failure_index_file)
+    FAILURES.open(f"{root}.{worker_id}{ext}")
+    JOURNAL.open(config.journal_dir, f"{time.strftime('%Y%m%d-%H%M%S')}.{worker_id}")
+
+    with RUN_STATS.stage('read_csv'):
+        df = read_export(csv_file)
+    # Every worker checks the whole export, so they all leave out the same rows
+    df, _, _ = preflight_export(df, ProductGraph(df))
+    shards = split_shards(df, config.shard_count)
+    logger.info(f"👷 Worker {worker_id} joining {config.shard_count} shards in {config.lease_db_file}")
+
+    failed = 0
+    while True:
+        shard = table.claim(worker_id, config.lease_seconds)
+        if shard is None:
+            counts, next_expiry = table.status()
+            if not counts["leased"]:
+                break
+            # Others are still working; wait in case one of them dies and its shard frees up
+            RUN_STATS.sleep(max(1.0, min(config.lease_seconds / 3, next_expiry - time.time())), reason='lease')
+            continue
+
+        df = shards.get(shard)
+        products = count_products(df) if df is not None else 0
+        RUN_STATS.set_total(RUN_STATS.total + products)
+
+        with log_context(shard=shard, worker=worker_id):
+            logger.info(f"📦 Shard {shard}: {products} products")
+            try:
+                with Heartbeat(table, shard, worker_id, config.lease_seconds) as heartbeat:
+                    finished = True
+                    if df is not None:
+                        with VariantScheduler(max_workers=config.variant_workers) as variant_scheduler:
+                            finished = migrate_rows(df, variant_scheduler, stop=heartbeat.lost)
+                        # Written before the shard counts as done
+                        METAFIELDS.flush()
+            except Exception as e:
+                logger.exception(f"❌ Shard {shard} failed, releasing it for a retry")
+                table.release(shard, worker_id, error=f"{type(e).__name__}: {e}")
+                failed += 1
+                continue
+
+            if finished and table.complete(shard, worker_id, products):
+                logger.info(f"✅ Shard {shard} done")
+
+    counts, _ = table.status()
+    logger.info(f"🏁 No shards left for {worker_id}", extra=counts)
+    close_pipeline()
+    METAFIELDS.close()
+    JOURNAL.close()
+    FAILURES.save()
+    root, ext = os.path.splitext(config.run_report_file)
+    RUN_STATS.write_report(f"{root}.{worker_id}{ext}", concurrency=CONCURRENCY.log_operating_point())
+    return 1 if failed or counts["failed"] else 0
+
+
+def show_status():
+    """Log the state of every shard in the lease table"""
+    table = LeaseTable(get_config().lease_db_file)
+    now = time.time()
+    for shard, status, worker, expires, attempts, products, error in table.shards():
+        if status == 'leased':
+            status = f"leased by {worker} ({int(expires - now)}s left)" if expires > now else f"expired ({worker})"
+        line = f"shard {shard:>3}: {status}, {attempts} attempts"
+        if products is not None:
+            line += f", {products} products"
+        if error:
+            line += f", last error {error}"
+        logger.info(line)
+    counts, _ = table.status()
+    logger.info("Shards: " + ", ".join(f"{count} {status}" for status, count in counts.items()))
+    return 0
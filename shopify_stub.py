@@ -0,0 +1,594 @@
+"""
+A local stand-in for the Shopify Admin API.
+
+Serves just enough of the GraphQL and REST endpoints used by spUtilities for
+the benchmarks to run a migration end to end without touching a real store.
+Query cost and the leaky bucket are modelled so throttling behaves roughly like
+the real thing.
+"""
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Shopify's standard plan bucket
+BUCKET_SIZE = 2000
+RESTORE_RATE = 100
+
+LOCATION_ID = 'gid://shopify/Location/1'
+
+
+class ShopifyStub:
+    """In-memory store state plus the HTTP server that exposes it"""
+
+    def __init__(self, latency=0.0, query_cost=10, bucket_size=BUCKET_SIZE, restore_rate=RESTORE_RATE):
+        self.latency = latency
+        self.query_cost = query_cost
+        self.bucket_size = bucket_size
+        self.restore_rate = restore_rate
+        self.available = float(bucket_size)
+        self.last_refill = time.monotonic()
+        self.lock = threading.RLock()
+        self.next_id = 1000
+        self.products = {}
+        self.collections = {}
+        self.inventory = {}
+        # (owner type, namespace, key) of the metafield definitions, and metafields by (owner ID, namespace, key)
+        self.metafield_definitions = set()
+        self.metafields = {}
+        # Served at /images/<name>, standing in for the WooCommerce media host
+        self.images = {}
+        self.image_requests = 0
+        self.staged_uploads = {}
+        self.media_sources = []
+        # The current bulk operation and the JSONL results served at /bulk/<id>.jsonl
+        self.bulk_operation = None
+        self.bulk_results = {}
+        self.request_count = 0
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def store(self):
+        host, port = self.server.server_address[:2]
+        return f"{host}:{port}"
+
+    def start(self):
+        stub = self
+
+        class Handler(StubRequestHandler):
+            pass
+        Handler.stub = stub
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def new_id(self, kind):
+        with self.lock:
+            self.next_id += 1
+            return f"gid://shopify/{kind}/{self.next_id}"
+
+    def new_variant(self, product_id, sku, price, quantity, metafields=None, options=None):
+        variant_sku = ''
+        for metafield in metafields or []:
+            if metafield.get('key') == 'woocommerce_sku':
+                variant_sku = metafield.get('value', '')
+        variant = {
+            "id": self.new_id('ProductVariant'),
+            "product_id": product_id,
+            "sku": sku,
+            "woocommerce_sku": variant_sku,
+            "price": price,
+            "compareAtPrice": None,
+            "inventory_item_id": self.new_id('InventoryItem'),
+            "quantity": quantity,
+            "options": options or []
+        }
+        self.inventory[variant["inventory_item_id"]] = variant
+        return variant
+
+    def all_variants(self):
+        with self.lock:
+            return [variant for product in self.products.values() for variant in product['variants']]
+
+    def spend(self, cost):
+        """Take cost from the bucket, returning the throttle status (None if throttled)"""
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.bucket_size, self.available + (now - self.last_refill) * self.restore_rate)
+            self.last_refill = now
+            self.request_count += 1
+            throttled = self.available < cost
+            if not throttled:
+                self.available -= cost
+            status = {
+                "maximumAvailable": float(self.bucket_size),
+                "currentlyAvailable": int(self.available),
+                "restoreRate": float(self.restore_rate)
+            }
+        return status, throttled
+
+    def graphql(self, body):
+        query = body.get('query', '')
+        variables = body.get('variables') or {}
+
+        status, throttled = self.spend(self.query_cost)
+        cost = {
+            "requestedQueryCost": self.query_cost,
+            "actualQueryCost": None if throttled else self.query_cost,
+            "throttleStatus": status
+        }
+        if throttled:
+            return {
+                "errors": [{"message": "Throttled", "extensions": {"code": "THROTTLED"}}],
+                "extensions": {"cost": cost}
+            }
+
+        data = {}
+        for marker, handler in GRAPHQL_HANDLERS:
+            if marker in query:
+                data = handler(self, variables)
+                break
+
+        return {"data": data, "extensions": {"cost": cost}}
+
+    # GraphQL handlers
+
+    def product_create(self, variables):
+        product_input = variables.get('input', {})
+        with self.lock:
+            self.media_sources.extend(item.get('originalSource') for item in variables.get('media') or [])
+        product_id = self.new_id('Product')
+        sku = ''
+        for metafield in product_input.get('metafields') or []:
+            if metafield.get('key') == 'woocommerce_sku':
+                sku = metafield.get('value', '')
+        # Like Shopify, every product starts with a default variant (without a SKU)
+        with self.lock:
+            self.products[product_id] = {
+                "id": product_id,
+                "title": product_input.get('title', ''),
+                "status": product_input.get('status', 'ACTIVE'),
+                "sku": sku,
+                "variants": [self.new_variant(product_id, '', '0.00', 0)]
+            }
+        return {
+            "productCreate": {
+                "product": {
+                    "id": product_id,
+                    "title": product_input.get('title', ''),
+                    "variants": {"edges": [{"node": {
+                        "id": self.products[product_id]["variants"][0]["id"],
+                        "title": "Default Title",
+                        "inventoryItem": {"id": self.products[product_id]["variants"][0]["inventory_item_id"]}
+                    }}]},
+                    "options": []
+                },
+                "userErrors": []
+            }
+        }
+
+    def product_update(self, variables):
+        product_input = variables.get('input', {})
+        product = self.products.get(product_input.get('id'))
+        if product is None:
+            return {"productUpdate": {"product": None, "userErrors": [{"field": ["id"], "message": "Product does not exist"}]}}
+        with self.lock:
+            product.update({key: product_input[key] for key in ('title', 'status') if product_input.get(key) is not None})
+        return {
+            "productUpdate": {
+                "product": {
+                    "id": product['id'],
+                    "title": product['title'],
+                    "variants": {"edges": [{"node": {"id": variant['id']}} for variant in product['variants'][:1]]}
+                },
+                "userErrors": []
+            }
+        }
+
+    def variants_bulk_create(self, variables):
+        product = self.products.get(variables.get('productId'))
+        if product is None:
+            return {
+                "productVariantsBulkCreate": {
+                    "productVariants": [],
+                    "userErrors": [{"field": ["productId"], "message": "Product does not exist"}]
+                }
+            }
+
+        created = []
+        stored_variants = []
+        for variant in variables.get('variants', []):
+            stored = self.new_variant(
+                product['id'],
+                variant.get('inventoryItem', {}).get('sku', ''),
+                variant.get('price'),
+                variant.get('inventoryQuantities', {}).get('availableQuantity', 0),
+                variant.get('metafields'),
+                [{"name": value.get('optionName'), "value": value.get('name')} for value in variant.get('optionValues', [])]
+            )
+            stored_variants.append(stored)
+            created.append({
+                "id": stored['id'],
+                "title": '',
+                "sku": stored['sku'],
+                "price": stored['price'],
+                "inventoryQuantity": stored['quantity'],
+                "inventoryItem": {"id": stored['inventory_item_id']},
+                "selectedOptions": stored['options']
+            })
+        with self.lock:
+            if variables.get('strategy') == 'REMOVE_STANDALONE_VARIANT' and len(product['variants']) == 1:
+                product['variants'] = []
+            product['variants'].extend(stored_variants)
+        return {"productVariantsBulkCreate": {"productVariants": created, "userErrors": []}}
+
+    def variants_bulk_update(self, variables):
+        product = self.products.get(variables.get('productId'))
+        if product is None:
+            return {"productVariantsBulkUpdate": {"productVariants": [], "userErrors": [{"field": ["productId"], "message": "Product does not exist"}]}}
+        by_id = {variant['id']: variant for variant in product['variants']}
+        updated = []
+        errors = []
+        with self.lock:
+            for change in variables.get('variants', []):
+                variant = by_id.get(change.get('id'))
+                if variant is None:
+                    errors.append({"field": ["variants", "id"], "message": "Variant does not exist"})
+                    continue
+                for key in ('price', 'compareAtPrice'):
+                    if key in change:
+                        variant[key] = change[key]
+                updated.append({"id": variant['id'], "price": variant['price'], "compareAtPrice": variant['compareAtPrice']})
+        return {"productVariantsBulkUpdate": {"productVariants": updated, "userErrors": errors}}
+
+    def inventory_set_quantities(self, variables):
+        changes = []
+        errors = []
+        with self.lock:
+            for quantity in variables.get('input', {}).get('quantities', []):
+                variant = self.inventory.get(quantity.get('inventoryItemId'))
+                if variant is None:
+                    errors.append({"field": ["input", "quantities"], "message": "Inventory item does not exist"})
+                    continue
+                changes.append({"delta": quantity['quantity'] - variant['quantity']})
+                variant['quantity'] = quantity['quantity']
+        return {"inventorySetQuantities": {"inventoryAdjustmentGroup": {"changes": changes}, "userErrors": errors}}
+
+    def product_variants(self, variables):
+        variants = self.all_variants()
+        start = int(variables.get('cursor') or 0)
+        page = variants[start:start + 250]
+        end = start + len(page)
+        edges = []
+        for variant in page:
+            product = self.products[variant['product_id']]
+            edges.append({"node": {
+                "id": variant['id'],
+                "sku": variant['sku'],
+                "price": variant['price'],
+                "compareAtPrice": variant['compareAtPrice'],
+                "inventoryQuantity": variant['quantity'],
+                "metafield": {"value": variant['woocommerce_sku']} if variant['woocommerce_sku'] else None,
+                "inventoryItem": {"id": variant['inventory_item_id']},
+                "product": {
+                    "id": product['id'],
+                    "metafield": {"value": product['sku']} if product['sku'] else None
+                }
+            }})
+        return {"productVariants": {"edges": edges, "pageInfo": {"hasNextPage": end < len(variants), "endCursor": str(end)}}}
+
+    def existing_variants(self, variables):
+        product = self.products.get(variables.get('id'))
+        if product is None:
+            return {"product": None}
+        with self.lock:
+            variants = list(product['variants'])
+        start = int(variables.get('cursor') or 0)
+        page = variants[start:start + variables.get('first', 250)]
+        end = start + len(page)
+        edges = [{"node": {
+            "id": variant['id'],
+            "sku": variant['sku'],
+            "price": variant['price'],
+            "compareAtPrice": variant['compareAtPrice'],
+            "selectedOptions": variant['options'],
+            "metafield": {"value": variant['woocommerce_sku']} if variant['woocommerce_sku'] else None,
+            "inventoryItem": {"id": variant['inventory_item_id']}
+        }} for variant in page]
+        return {"product": {"variants": {"edges": edges, "pageInfo": {"hasNextPage": end < len(variants), "endCursor": str(end)}}}}
+
+    def products_query(self, variables):
+        match = re.match(r'sku:(.*)', variables.get('sku', ''))
+        sku = match.group(1) if match else None
+        edges = []
+        with self.lock:
+            for product in self.products.values():
+                # Like Shopify's sku: search, match the product's variants too
+                if sku and (product['sku'] == sku or any(variant['sku'] == sku for variant in product['variants'])):
+                    edges.append({"node": {"id": product['id'], "variants": {"edges": []}}})
+                    break
+        return {"products": {"edges": edges}}
+
+    def bulk_run_query(self, variables):
+        """
+        Snapshot the catalogue the way reconcile.CATALOGUE_QUERY asks for it
+        (whatever the query): products, then each one's variants with a
+        __parentId, one JSON object per line. The operation reports RUNNING
+        on the first poll and COMPLETED on the next.
+        """
+        operation_id = self.new_id('BulkOperation')
+        lines = []
+        with self.lock:
+            for product in self.products.values():
+                lines.append({
+                    "id": product['id'],
+                    "title": product['title'],
+                    "status": product.get('status', 'ACTIVE'),
+                    "metafield": {"value": product['sku']} if product['sku'] else None
+                })
+                for variant in product['variants']:
+                    lines.append({
+                        "id": variant['id'],
+                        "sku": variant['sku'],
+                        "price": variant['price'],
+                        "compareAtPrice": variant['compareAtPrice'],
+                        "inventoryQuantity": variant['quantity'],
+                        "metafield": {"value": variant['woocommerce_sku']} if variant['woocommerce_sku'] else None,
+                        "__parentId": product['id']
+                    })
+            self.bulk_results[operation_id.rsplit('/', 1)[-1]] = ''.join(json.dumps(line) + '\n' for line in lines).encode('utf-8')
+            self.bulk_operation = {
+                "id": operation_id,
+                "status": "CREATED",
+                "errorCode": None,
+                "objectCount": str(len(lines)),
+                "url": None
+            }
+        return {"bulkOperationRunQuery": {"bulkOperation": {"id": operation_id, "status": "CREATED"}, "userErrors": []}}
+
+    def current_bulk_operation(self, variables):
+        with self.lock:
+            operation = self.bulk_operation
+            if operation is None:
+                return {"currentBulkOperation": None}
+            if operation['status'] == 'CREATED':
+                operation['status'] = 'RUNNING'
+            elif operation['status'] == 'RUNNING':
+                operation['status'] = 'COMPLETED'
+                operation['url'] = f"{self.url}/bulk/{operation['id'].rsplit('/', 1)[-1]}.jsonl"
+            return {"currentBulkOperation": dict(operation)}
+
+    def product_delete(self, variables):
+        product_id = variables.get('input', {}).get('id')
+        with self.lock:
+            product = self.products.pop(product_id, None)
+            for variant in (product or {}).get('variants', []):
+                self.inventory.pop(variant['inventory_item_id'], None)
+        if product is None:
+            return {"productDelete": {"deletedProductId": None, "userErrors": [{"field": ["id"], "message": "Product does not exist"}]}}
+        return {"productDelete": {"deletedProductId": product_id, "userErrors": []}}
+
+    def collection_delete(self, variables):
+        collection_id = variables.get('input', {}).get('id')
+        with self.lock:
+            title = self.collections.pop(collection_id, None)
+        if title is None:
+            return {"collectionDelete": {"deletedCollectionId": None, "userErrors": [{"field": ["id"], "message": "Collection does not exist"}]}}
+        return {"collectionDelete": {"deletedCollectionId": collection_id, "userErrors": []}}
+
+    def metafield_definitions_query(self, variables):
+        owner_type, namespace = variables.get('ownerType'), variables.get('namespace')
+        with self.lock:
+            keys = sorted(key for owner, space, key in self.metafield_definitions if owner == owner_type and space == namespace)
+        return {"metafieldDefinitions": {"edges": [{"node": {"key": key}} for key in keys]}}
+
+    def metafield_definition_create(self, variables):
+        definition = variables.get('definition', {})
+        identity = (definition.get('ownerType'), definition.get('namespace'), definition.get('key'))
+        with self.lock:
+            taken = identity in self.metafield_definitions
+            self.metafield_definitions.add(identity)
+        if taken:
+            errors = [{"field": ["definition", "key"], "message": "Key is in use for Product metafields on the 'custom' namespace.", "code": "TAKEN"}]
+            return {"metafieldDefinitionCreate": {"createdDefinition": None, "userErrors": errors}}
+        definition_id = self.new_id('MetafieldDefinition')
+        return {"metafieldDefinitionCreate": {"createdDefinition": {"id": definition_id, "key": identity[2]}, "userErrors": []}}
+
+    def metafields_set(self, variables):
+        """Like Shopify, all or nothing; more than 25 or an unknown owner rejects the whole call"""
+        metafields = variables.get('metafields') or []
+        if len(metafields) > 25:
+            errors = [{"field": ["metafields"], "message": "Exceeded the maximum metafields input limit of 25.", "code": "LESS_THAN_OR_EQUAL_TO"}]
+            return {"metafieldsSet": {"metafields": [], "userErrors": errors}}
+        with self.lock:
+            owners = set(self.products) | {variant["id"] for product in self.products.values() for variant in product['variants']}
+            errors = [
+                {"field": ["metafields", str(position), "ownerId"], "message": "Owner does not exist.", "code": "INVALID"}
+                for position, metafield in enumerate(metafields)
+                if metafield.get('ownerId') not in owners
+            ]
+            if errors:
+                return {"metafieldsSet": {"metafields": [], "userErrors": errors}}
+            written = []
+            for metafield in metafields:
+                self.metafields[(metafield['ownerId'], metafield.get('namespace'), metafield.get('key'))] = metafield.get('value')
+                if metafield.get('key') == 'woocommerce_sku':
+                    self.products[metafield['ownerId']]['sku'] = metafield.get('value', '')
+                written.append({"id": self.new_id('Metafield'), "key": metafield.get('key')})
+        return {"metafieldsSet": {"metafields": written, "userErrors": []}}
+
+    def locations(self, variables):
+        return {"locations": {"edges": [{"node": {"id": LOCATION_ID, "name": "Stub warehouse"}}]}}
+
+    def publications(self, variables):
+        return {"publications": {"edges": [{"node": {"id": "gid://shopify/Publication/1", "name": "Online Store"}}]}}
+
+    def publishable_publish(self, variables):
+        if variables.get('id') not in self.products:
+            return {"publishablePublish": {"userErrors": [{"field": ["id"], "message": "Product does not exist"}]}}
+        return {"publishablePublish": {"userErrors": []}}
+
+    def collection_create(self, variables):
+        collection_id = self.new_id('Collection')
+        with self.lock:
+            self.collections[collection_id] = variables.get('input', {}).get('title')
+        return {"collectionCreate": {"collection": {"id": collection_id, "title": self.collections[collection_id]}, "userErrors": []}}
+
+    def staged_uploads_create(self, variables):
+        targets = []
+        for upload in variables.get('input', []):
+            upload_id = self.new_id('StagedUpload').rsplit('/', 1)[-1]
+            targets.append({
+                "url": f"{self.url}/staged-uploads/{upload_id}",
+                "resourceUrl": f"{self.url}/staged-uploads/{upload_id}/{upload.get('filename')}",
+                "parameters": [{"name": "key", "value": f"tmp/{upload_id}/{upload.get('filename')}"}]
+            })
+        return {"stagedUploadsCreate": {"stagedTargets": targets, "userErrors": []}}
+
+    def create_media(self, variables):
+        with self.lock:
+            self.media_sources.extend(item.get('originalSource') for item in variables.get('media', []))
+        media = [
+            {"alt": item.get('alt'), "status": "UPLOADED", "mediaContentType": "IMAGE"}
+            for item in variables.get('media', [])
+        ]
+        return {"productCreateMedia": {"media": media, "mediaUserErrors": []}}
+
+    def product_images(self, variables):
+        return {"product": {"images": {"edges": []}}}
+
+    def inventory_adjust(self, variables):
+        return {"inventoryAdjustQuantity": {"inventoryLevel": {"id": self.new_id('InventoryLevel'), "available": 0}, "userErrors": []}}
+
+
+# Checked in order against the query text, so more specific markers go first
+GRAPHQL_HANDLERS = [
+    # The bulk query embeds a whole products query, so it has to be matched first
+    ('bulkOperationRunQuery', ShopifyStub.bulk_run_query),
+    ('currentBulkOperation', ShopifyStub.current_bulk_operation),
+    ('productDelete', ShopifyStub.product_delete),
+    ('collectionDelete', ShopifyStub.collection_delete),
+    ('productVariantsBulkCreate', ShopifyStub.variants_bulk_create),
+    ('productVariantsBulkUpdate', ShopifyStub.variants_bulk_update),
+    ('inventorySetQuantities', ShopifyStub.inventory_set_quantities),
+    ('metafieldDefinitionCreate', ShopifyStub.metafield_definition_create),
+    ('metafieldDefinitions(', ShopifyStub.metafield_definitions_query),
+    ('metafieldsSet', ShopifyStub.metafields_set),
+    ('productVariants(', ShopifyStub.product_variants),
+    ('existingVariants', ShopifyStub.existing_variants),
+    ('stagedUploadsCreate', ShopifyStub.staged_uploads_create),
+    ('productCreateMedia', ShopifyStub.create_media),
+    ('productCreate', ShopifyStub.product_create),
+    ('productUpdate', ShopifyStub.product_update),
+    ('collectionCreate', ShopifyStub.collection_create),
+    ('publishablePublish', ShopifyStub.publishable_publish),
+    ('inventoryAdjustQuantity', ShopifyStub.inventory_adjust),
+    ('locations(', ShopifyStub.locations),
+    ('publications(', ShopifyStub.publications),
+    ('products(', ShopifyStub.products_query),
+    ('product(id:', ShopifyStub.product_images),
+]
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    stub = None
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, each response waits on a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.stub.latency:
+            time.sleep(self.stub.latency)
+        if self.path.startswith('/bulk/'):
+            data = self.stub.bulk_results.get(self.path[len('/bulk/'):].split('.', 1)[0])
+            if data is None:
+                self.send_json({}, status=404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/jsonl')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        name = self.path.split('/images/', 1)[-1]
+        data = self.stub.images.get(name) if self.path.startswith('/images/') else None
+        if data is None:
+            self.send_json({}, status=404)
+            return
+        with self.stub.lock:
+            self.stub.image_requests += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path.startswith('/staged-uploads/'):
+            # Multipart form from the staged upload; keep the raw body
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            with self.stub.lock:
+                self.stub.staged_uploads[self.path] = len(data)
+            self.send_response(201)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = self.read_body()
+        if self.stub.latency:
+            time.sleep(self.stub.latency)
+        if self.path.endswith('/graphql.json'):
+            self.send_json(self.stub.graphql(body))
+        else:
+            self.send_json({}, status=404)
+
+    def do_PUT(self):
+        self.read_body()
+        if self.stub.latency:
+            time.sleep(self.stub.latency)
+        self.send_json({})
+
+    def do_DELETE(self):
+        if self.stub.latency:
+            time.sleep(self.stub.latency)
+        self.send_json({})
@@ -0,0 +1,114 @@
+"""
+A local index of the store's variants by WooCommerce SKU.
+"""
+import json
+import os
+import threading
+import time
+
+from log import get_logger
+
+logger = get_logger('sku_index')
+
+
+class SkuIndex:
+    """
+    WooCommerce SKU -> product/variant/inventory item IDs (and current prices).
+
+    Built from one paginated pass over the store's variants and cached in a
+    JSON file, so lookups during a run don't cost a query each.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.built = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, sku):
+        return sku in self.entries
+
+    def get(self, sku):
+        return self.entries.get(sku)
+
+    def add(self, sku, product_id, variant_id=None, inventory_item_id=None, price=None, compare_at_price=None):
+        """Record an ID we learned during a run (e.g. a product we just created)"""
+        with self.lock:
+            self.entries[sku] = {
+                "product_id": product_id,
+                "variant_id": variant_id,
+                "inventory_item_id": inventory_item_id,
+                "price": price,
+                "compare_at_price": compare_at_price
+            }
+
+    def load(self):
+        """Load the cached index, returning False if there isn't one"""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            data = json.load(f)
+        self.entries = data.get("entries", {})
+        self.built = data.get("built")
+        logger.info(f"📇 Loaded {len(self.entries)} SKUs from {self.path}", extra={"built": self.built})
+        return True
+
+    def save(self):
+        with self.lock:
+            data = {"built": self.built, "entries": self.entries}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def refresh(self):
+        """
+        Rebuild the index from the store and cache it. Raises RuntimeError if
+        a page of variants can't be fetched, keeping the previous index.
+        """
+        from spUtilities import fetch_variant_pages
+
+        entries = {}
+        for page in fetch_variant_pages():
+            for node in page:
+                sku = variant_sku(node)
+                if not sku:
+                    continue
+                entries[sku] = {
+                    "product_id": node["product"]["id"],
+                    "variant_id": node["id"],
+                    "inventory_item_id": (node.get("inventoryItem") or {}).get("id"),
+                    "price": node.get("price"),
+                    "compare_at_price": node.get("compareAtPrice")
+                }
+
+        with self.lock:
+            self.entries = entries
+            self.built = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.save()
+        logger.info(f"📇 Indexed {len(entries)} SKUs from the store")
+        return self
+
+    def ensure(self, refresh=False):
+        """Use the cached index, building it first if there isn't one (or refresh is set)"""
+        if refresh or not self.load():
+            self.refresh()
+        return self
+
+
+def variant_sku(node):
+    """
+    The WooCommerce SKU of a variant: its woocommerce_sku metafield, its own
+    SKU, or for a product's default variant the product's woocommerce_sku.
+    """
+    for value in (
+        (node.get("metafield") or {}).get("value"),
+        node.get("sku"),
+        ((node.get("product") or {}).get("metafield") or {}).get("value")
+    ):
+        if value:
+            return value
+    return None
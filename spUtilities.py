@@ -1,9 +1,285 @@
 
-from vars import *
-from secrets import *
+from config import get_config, STORE, StoreLocal
 from utilities import log_image_error, parse_images
-import json
+import contextvars
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from instrumentation import RUN_STATS, timed, profiled
+from log import get_logger, log_payload, current_context
+from failures import FAILURES
+from images import image_sources
+from journal import JOURNAL
+from cassette import new_session
+from metrics import REGISTRY, PRODUCTS, VARIANTS, MEDIA, REQUEST_SECONDS, QUERY_COST, THROTTLED, VARIANT_QUEUE
+
+logger = get_logger('shopify')
+
+# How many times to wait out a THROTTLED response before giving up
+MAX_THROTTLE_RETRIES = 5
+
+@lru_cache(maxsize=None)
+def operation_name(query):
+    """Name a GraphQL document by its operation name, or its first field for anonymous queries"""
+    match = re.search(r'\b(?:query|mutation)\s+(\w+)', query)
+    if not match:
+        match = re.search(r'{\s*(\w+)', query)
+    return match.group(1) if match else 'unknown'
+
+def is_throttled(result):
+    return any(
+        (error.get('extensions') or {}).get('code') == 'THROTTLED'
+        for error in result.get('errors') or []
+    )
+
+def throttle_delay(cost):
+    """Seconds until the bucket has refilled enough to cover the requested cost"""
+    if not cost:
+        return 1.0
+    status = cost.get('throttleStatus') or {}
+    restore_rate = status.get('restoreRate') or 50
+    shortfall = (cost.get('requestedQueryCost') or 0) - (status.get('currentlyAvailable') or 0)
+    return max(shortfall / restore_rate, 0.1)
+
+# Concurrency tuning: a throttled response halves the limit and slow responses trim it;
+# otherwise it grows by about one request per round of responses, unless the bucket is
+# nearly empty (then the bucket, not concurrency, is what limits the run)
+THROTTLED_DECREASE = 0.5
+SLOW_DECREASE = 0.9
+LOW_BUCKET = 0.2
+SLOW_LATENCY_FACTOR = 2.0
+SLOW_LATENCY_SLACK = 0.1
+
+
+class ConcurrencyController:
+    """
+    Caps how many requests to Shopify are in flight at once (GraphQL, and the
+    REST and staged upload calls) and tunes the cap while the run goes (additive increase, multiplicative decrease) from
+    each response's latency, throttling and leaky bucket headroom.
+
+    Every thread that talks to the API (the main loop, variant and image
+    workers) takes a slot for the duration of a request, so the cap holds
+    across all of them. Only requests sent after the last decrease can
+    cause another, so a burst of throttled responses from one overload
+    counts once.
+
+    The controller also keeps its own estimate of the bucket (refilled at
+    the restore rate, less the cost of requests in flight) and holds a
+    request back until it would be affordable, which avoids most throttled
+    responses once concurrency is down to what the bucket sustains.
+    """
+
+    def __init__(self, initial=2, maximum=8):
+        self.condition = threading.Condition()
+        self.reset(initial, maximum)
+
+    def reset(self, initial, maximum):
+        with self.condition:
+            self.maximum = max(1, maximum)
+            self.limit = float(min(max(1, initial), self.maximum))
+            self.in_flight = 0
+            self.latency = None
+            self.baseline = None
+            self.bucket = {}
+            self.available = None
+            self.available_at = 0.0
+            self.request_cost = None
+            self.changes = {"increase": 0, "throttled": 0, "slow": 0}
+            self.last_decrease = 0.0
+            self.started = self.last_change = time.perf_counter()
+            self.limit_seconds = 0.0
+            self.peak = int(self.limit)
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """Hold one of the in-flight slots for the enclosed request"""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            wait = self.reserve()
+        try:
+            if wait > 0:
+                RUN_STATS.sleep(wait, reason='bucket')
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify()
+
+    def reserve(self):
+        """Take a request's cost from the estimated bucket; returns how long to wait for it to refill"""
+        restore_rate = self.bucket.get("restore_rate")
+        if self.available is None or not self.request_cost or not restore_rate:
+            return 0.0
+        now = time.perf_counter()
+        available = min(self.bucket["size"], self.available + (now - self.available_at) * restore_rate)
+        self.available, self.available_at = available - self.request_cost, now
+        return max(0.0, (self.request_cost - available) / restore_rate)
+
+    def observe(self, sent, seconds, cost, throttled):
+        """Adjust the limit after a response to a request sent at sent (perf_counter) that took seconds"""
+        status = (cost or {}).get('throttleStatus') or {}
+        with self.condition:
+            self.latency = seconds if self.latency is None else 0.8 * self.latency + 0.2 * seconds
+            self.baseline = self.latency if self.baseline is None else min(self.baseline, self.latency)
+            if cost and cost.get('requestedQueryCost'):
+                requested = cost['requestedQueryCost']
+                self.request_cost = requested if self.request_cost is None else 0.8 * self.request_cost + 0.2 * requested
+
+            headroom = None
+            if status.get('maximumAvailable') and status.get('currentlyAvailable') is not None:
+                self.bucket = {"size": status['maximumAvailable'], "restore_rate": status.get('restoreRate')}
+                # Requests still in flight will spend their share of what the response reports
+                self.available = status['currentlyAvailable'] - (self.request_cost or 0) * self.in_flight
+                self.available_at = time.perf_counter()
+                headroom = status['currentlyAvailable'] / status['maximumAvailable']
+
+            if throttled:
+                self.decrease(sent, THROTTLED_DECREASE, 'throttled')
+            elif self.latency > max(self.baseline * SLOW_LATENCY_FACTOR, self.baseline + SLOW_LATENCY_SLACK):
+                self.decrease(sent, SLOW_DECREASE, 'slow')
+            elif headroom is not None and headroom < LOW_BUCKET:
+                pass
+            elif self.in_flight + 1 >= int(self.limit) and self.limit < self.maximum:
+                # Only grow while the current limit is actually in use
+                self.set_limit(min(self.maximum, self.limit + 1 / self.limit), 'increase')
+
+    def decrease(self, sent, factor, reason):
+        if sent < self.last_decrease:
+            return
+        self.last_decrease = time.perf_counter()
+        self.set_limit(max(1.0, self.limit * factor), reason)
+
+    def set_limit(self, limit, reason):
+        old = int(self.limit)
+        now = time.perf_counter()
+        self.limit_seconds += (now - self.last_change) * self.limit
+        self.last_change = now
+        self.limit = limit
+        if int(limit) == old:
+            return
+        self.changes[reason] += 1
+        self.peak = max(self.peak, int(limit))
+        if int(limit) > old:
+            self.condition.notify_all()
+        logger.debug(f"🎚️ Concurrency {old} -> {int(limit)} ({reason})",
+                     extra={"latency_ms": round(self.latency * 1000, 1), "bucket": self.bucket})
+
+    def operating_point(self):
+        """Where the controller settled, for the run report"""
+        with self.condition:
+            now = time.perf_counter()
+            elapsed = now - self.started
+            limit_seconds = self.limit_seconds + (now - self.last_change) * self.limit
+            return {
+                "limit": int(self.limit),
+                "average_limit": round(limit_seconds / elapsed, 2) if elapsed > 0 else int(self.limit),
+                "peak_limit": self.peak,
+                "max_limit": self.maximum,
+                "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+                "baseline_latency_ms": round(self.baseline * 1000, 1) if self.baseline is not None else None,
+                "request_cost": round(self.request_cost, 1) if self.request_cost is not None else None,
+                "bucket_size": self.bucket.get("size"),
+                "restore_rate": self.bucket.get("restore_rate"),
+                "changes": dict(self.changes)
+            }
+
+    def log_operating_point(self):
+        point = self.operating_point()
+        logger.info(f"🎚️ Ran {point['average_limit']} requests in flight on average, ending at {point['limit']} "
+                    f"(bucket {point['bucket_size']} @ {point['restore_rate']}/s)", extra=point)
+        return point
+
+
+# Shared by everything that calls graphql() for a store; start_run sets its range from the config
+CONCURRENCY = StoreLocal(ConcurrencyController)
 
+REGISTRY.gauge('shopify_requests_in_flight', 'GraphQL requests in flight', collect=lambda: CONCURRENCY.in_flight)
+REGISTRY.gauge('shopify_concurrency_limit', 'Requests the concurrency controller allows in flight', collect=lambda: int(CONCURRENCY.limit))
+
+
+def count_media(image_urls, sources):
+    """Count attached images by whether Shopify fetches them from us (staged) or the original host"""
+    originals = set(image_urls)
+    for source in sources:
+        MEDIA.inc(source='remote' if source in originals else 'staged')
+
+
+_session = None
+_session_lock = threading.Lock()
+
+def http():
+    """The requests session of the active store, or the one everything else shares (kept-alive connections)"""
+    global _session
+    store = STORE.get()
+    if store is not None:
+        return store.session
+    with _session_lock:
+        if _session is None:
+            config = get_config()
+            _session = new_session(max(config.max_concurrency, config.variant_workers, config.image_workers))
+        return _session
+
+def reset_http():
+    """Start a new shared session on the next request, e.g. after a cassette was opened"""
+    global _session
+    with _session_lock:
+        session, _session = _session, None
+    if session is not None:
+        session.close()
+
+@profiled('graphql')
+def graphql(query, variables=None):
+    """
+    POST a query to the Admin GraphQL API, recording its cost in RUN_STATS
+    and waiting out any throttling.
+
+    Returns the response and its decoded JSON body ({} if it wasn't JSON).
+    """
+    config = get_config()
+    operation = operation_name(query)
+    payload = {"query": query}
+    if variables is not None:
+        payload["variables"] = variables
+
+    log_payload(logger, f"➡️ {operation}", payload)
+
+    post = http().post
+
+    for attempt in range(MAX_THROTTLE_RETRIES + 1):
+        with CONCURRENCY.slot():
+            start = time.perf_counter()
+            response = post(config.graphql_url, headers=config.headers, json=payload)
+            seconds = time.perf_counter() - start
+
+        try:
+            result = response.json()
+        except ValueError:
+            result = {}
+
+        cost = (result.get('extensions') or {}).get('cost')
+        RUN_STATS.record_cost(operation, cost, seconds)
+        throttled = is_throttled(result)
+        CONCURRENCY.observe(start, seconds, cost, throttled)
+        REQUEST_SECONDS.observe(seconds, operation=operation)
+        QUERY_COST.inc((cost or {}).get('actualQueryCost') or 0, operation=operation)
+
+        if not throttled or attempt == MAX_THROTTLE_RETRIES:
+            return response, result
+
+        delay = throttle_delay(cost)
+        logger.warning(f"⏳ Throttled on {operation}, waiting {delay:.2f}s", extra={"attempt": attempt + 1})
+        RUN_STATS.record_throttle(operation)
+        THROTTLED.inc(operation=operation)
+        RUN_STATS.sleep(delay, reason='throttled')
+
+@timed('sku_lookup')
 def get_product_by_sku(sku):
     query = """
     query getProductBySku($sku: String!) {
@@ -28,19 +304,15 @@ def get_product_by_sku(sku):
         "sku": f"sku:{sku}"
     }
     
-    response = requests.post(
-        GRAPHQL_URL,
-        headers=HEADERS,
-        json={"query": query, "variables": variables}
-    )
+    response, data = graphql(query, variables)
     
     if response.status_code == 200:
-        data = response.json()
         products = data.get('data', {}).get('products', {}).get('edges', [])
         if products:
             return products[0]['node']['id']
     return None
 
+@profiled('title_lookup')
 def get_product_by_title(title):
     query = """
     query getProductByTitle($title: String!) {
@@ -59,19 +331,81 @@ def get_product_by_title(title):
         "title": f"title:'{title}'"
     }
     
-    response = requests.post(
-        GRAPHQL_URL,
-        headers=HEADERS,
-        json={"query": query, "variables": variables}
-    )
+    response, data = graphql(query, variables)
     
     if response.status_code == 200:
-        data = response.json()
         products = data.get('data', {}).get('products', {}).get('edges', [])
         if products:
             return products[0]['node']['id']
     return None
 
+@timed('variant_lookup')
+def get_product_variants(product_id, page_size=250):
+    """
+    The variants a product already has, with their SKU, woocommerce_sku
+    metafield, selected options and inventory item, so variants of a re-run
+    can be matched to them (see existing_variant).
+    """
+    query = """
+    query existingVariants($id: ID!, $first: Int!, $cursor: String) {
+      product(id: $id) {
+        variants(first: $first, after: $cursor) {
+          edges {
+            node {
+              id
+              sku
+              price
+              compareAtPrice
+              selectedOptions {
+                name
+                value
+              }
+              metafield(namespace: "custom", key: "woocommerce_sku") {
+                value
+              }
+              inventoryItem {
+                id
+              }
+            }
+          }
+          pageInfo {
+            hasNextPage
+            endCursor
+          }
+        }
+      }
+    }
+    """
+
+    variants = []
+    cursor = None
+    while True:
+        response, result = graphql(query, {"id": product_id, "first": page_size, "cursor": cursor})
+        page = ((result.get("data") or {}).get("product") or {}).get("variants")
+        if page is None:
+            raise RuntimeError(f"Could not read the variants of {product_id}: {result.get('errors') or response.status_code}")
+        variants.extend(edge["node"] for edge in page["edges"])
+        if not page["pageInfo"]["hasNextPage"]:
+            return variants
+        cursor = page["pageInfo"]["endCursor"]
+
+def existing_variant(child, variants):
+    """
+    The variant among a product's variants that a transformed variant row
+    already became, or None: matched by WooCommerce SKU, or for a row without
+    one by its option values.
+    """
+    sku = (child.get('sku') or '').strip()
+    if sku:
+        return next((variant for variant in variants
+                     if sku in (variant.get("sku"), (variant.get("metafield") or {}).get("value"))), None)
+    options = {name: value for name, value in (child.get('variantAttributes') or {}).items()}
+    if not options:
+        return None
+    return next((variant for variant in variants
+                 if {option["name"]: option["value"] for option in variant.get("selectedOptions") or []} == options), None)
+
+@profiled('locations')
 def get_locations():  
     """Get available locations from Shopify"""
     query = """
@@ -87,14 +421,9 @@ def get_locations():
     }
     """
     
-    response = requests.post(
-        GRAPHQL_URL,
-        headers=HEADERS,
-        json={"query": query}
-    )
+    response, data = graphql(query)
     
     if response.status_code == 200:
-        data = response.json()
         locations = data.get('data', {}).get('locations', {}).get('edges', [])
         
         # If no active location found, use the first location
@@ -104,6 +433,7 @@ def get_locations():
     return None
 
 
+@profiled('image_ids')
 def get_product_image_ids(product_id):
     query = """
     query getMedia($id: ID!) {
@@ -119,87 +449,254 @@ def get_product_image_ids(product_id):
       }
     }
     """
-    response = requests.post(
-        GRAPHQL_URL,
-        headers=HEADERS,
-        json={"query": query, "variables": {"id": product_id}}
-    )
-    data = response.json()
+    response, data = graphql(query, {"id": product_id})
     image_ids = [
         edge["node"]["id"].split("/")[-1]  # Extract just the numeric ID
         for edge in data["data"]["product"]["images"]["edges"]
     ]
     return image_ids
 
+@profiled('image_delete')
 def delete_images_rest_api(product_id, image_ids):
     for image_id in image_ids:
-        url = f"https://{SHOPIFY_STORE}/admin/api/2023-07/products/{product_id.split('/')[-1]}/images/{image_id}.json"
-        response = requests.delete(url, headers={
-            "X-Shopify-Access-Token": SHOPIFY_API_ACCESS_TOKEN
-        })
+        url = get_config().rest_url(f"products/{product_id.split('/')[-1]}/images/{image_id}.json")
+        with CONCURRENCY.slot():
+            response = http().delete(url, headers=get_config().rest_headers)
         if response.status_code == 200:
-            print(f"🗑️ Deleted image {image_id}")
+            logger.info(f"🗑️ Deleted image {image_id}")
         else:
-            print(f"❌ Failed to delete image {image_id}: {response.text}")
+            logger.error(f"❌ Failed to delete image {image_id}", extra={"status": response.status_code, "body": response.text})
 
+@profiled('image_delete_all')
 def delete_all_product_images(product_id):
     image_ids = get_product_image_ids(product_id)
     if not image_ids:
-        print("ℹ️ No images to delete.")
+        logger.info("ℹ️ No images to delete.")
         return
     delete_images_rest_api(product_id, image_ids)
 
-def build_variant_input(child, option_names, use_selected_options=True):
-    base = {
-        "title": child["title"],
-        "sku": child["sku"],
-        "price": child["price"],
-        "inventoryManagement": "SHOPIFY"
-    }
+# Shopify's limits on a product's options and variants (2024-04 and later)
+MAX_OPTIONS = 3
+MAX_VARIANTS = 2048
 
-    if use_selected_options:
-        base["selectedOptions"] = [
-            {"name": k, "value": child["variantAttributes"][k]} for k in option_names
-        ]
-    else:
-        for i, key in enumerate(option_names[:3]):
-            base[f"option{i+1}"] = child["variantAttributes"][key]
-    
-    return base
+def option_values(value_str):
+    """Split a WooCommerce attribute value list ("A, B, C") into its values"""
+    return [value.strip() for value in (value_str or '').split(',') if value.strip()]
 
-def build_all_variant_inputs(product, use_selected_options=True):
+@profiled('variant_input')
+def build_variant_input(child, location_id):
     """
-    Given a product object and flag for using selectedOptions or optionN format,
-    return a list of ProductVariantInput objects ready for mutation.
+    Build the ProductVariantsBulkInput for one transformed variant row.
+    Used for every productVariantsBulkCreate request. Only the
+    woocommerce_sku metafield goes with it; add_variants queues the rest
+    with METAFIELDS once the variants exist.
     """
-    option_names = list(product.get("variantAttributes", {}).keys())
-    variant_inputs = []
+    variant_attributes = child.get('variantAttributes') or {}
 
-    for child in product.get("children", []):
-        base = {
-            "title": child.get("title"),
-            "sku": child.get("sku"),
-            "price": child.get("price"),
-            "inventoryManagement": "SHOPIFY"
+    metafields = [
+        {
+            "namespace": "custom",
+            "key": "woocommerce_sku",
+            "value": child.get('sku', ''),
+            "type": "single_line_text_field"
         }
+    ]
 
-        if use_selected_options:
-            base["selectedOptions"] = [
-                {
-                    "name": key,
-                    "value": child.get("variantAttributes", {}).get(key, "")
-                }
-                for key in option_names
-            ]
-        else:
-            # Fall back to option1, option2, option3
-            for i, key in enumerate(option_names[:3]):
-                base[f"option{i+1}"] = child.get("variantAttributes", {}).get(key, "")
+    return {
+        "price": child.get('price') or '0.00',
+        "inventoryItem": {
+            "sku": child.get('sku', ''),
+            "tracked": True
+        },
+        "inventoryQuantities": {
+            "locationId": location_id,
+            "availableQuantity": int(child.get('inventoryQuantity') or 0)
+        },
+        "metafields": metafields,
+        "optionValues": [
+            {
+                "optionName": option_name,
+                "name": value
+            }
+            for option_name, value in variant_attributes.items()
+        ]
+    }
 
-        variant_inputs.append(base)
+@profiled('validate_variants')
+def validate_variants(parent_product, child_products):
+    """
+    Check variants against their parent's variantAttributes before sending them,
+    catching what productVariantsBulkCreate would reject.
 
-    return variant_inputs
+    Returns (valid children, errors); errors are shaped like Shopify userErrors
+    with the offending variant's SKU added.
+    """
+    parent_options = {
+        name: set(option_values(values))
+        for name, values in ((parent_product or {}).get('variantAttributes') or {}).items()
+    }
+    errors = []
+    valid = []
+    seen = {}
+
+    def reject(child, field, message):
+        errors.append({"field": field, "message": message, "sku": child.get('sku', '')})
+
+    if len(parent_options) > MAX_OPTIONS:
+        for child in child_products:
+            reject(child, ["optionValues"], f"Parent has {len(parent_options)} options, Shopify allows {MAX_OPTIONS}")
+        return [], errors
+
+    for child in child_products:
+        attributes = child.get('variantAttributes') or {}
+        problems = len(errors)
+
+        if not parent_options:
+            reject(child, ["productId"], "Parent has no variant attributes to use as options")
+        for name, value in attributes.items():
+            if name not in parent_options:
+                reject(child, ["optionValues", name], f"Option '{name}' is not an option of the parent")
+            elif parent_options[name] and value not in parent_options[name]:
+                reject(child, ["optionValues", name], f"'{value}' is not one of the parent's values for '{name}'")
+        for name in parent_options:
+            if not attributes.get(name):
+                reject(child, ["optionValues", name], f"Missing a value for option '{name}'")
+
+        try:
+            float(child.get('price') or 0)
+        except ValueError:
+            reject(child, ["price"], f"Price '{child.get('price')}' is not a number")
+        try:
+            int(child.get('inventoryQuantity') or 0)
+        except ValueError:
+            reject(child, ["inventoryQuantities", "availableQuantity"], f"Stock '{child.get('inventoryQuantity')}' is not a whole number")
+
+        combination = tuple(attributes.get(name) for name in parent_options)
+        if combination in seen:
+            reject(child, ["optionValues"], f"Same options as variant {seen[combination]}")
+
+        if len(errors) == problems:
+            seen[combination] = child.get('sku', '')
+            valid.append(child)
+
+    if len(valid) > MAX_VARIANTS:
+        for child in valid[MAX_VARIANTS:]:
+            reject(child, ["variants"], f"Parent already has {MAX_VARIANTS} variants")
+        valid = valid[:MAX_VARIANTS]
+
+    return valid, errors
+
+class VariantScheduler:
+    """
+    Creates the variants of many parents concurrently.
 
+    Submit each parent's variants as soon as its Shopify ID is known; the
+    requests run on a small thread pool while the caller carries on creating
+    parents. Use as a context manager, or call wait() to finish.
+    """
+
+    def __init__(self, max_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='variants')
+        self.futures = []
+
+    def submit(self, parent_id, child_products, parent_product=None):
+        if not parent_id or not child_products:
+            return None
+        # Run with the caller's log context so records keep the parent's SKU
+        context = contextvars.copy_context()
+        VARIANT_QUEUE.inc()
+        future = self.executor.submit(context.run, self.run, parent_id, child_products, parent_product)
+        self.futures.append(future)
+        return future
+
+    @staticmethod
+    def run(parent_id, child_products, parent_product):
+        try:
+            return add_variants(parent_id, child_products, parent_product)
+        except Exception as e:
+            logger.exception("❌ Creating variants failed")
+            FAILURES.record('variants', type(e).__name__, e)
+            return None
+        finally:
+            VARIANT_QUEUE.dec()
+
+    def wait(self):
+        """Wait for every submitted parent, returning the results in submission order"""
+        results = [future.result() for future in self.futures]
+        self.futures = []
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.wait()
+        self.executor.shutdown()
+
+# Files per stagedUploadsCreate call
+STAGED_UPLOAD_BATCH_SIZE = 25
+
+@timed('image_upload')
+def staged_upload_targets(files):
+    """
+    Reserve upload targets for files, a list of (filename, mime type, size),
+    with one stagedUploadsCreate call. Returns a target per file (None for
+    any Shopify refused).
+    """
+    mutation = """
+    mutation stagedUploadsCreate($input: [StagedUploadInput!]!) {
+      stagedUploadsCreate(input: $input) {
+        stagedTargets {
+          url
+          resourceUrl
+          parameters {
+            name
+            value
+          }
+        }
+        userErrors {
+          field
+          message
+        }
+      }
+    }
+    """
+
+    variables = {
+        "input": [
+            {
+                "filename": filename,
+                "mimeType": mime_type,
+                "resource": "IMAGE",
+                "httpMethod": "POST",
+                "fileSize": str(size)
+            }
+            for filename, mime_type, size in files
+        ]
+    }
+
+    response, result = graphql(mutation, variables)
+    payload = result.get("data", {}).get("stagedUploadsCreate") or {}
+    errors = payload.get("userErrors") or result.get("errors", [])
+    targets = payload.get("stagedTargets") or []
+    if errors or len(targets) != len(files):
+        logger.error(f"❌ Could not stage {len(files)} image uploads", extra={"errors": errors})
+        return [None] * len(files)
+    return targets
+
+@profiled('image_upload_file')
+def upload_to_target(target, filename, mime_type, data):
+    """POST a file to a staged upload target; returns its resourceUrl, or None if the upload failed"""
+    # The parameters sign the upload and must come before the file
+    form = {parameter["name"]: parameter["value"] for parameter in target["parameters"]}
+    with CONCURRENCY.slot():
+        upload = http().post(target["url"], data=form, files={"file": (filename, data, mime_type)}, timeout=120)
+    if upload.status_code not in (200, 201, 204):
+        logger.error(f"❌ Staged upload of {filename} failed", extra={"status": upload.status_code, "body": upload.text[:500]})
+        return None
+    return target["resourceUrl"]
+
+@timed('media')
 def create_media(product_id, image_urls, sku=None, name=None):
     """
     Upload images to a product using the productCreateMedia mutation.
@@ -234,7 +731,7 @@ def create_media(product_id, image_urls, sku=None, name=None):
             "originalSource": url,
             "mediaContentType": "IMAGE"
         }
-        for url in image_urls
+        for url in image_sources(image_urls)
     ]
 
     variables = {
@@ -242,23 +739,20 @@ def create_media(product_id, image_urls, sku=None, name=None):
         "media": media_inputs
     }
 
-    response = requests.post(
-        GRAPHQL_URL,
-        headers=HEADERS,
-        json={"query": mutation, "variables": variables}
-    )
-
-    result = response.json()
+    response, result = graphql(mutation, variables)
     errors = result.get("data", {}).get("productCreateMedia", {}).get("mediaUserErrors", [])
     if errors:
-        print(f"⚠️ Media Error at line {line_number}: {errors[0]['message']}")
+        logger.warning(f"⚠️ Media error: {errors[0]['message']}", extra={"errors": errors})
+        FAILURES.record('media', 'MediaUserError', errors[0]['message'])
         # Log the error
-        log_image_error(sku or '', name or '', errors.length, image_urls, errors[0]['message'], line_number or 'N/A')
+        log_image_error(sku or '', name or '', image_urls, errors[0]['message'], current_context().get('line', 'N/A'))
     else:
-        print(f"✅ Uploaded {len(image_urls)} images to product {product_id}")
+        count_media(image_urls, [media["originalSource"] for media in media_inputs])
+        logger.info(f"✅ Uploaded {len(image_urls)} images to product {product_id}")
 
+@timed('variants')
 def add_variants(parent_id, child_products, parent_product=None):
-    DEFAULT_LOCATION_ID = get_locations()
+    location_id = get_config().location_id or get_locations()
     
     mutation = """
     mutation productVariantsBulkCreate(
@@ -277,6 +771,9 @@ def add_variants(parent_id, child_products, parent_product=None):
           sku
           price
           inventoryQuantity
+          inventoryItem {
+            id
+          }
           selectedOptions {
             name
             value
@@ -290,47 +787,15 @@ def add_variants(parent_id, child_products, parent_product=None):
     }
     """
 
-    # Create variant inputs for each child product
-    variants = []
-    
-    for child_product in child_products:
-        # Get variant attributes
-        variant_attributes = child_product.get('variantAttributes', {})
-        
-        metafields = [
-            {
-                "namespace": "custom",
-                "key": "woocommerce_sku",
-                "value": child_product.get('sku', ''),
-                "type": "single_line_text_field"
-            }
-        ]
+    if parent_product is not None:
+        child_products, invalid = validate_variants(parent_product, child_products)
+        if invalid:
+            logger.error(f"❌ Skipping {len(invalid)} invalid variants", extra={"errors": invalid})
+            FAILURES.record('variants', 'InvalidVariant', invalid[0]['message'])
+        if not child_products:
+            return {}
 
-        if child_product.get('metafields'):
-            metafields.extend(child_product.get('metafields'))
-
-        # Create the variant input
-        variant = {
-            "price": child_product.get('price', '0.00'),
-            "inventoryItem": {
-                "sku": child_product.get('sku', ''),
-                "tracked": True
-            },
-            "inventoryQuantities": {
-                "locationId": DEFAULT_LOCATION_ID,
-                "availableQuantity": int(child_product.get('inventoryQuantity', 0))
-            },
-            "metafields": metafields,
-            "optionValues": [
-                {
-                    "name": name,
-                    "optionName": value
-                }
-                for name, value in variant_attributes.items()
-            ]
-        }
-        
-        variants.append(variant)
+    variants = [build_variant_input(child, location_id) for child in child_products]
 
     variables = {
         "productId": parent_id,
@@ -338,32 +803,33 @@ def add_variants(parent_id, child_products, parent_product=None):
         "variants": variants
     }
 
-    response = requests.post(
-        GRAPHQL_URL,
-        headers=HEADERS,
-        json={"query": mutation, "variables": variables}
-    )
-
-    result = response.json()
+    response, result = graphql(mutation, variables)
     user_errors = result.get("data", {}).get("productVariantsBulkCreate", {}).get("userErrors", [])
     result_errors = result.get("errors", [])
 
-    print("🎯 Add Variants Response:")
+    log_payload(logger, "🎯 Add Variants Response", result)
     if user_errors:
-        print(f"❌ User Errors creating variants:")
-        print(json.dumps(user_errors, indent=2))
+        logger.error("❌ User errors creating variants", extra={"errors": user_errors})
+        FAILURES.record('variants', 'UserError', user_errors[0]['message'])
     
     if result_errors:
-        print(f"❌ Result Errors creating variants:")
-        print(json.dumps(result_errors, indent=2))
+        logger.error("❌ Result errors creating variants", extra={"errors": result_errors})
+        FAILURES.record('variants', 'GraphQLError', result_errors[0].get('message'))
     
     if not user_errors and not result_errors:
-        print(f"✅ Variants created successfully")
-        print(json.dumps(result, indent=2))
+        from metafields import METAFIELDS
+
+        VARIANTS.inc(len(variants))
+        logger.info(f"✅ Created {len(variants)} variants", extra={"product_id": parent_id})
+        # The variants come back in the order they were sent
+        created = result["data"]["productVariantsBulkCreate"].get("productVariants") or []
+        for child, variant in zip(child_products, created):
+            METAFIELDS.add(variant["id"], child.get('metafields'), sku=child.get('sku'))
     
     return result
 
 
+@timed('create')
 def create_variable_product(product):
     # Step 1: Create product without variants
     mutation_create_product = """
@@ -402,24 +868,19 @@ def create_variable_product(product):
         "status": product.get("status", "DRAFT")
     }
 
-    response = requests.post(
-        GRAPHQL_URL,
-        headers=HEADERS,
-        json={"query": mutation_create_product, "variables": {"input": product_input}}
-    )
-    result = response.json()
-    print("🎯 Product Create Response:")
-    print(json.dumps(result, indent=2))
+    response, result = graphql(mutation_create_product, {"input": product_input})
+    log_payload(logger, "🎯 Product Create Response", result)
 
     errors = result.get("data", {}).get("productCreate", {}).get("userErrors", [])
     if errors:
-        print(f"❌ Errors creating product: {errors[0]['message']}")
+        logger.error(f"❌ Errors creating product: {errors[0]['message']}", extra={"errors": errors})
         return response, None
 
     product_id = result["data"]["productCreate"]["product"]["id"]
+    JOURNAL.record('product', product_id, sku=product.get("sku"), title=product["title"])
 
-    # Step 2: Create variants using productVariantCreate
-    result = add_variants(product_id, product)
+    # Step 2: Create variants using productVariantsBulkCreate
+    result = add_variants(product_id, product.get("children", []), parent_product=product)
 
 
     # Step 3: Upload images
@@ -428,6 +889,7 @@ def create_variable_product(product):
     return response, product_id
 
 
+@timed('create')
 def create_product(product):
     # Create new product
     mutation = """
@@ -441,6 +903,9 @@ def create_product(product):
               node {  
                 id
                 title
+                inventoryItem {
+                  id
+                }
               }
             }
           }
@@ -500,14 +965,15 @@ def create_product(product):
     media = []
     if product.get('images'):
         image_urls = parse_images(product.get('images'))
-        for url in image_urls:
+        for url in image_sources(image_urls):
             media.append({
                 "alt": product.get('title', ''),
                 "originalSource": url,
                 "mediaContentType": "IMAGE"
             })
     
-    # Add metafields
+    # Only the SKU goes with the product, so it can always be found again;
+    # the rest of its metafields are batched by metafields.METAFIELDS
     metafields = [
         {
             "namespace": "custom",
@@ -516,8 +982,6 @@ def create_product(product):
             "type": "single_line_text_field"
         }
     ]
-    if product.get('metafields'):
-        product_input["metafields"].extend(product.get('metafields'))
 
     # Build the product input
     product_input = {
@@ -538,39 +1002,52 @@ def create_product(product):
         "media": media
     }
 
-    response = requests.post(
-        GRAPHQL_URL,
-        headers=HEADERS,
-        json={"query": mutation, "variables": variables}
-    )
-
-    result = response.json()
+    response, result = graphql(mutation, variables)
     user_errors = result.get("data", {}).get("productCreate", {}).get("userErrors", [])
     result_errors = result.get("errors", [])
 
-    print("🎯 Product Create Response:")
+    log_payload(logger, "🎯 Product Create Response", result)
     if user_errors:
-        print(f"❌ User Errors creating product:")
-        print(json.dumps(user_errors, indent=2))
+        logger.error("❌ User errors creating product", extra={"errors": user_errors})
+        FAILURES.record('product', 'UserError', user_errors[0]['message'])
     
     if result_errors:
-        print(f"❌ Result Errors creating product:")
-        print(json.dumps(result_errors, indent=2))
+        logger.error("❌ Result errors creating product", extra={"errors": result_errors})
+        FAILURES.record('product', 'GraphQLError', result_errors[0].get('message'))
     
     productId = None
     if not user_errors and not result_errors:
         productId = result.get("data", {}).get("productCreate", {}).get("product", {}).get("id")
-        print(f"✅ Product created successfully (productId: {productId})")
+        JOURNAL.record('product', productId, sku=product.get('sku'), title=product.get('title'))
+        PRODUCTS.inc(outcome='created')
+        if media:
+            count_media(parse_images(product.get('images')), [item["originalSource"] for item in media])
+        logger.info("✅ Product created successfully", extra={"product_id": productId})
     return result, productId
 
+@timed('update')
 def update_product(product):
-  # Update existing product
+  """
+  Update an existing product (product['shopifyExistingId']) from its
+  transformed row. The product's own fields go through productUpdate; the
+  price of a product without variations is on its default variant, so it
+  goes through productVariantsBulkUpdate like the stock and price sync, and
+  an ACTIVE product is published with publishablePublish.
+  """
+  product_id = product.get('shopifyExistingId')
   mutation = """
   mutation productUpdate($input: ProductInput!) {
       productUpdate(input: $input) {
       product {
           id
           title
+          variants(first: 1) {
+              edges {
+                  node {
+                      id
+                  }
+              }
+          }
       }
       userErrors {
           field
@@ -582,48 +1059,101 @@ def update_product(product):
 
   variables = {
       "input": {
+          "id": product_id,
           "title": product.get('title'),
-          "bodyHtml": product.get('descriptionHtml'),
+          "descriptionHtml": product.get('descriptionHtml'),
           "status": product.get('status'),
           "vendor": product.get('vendor'),
           "productType": product.get('productType'),
-          "tags": product.get('tags'),
-          "metafields": product.get('metafields'),
-          "published": product.get('published'),
-          "variants": [{
-              "price": product.get('price', '0.00'),
-              "inventoryManagement": "SHOPIFY",
-              "sku": product.get('sku', '')
-          }]
+          "tags": product.get('tags')
       }
   }
-  
-  response = requests.post(
-      GRAPHQL_URL,
-      headers=HEADERS,
-      json={"query": mutation, "variables": variables}
-  )
-
-  result = response.json()
-  errors = result.get("data", {}).get("productCreate", {}).get("userErrors", [])
+
+  response, result = graphql(mutation, variables)
+  log_payload(logger, "🎯 Product Update Response", result)
+  update = (result.get("data") or {}).get("productUpdate") or {}
+  errors = update.get("userErrors", []) + result.get("errors", [])
   if errors:
-      print(f"❌ Errors creating product: {errors[0]['message']}")
-  
-  if not errors and SYNC_IMAGES:
-      delete_all_product_images(product.get('shopifyExistingId'))
-      create_media(product.get('shopifyExistingId'), parse_images(product.get('images')), product.get('sku'), product.get('title'))
+      logger.error(f"❌ Errors updating product: {errors[0]['message']}", extra={"errors": errors})
+      FAILURES.record('product', 'UserError', errors[0]['message'])
+      return response
+  PRODUCTS.inc(outcome='updated')
+
+  # A variable parent has no price of its own; its variations carry theirs
+  variants = ((update.get("product") or {}).get("variants") or {}).get("edges", [])
+  if not product.get('isParent') and variants:
+      if update_variant_prices(product_id, [{"id": variants[0]["node"]["id"], "price": product.get('price') or '0.00'}]):
+          FAILURES.record('product', 'UserError', 'Price update failed')
+
+  if product.get('status') == 'ACTIVE':
+      publish_product(product_id)
+
+  if get_config().sync_images:
+      delete_all_product_images(product_id)
+      create_media(product_id, parse_images(product.get('images')), product.get('sku'), product.get('title'))
 
   return response
 
+# Publication name -> ID, looked up in each store the first time a product is published there
+PUBLICATIONS = StoreLocal(dict)
+
+@profiled('publish')
+def publish_product(product_id):
+  """Publish a product to every sales channel (publication) of the store. Returns the userErrors"""
+  if not PUBLICATIONS:
+      PUBLICATIONS.update(get_publication_ids())
+
+  mutation = """
+  mutation publishablePublish($id: ID!, $input: [PublicationInput!]!) {
+    publishablePublish(id: $id, input: $input) {
+      userErrors {
+        field
+        message
+      }
+    }
+  }
+  """
 
+  variables = {
+      "id": product_id,
+      "input": [{"publicationId": publication_id} for publication_id in PUBLICATIONS.values()]
+  }
+
+  response, result = graphql(mutation, variables)
+  errors = ((result.get("data") or {}).get("publishablePublish") or {}).get("userErrors", []) + result.get("errors", [])
+  if errors:
+      logger.error(f"❌ Errors publishing product: {errors[0]['message']}", extra={"errors": errors, "product_id": product_id})
+
+  return errors
+
+
+# inventorySetQuantities accepts up to 250 quantities per call
+INVENTORY_BATCH_SIZE = 250
+
+@profiled('inventory_single')
 def set_inventory_quantity(product_id, inventory_item_id, location_id, quantity):
-  # Update existing product
+  """Set the available quantity of one inventory item (absolute, so safe to re-run)"""
+  return set_inventory_quantities([{
+      "inventoryItemId": inventory_item_id,
+      "locationId": location_id,
+      "quantity": int(quantity)
+  }])
+
+@timed('inventory')
+def set_inventory_quantities(quantities, reason='correction'):
+  """
+  Set absolute available quantities for many inventory items in one call.
+
+  quantities is a list of {"inventoryItemId", "locationId", "quantity"}; at
+  most INVENTORY_BATCH_SIZE per call. Returns the userErrors.
+  """
   mutation = """
-  mutation adjustInventory($input: InventoryAdjustQuantityInput!) {
-    inventoryAdjustQuantity(input: $input) {
-      inventoryLevel {
-        id
-        available
+  mutation inventorySetQuantities($input: InventorySetQuantitiesInput!) {
+    inventorySetQuantities(input: $input) {
+      inventoryAdjustmentGroup {
+        changes {
+          delta
+        }
       }
       userErrors {
         field
@@ -635,26 +1165,255 @@ def set_inventory_quantity(product_id, inventory_item_id, location_id, quantity)
 
   variables = {
       "input": {
-          "inventoryItemId": inventory_item_id,
-          "locationId": location_id,
-          "availableDelta": quantity
+          "name": "available",
+          "reason": reason,
+          "ignoreCompareQuantity": True,
+          "quantities": quantities
       }
   }
-  
-  response = requests.post(
-      GRAPHQL_URL,
-      headers=HEADERS,
-      json={"query": mutation, "variables": variables}
-  )
-
-  result = response.json()
-  errors = result.get("data", {}).get("productCreate", {}).get("userErrors", [])
+
+  response, result = graphql(mutation, variables)
+  errors = (result.get("data") or {}).get("inventorySetQuantities", {}).get("userErrors", []) + result.get("errors", [])
   if errors:
-      print(f"❌ Errors creating product: {errors[0]['message']}")
-  
-  return response
+      logger.error(f"❌ Errors setting inventory: {errors[0]['message']}", extra={"errors": errors})
+
+  return errors
+
+@timed('prices')
+def update_variant_prices(product_id, variants):
+  """
+  Update price/compareAtPrice of several variants of one product.
+
+  variants is a list of {"id", "price", "compareAtPrice"}. Returns the userErrors.
+  """
+  mutation = """
+  mutation productVariantsBulkUpdate($productId: ID!, $variants: [ProductVariantsBulkInput!]!) {
+    productVariantsBulkUpdate(productId: $productId, variants: $variants) {
+      productVariants {
+        id
+        price
+        compareAtPrice
+      }
+      userErrors {
+        field
+        message
+      }
+    }
+  }
+  """
+
+  response, result = graphql(mutation, {"productId": product_id, "variants": variants})
+  errors = (result.get("data") or {}).get("productVariantsBulkUpdate", {}).get("userErrors", []) + result.get("errors", [])
+  if errors:
+      logger.error(f"❌ Errors updating prices: {errors[0]['message']}", extra={"errors": errors, "product_id": product_id})
+
+  return errors
+
+# metafieldsSet accepts up to 25 metafields per call
+METAFIELDS_BATCH_SIZE = 25
+
+@profiled('metafield_definitions')
+def get_metafield_definitions(owner_type, namespace='custom'):
+  """The keys of the metafield definitions in namespace for owner_type (PRODUCT, PRODUCTVARIANT, ...)"""
+  query = """
+  query metafieldDefinitions($ownerType: MetafieldOwnerType!, $namespace: String) {
+    metafieldDefinitions(first: 250, ownerType: $ownerType, namespace: $namespace) {
+      edges {
+        node {
+          key
+        }
+      }
+    }
+  }
+  """
+
+  response, result = graphql(query, {"ownerType": owner_type, "namespace": namespace})
+  edges = ((result.get("data") or {}).get("metafieldDefinitions") or {}).get("edges", [])
+  return {edge["node"]["key"] for edge in edges}
+
+@profiled('metafield_definition')
+def create_metafield_definition(definition):
+  """Create a metafield definition; returns the userErrors, leaving out that it already exists"""
+  mutation = """
+  mutation metafieldDefinitionCreate($definition: MetafieldDefinitionInput!) {
+    metafieldDefinitionCreate(definition: $definition) {
+      createdDefinition {
+        id
+        key
+      }
+      userErrors {
+        field
+        message
+        code
+      }
+    }
+  }
+  """
+
+  response, result = graphql(mutation, {"definition": definition})
+  errors = ((result.get("data") or {}).get("metafieldDefinitionCreate") or {}).get("userErrors", []) + result.get("errors", [])
+  errors = [error for error in errors if error.get("code") != "TAKEN"]
+  if errors:
+      logger.error(f"❌ Errors creating metafield definition {definition['key']}: {errors[0]['message']}", extra={"errors": errors})
+  return errors
+
+@timed('metafields')
+def set_metafields(metafields):
+  """
+  Write metafields of any number of owners in one call.
+
+  metafields is a list of {"ownerId", "namespace", "key", "type", "value"};
+  at most METAFIELDS_BATCH_SIZE per call. Shopify writes all of them or
+  none. Returns the errors.
+  """
+  mutation = """
+  mutation metafieldsSet($metafields: [MetafieldsSetInput!]!) {
+    metafieldsSet(metafields: $metafields) {
+      metafields {
+        id
+        key
+      }
+      userErrors {
+        field
+        message
+        code
+      }
+    }
+  }
+  """
 
+  response, result = graphql(mutation, {"metafields": metafields})
+  errors = ((result.get("data") or {}).get("metafieldsSet") or {}).get("userErrors", []) + result.get("errors", [])
+  if not errors and response.status_code != 200:
+      errors = [{"message": f"HTTP {response.status_code}"}]
+  return errors
 
+def fetch_variant_pages(page_size=250):
+  """
+  Yield every variant in the store, a page at a time, with what's needed to
+  find it again by WooCommerce SKU: its own SKU, the woocommerce_sku
+  metafields on it and its product, and its inventory item. Raises
+  RuntimeError when a page can't be fetched, rather than ending early.
+  """
+  query = """
+  query variantIndex($first: Int!, $cursor: String) {
+    productVariants(first: $first, after: $cursor) {
+      edges {
+        node {
+          id
+          sku
+          price
+          compareAtPrice
+          metafield(namespace: "custom", key: "woocommerce_sku") {
+            value
+          }
+          inventoryItem {
+            id
+          }
+          product {
+            id
+            metafield(namespace: "custom", key: "woocommerce_sku") {
+              value
+            }
+          }
+        }
+      }
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+    }
+  }
+  """
+
+  cursor = None
+  while True:
+      response, result = graphql(query, {"first": page_size, "cursor": cursor})
+      page = (result.get("data") or {}).get("productVariants")
+      if not page:
+          errors = result.get("errors", [])
+          raise RuntimeError(f"Failed to fetch variants: {errors[0].get('message') if errors else response.status_code}")
+      yield [edge["node"] for edge in page["edges"]]
+      if not page["pageInfo"]["hasNextPage"]:
+          return
+      cursor = page["pageInfo"]["endCursor"]
+
+
+# Bulk operations are polled until they finish; Shopify allows one per store at a time
+BULK_POLL_SECONDS = 2.0
+BULK_TIMEOUT_SECONDS = 3600
+
+def run_bulk_query(query):
+    """
+    Run query as a bulk operation and wait for it to finish.
+
+    Returns the URL of the JSONL result (None if the query matched nothing),
+    or raises RuntimeError if the operation couldn't be started or failed.
+    """
+    mutation = """
+    mutation bulkOperationRunQuery($query: String!) {
+      bulkOperationRunQuery(query: $query) {
+        bulkOperation {
+          id
+          status
+        }
+        userErrors {
+          field
+          message
+        }
+      }
+    }
+    """
+    poll = """
+    query currentBulkOperation {
+      currentBulkOperation {
+        id
+        status
+        errorCode
+        objectCount
+        url
+      }
+    }
+    """
+
+    response, result = graphql(mutation, {"query": query})
+    started = (result.get("data") or {}).get("bulkOperationRunQuery") or {}
+    errors = started.get("userErrors", []) + result.get("errors", [])
+    if errors or not started.get("bulkOperation"):
+        raise RuntimeError(f"Could not start bulk query: {errors[0]['message'] if errors else response.status_code}")
+    operation_id = started["bulkOperation"]["id"]
+    logger.info("📦 Bulk query started", extra={"operation": operation_id})
+
+    deadline = time.monotonic() + BULK_TIMEOUT_SECONDS
+    while True:
+        response, result = graphql(poll)
+        operation = (result.get("data") or {}).get("currentBulkOperation") or {}
+        if operation.get("id") != operation_id:
+            raise RuntimeError(f"Bulk query {operation_id} is no longer the current operation")
+        status = operation.get("status")
+        if status == "COMPLETED":
+            logger.info(f"📦 Bulk query finished with {operation.get('objectCount')} objects", extra={"operation": operation_id})
+            return operation.get("url")
+        if status not in ("CREATED", "RUNNING"):
+            raise RuntimeError(f"Bulk query {operation_id} ended {status} ({operation.get('errorCode')})")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Bulk query {operation_id} still {status} after {BULK_TIMEOUT_SECONDS}s")
+        RUN_STATS.sleep(BULK_POLL_SECONDS, reason='bulk')
+
+@timed('bulk_download')
+def download_bulk_result(url, path):
+    """Stream a bulk operation's JSONL result into path"""
+    tmp_path = f"{path}.tmp"
+    with http().get(url, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        with open(tmp_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+    os.replace(tmp_path, path)
+    return path
+
+
+@profiled('publications')
 def get_publication_ids():
     query = """
     {
@@ -668,17 +1427,13 @@ def get_publication_ids():
       }
     }
     """
-    response = requests.post(
-        GRAPHQL_URL,
-        headers=HEADERS,
-        json={"query": query}
-    )
-    data = response.json()
+    response, data = graphql(query)
     return {
         edge["node"]["name"]: edge["node"]["id"]
         for edge in data["data"]["publications"]["edges"]
     }
 
+@profiled('inventory_adjust')
 def adjust_inventory_quantity(inventory_item_id, location_id, delta):
 
     mutation = """
@@ -704,19 +1459,14 @@ def adjust_inventory_quantity(inventory_item_id, location_id, delta):
         }
     }
 
-    response = requests.post(
-        GRAPHQL_URL,
-        headers=HEADERS,
-        json={"query": mutation, "variables": variables}
-    )
-
-    result = response.json()
-    errors = result.get("data", {}).get("productVariantCreate", {}).get("userErrors", [])
+    response, result = graphql(mutation, variables)
+    errors = result.get("data", {}).get("inventoryAdjustQuantity", {}).get("userErrors", [])
     if errors:
-        print(f"❌ Errors creating variant: {errors[0]['message']}")
+        logger.error(f"❌ Errors adjusting inventory: {errors[0]['message']}", extra={"errors": errors})
     
     return response
 
+@profiled('publish_collection')
 def publish_collection(collection_id, publication_ids):
     """
     Publish a collection to the Shopify online store.
@@ -725,7 +1475,7 @@ def publish_collection(collection_id, publication_ids):
     numeric_id = collection_id.split('/')[-1]
     
     # Use the REST API to publish the collection to the online store
-    publish_url = f"https://{SHOPIFY_STORE}/admin/api/2023-07/smart_collections/{numeric_id}.json"
+    publish_url = get_config().rest_url(f"smart_collections/{numeric_id}.json")
 
     # Update the collection to make it published to the online store
     update_data = {
@@ -735,11 +1485,12 @@ def publish_collection(collection_id, publication_ids):
         }
     }
     
-    update_response = requests.put(
-        publish_url,
-        headers={"X-Shopify-Access-Token": SHOPIFY_API_ACCESS_TOKEN},
-        json=update_data
-    )
+    with CONCURRENCY.slot():
+        update_response = http().put(
+            publish_url,
+            headers=get_config().rest_headers,
+            json=update_data
+        )
 
     # Update the collection to make it published to the online store
     update_data = {
@@ -749,17 +1500,19 @@ def publish_collection(collection_id, publication_ids):
         }
     }
     
-    update_response = requests.put(
-        publish_url,
-        headers={"X-Shopify-Access-Token": SHOPIFY_API_ACCESS_TOKEN},
-        json=update_data
-    )
+    with CONCURRENCY.slot():
+        update_response = http().put(
+            publish_url,
+            headers=get_config().rest_headers,
+            json=update_data
+        )
 
     if update_response.status_code == 200:
-        print(f"📢 Published collection to online store")
+        logger.info("📢 Published collection to online store", extra={"collection_id": collection_id})
     else:
-        print(f"❌ Failed to publish collection to online store: {update_response.text}")
+        logger.error("❌ Failed to publish collection to online store", extra={"collection_id": collection_id, "status": update_response.status_code, "body": update_response.text})
 
+@profiled('collection')
 def create_smart_collection(title, publication_ids):
     """Create a smart collection based on a tag"""
     mutation = """
@@ -793,32 +1546,65 @@ def create_smart_collection(title, publication_ids):
         }
     }
     
-    response = requests.post(
-        GRAPHQL_URL,
-        headers=HEADERS,
-        json={"query": mutation, "variables": variables}
-    )
+    response, data = graphql(mutation, variables)
     
     if response.status_code == 200:
-        data = response.json()
         result = data.get('data', {}).get('collectionCreate', {})
         errors = data.get('errors', [])
         collection = result.get('collection', {})
         user_errors = result.get('userErrors', [])
         
         if errors:
-            print(f"❌ Errors creating collection '{title}':")
-            for error in errors:
-                print(f"  - {error['message']}")
+            logger.error(f"❌ Errors creating collection '{title}'", extra={"errors": [error['message'] for error in errors]})
         elif user_errors:
-            print(f"❌ Errors creating collection '{title}':")
-            for error in user_errors:
-                print(f"  - {error['message']}")
+            logger.error(f"❌ Errors creating collection '{title}'", extra={"errors": [error['message'] for error in user_errors]})
         else:
             collection_id = collection.get('id', '')
+            JOURNAL.record('collection', collection_id, title=title)
             publish_collection(collection_id, publication_ids)
-            print(f"✅ Created collection: {title} (ID: {collection_id})")
+            logger.info(f"✅ Created collection: {title}", extra={"collection_id": collection_id})
 
     else:
-        print(f"❌ Failed to create collection '{title}'")
-        print(response.status_code, response.text)
+        logger.error(f"❌ Failed to create collection '{title}'", extra={"status": response.status_code, "body": response.text})
+
+
+DELETE_MUTATIONS = {
+    'product': ('productDelete', """
+    mutation productDelete($input: ProductDeleteInput!) {
+      productDelete(input: $input) {
+        deletedProductId
+        userErrors {
+          field
+          message
+        }
+      }
+    }
+    """),
+    'collection': ('collectionDelete', """
+    mutation collectionDelete($input: CollectionDeleteInput!) {
+      collectionDelete(input: $input) {
+        deletedCollectionId
+        userErrors {
+          field
+          message
+        }
+      }
+    }
+    """)
+}
+
+@timed('delete')
+def delete_from_store(kind, object_id):
+    """
+    Delete a product (with its variants and media) or a collection. Returns
+    the errors; something that's already gone counts as deleted.
+    """
+    name, mutation = DELETE_MUTATIONS[kind]
+    response, result = graphql(mutation, {"input": {"id": object_id}})
+    errors = ((result.get("data") or {}).get(name) or {}).get("userErrors", []) + result.get("errors", [])
+    if not errors and response.status_code != 200:
+        errors = [{"message": f"HTTP {response.status_code}"}]
+    errors = [error for error in errors if 'not exist' not in error.get('message', '') and 'not found' not in error.get('message', '')]
+    if errors:
+        logger.error(f"❌ Errors deleting {kind}: {errors[0]['message']}", extra={"errors": errors, "id": object_id})
+    return errors
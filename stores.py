@@ -0,0 +1,292 @@
+"""
+Migrating one export into several stores at once (`cli.py migrate --stores`).
+
+The stores are the ones named in SHOPIFY_STORES. The export is read,
+checked and transformed once: each product and its variants are turned into
+Shopify input a single time, without looking anything up, and the result is
+queued to every store. Each store has a thread of its own that creates or
+updates the products in its queue, so a slow or throttled store only holds
+up its own queue (and the transform, once its queue is full). Progress
+counts uploads finished, one per product and store.
+
+Everything that belongs to a store is kept apart while its thread works on
+it (config.STORE): its config and location, a requests session (connection
+pool), the concurrency controller, failure index, journal and metafield
+writer, and its SKU index. The SKU index is built with one paginated pass
+over the store's variants at the start. It decides whether each product is
+created or updated there, so no product needs a lookup of its own, and what
+the store creates is added to it (product, variant and inventory item IDs)
+and saved at the end for `sync`.
+Each store's failures, journals and SKU index go in files named after it
+(see Config.for_store), so `cli.py --store <name> retry` or `rollback` work
+on one store afterwards.
+"""
+import queue
+import threading
+from contextlib import contextmanager
+
+from cassette import new_session
+from config import get_config, configured_stores, STORE
+from failures import FAILURES
+from instrumentation import RUN_STATS
+from journal import JOURNAL
+from log import get_logger, log_context
+from metafields import METAFIELDS
+from sku_index import SkuIndex
+
+logger = get_logger('stores')
+
+# Transformed products waiting for each store; the transform waits when a store falls this far behind
+QUEUE_SIZE = 50
+
+
+class Store:
+    """A store being migrated into alongside others, with its own queue and worker thread"""
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.session = new_session(max(config.max_concurrency, config.variant_workers))
+        self.index = SkuIndex(config.sku_index_file)
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.thread = None
+        # What stopped the store's thread, if it didn't get to the end of its queue
+        self.error = None
+        self.created = 0
+        self.updated = 0
+
+    @contextmanager
+    def active(self):
+        """Work on this store: get_config() and the store-local singletons are its own inside the block"""
+        token = STORE.set(self)
+        try:
+            yield self
+        finally:
+            STORE.reset(token)
+
+    def start_run(self):
+        """Resolve the location, open the run's failure index and journal and index the store; False if it isn't usable"""
+        from spUtilities import get_locations, CONCURRENCY
+
+        with self.active(), log_context(store=self.name):
+            self.config.location_id = get_locations()
+            if not self.config.location_id:
+                logger.error(f"❌ Could not find a valid location ID in {self.config.store}")
+                return False
+            CONCURRENCY.reset(self.config.concurrency, self.config.max_concurrency)
+            FAILURES.open(self.config.failure_index_file)
+            JOURNAL.open(self.config.journal_dir)
+            try:
+                with RUN_STATS.stage('sku_index'):
+                    self.index.refresh()
+            except RuntimeError as e:
+                # A partial index would have every product it's missing created again
+                logger.error(f"❌ Could not index the variants in {self.config.store}: {e}")
+                return False
+            logger.info(f"✅ {self.name}: {self.config.store}, location {self.config.location_id}")
+        return True
+
+    def product_id(self, sku):
+        entry = self.index.get(sku.strip()) if sku and sku.strip() else None
+        return entry["product_id"] if entry else None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f"store-{self.name}", daemon=True)
+        self.thread.start()
+        return self
+
+    def put(self, item, timeout=1.0):
+        """Queue item for the store's thread; False, instead of waiting forever, once the thread has stopped"""
+        while self.thread.is_alive():
+            try:
+                self.queue.put(item, timeout=timeout)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def finish(self, timeout=1.0):
+        """Wait for everything queued to be sent; logs what stopped the thread if it died first"""
+        self.put(None, timeout)
+        while self.thread.is_alive():
+            self.thread.join(timeout)
+        if self.error is not None:
+            with log_context(store=self.name):
+                logger.error(f"❌ {self.name} stopped with {self.queue.qsize()} products still queued: {self.error}",
+                             extra={"error": type(self.error).__name__})
+
+    def run(self):
+        try:
+            self.work()
+        except Exception as e:
+            self.error = e
+            with log_context(store=self.name):
+                logger.exception(f"❌ {self.name} stopped")
+
+    def work(self):
+        from spUtilities import VariantScheduler
+
+        with self.active(), VariantScheduler(max_workers=self.config.variant_workers) as variant_scheduler:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                product, children, context = item
+                with log_context(store=self.name, **context):
+                    try:
+                        self.upload(product, children, variant_scheduler)
+                    except Exception as e:
+                        logger.exception("❌ Failed to migrate product")
+                        FAILURES.record('product', type(e).__name__, e)
+                RUN_STATS.advance()
+
+    def upload(self, product, children, variant_scheduler):
+        """Create or update a transformed product in this store and submit its new variants"""
+        from spUtilities import create_product, update_product, get_product_variants, existing_variant
+
+        # A parent without a SKU of its own is found through the first of its variants that has one
+        existing = self.product_id(product.get('sku')) or next(
+            (product_id for product_id in (self.product_id(child.get('sku')) for child in children) if product_id), None)
+        product = dict(product, shopifyExistingId=existing, isNew=not existing)
+
+        if existing:
+            update_product(product)
+            product_id = existing
+            self.updated += 1
+        else:
+            result, product_id = create_product(product)
+            if not product_id:
+                return
+            self.created += 1
+            if (product.get('sku') or '').strip():
+                # The default variant; a parent's is replaced by its variants
+                edges = [] if children else result["data"]["productCreate"]["product"]["variants"]["edges"]
+                variant = edges[0]["node"] if edges else {}
+                self.index.add(product['sku'].strip(), product_id, variant.get("id"),
+                               (variant.get("inventoryItem") or {}).get("id"))
+
+        METAFIELDS.add(product_id, product.get('metafields'))
+        # Variants an earlier run already created are matched by SKU, or by option values for those without one
+        if existing and children:
+            existing_variants = get_product_variants(existing)
+            children = [child for child in children if not existing_variant(child, existing_variants)]
+        if children:
+            future = variant_scheduler.submit(product_id, children, parent_product=product)
+            future.add_done_callback(lambda future: self.index_variants(product_id, future.result()))
+
+    def index_variants(self, product_id, result):
+        """Add the variants add_variants created (its result) to the SKU index"""
+        created = ((result or {}).get("data") or {}).get("productVariantsBulkCreate") or {}
+        for variant in created.get("productVariants") or []:
+            if (variant.get("sku") or '').strip():
+                self.index.add(variant["sku"].strip(), product_id, variant["id"],
+                               (variant.get("inventoryItem") or {}).get("id"), variant.get("price"))
+
+    def close(self):
+        """Finish the store's metafields, journal and failures; returns its part of the run report"""
+        from spUtilities import CONCURRENCY
+
+        with self.active(), log_context(store=self.name):
+            METAFIELDS.close()
+            JOURNAL.close()
+            FAILURES.save()
+            self.index.save()
+            summary = {
+                "store": self.config.store,
+                "created": self.created,
+                "updated": self.updated,
+                "failed": len(FAILURES),
+                "error": repr(self.error) if self.error is not None else None,
+                "concurrency": CONCURRENCY.log_operating_point()
+            }
+        self.session.close()
+        return summary
+
+
+def transform_once(row, df, graph):
+    """A product and its variants as Shopify input, without any store's IDs"""
+    from migrate import transform_product
+    from utilities import get_line_number
+
+    variations = graph.variants(graph.keys[row.name], df)
+    product = transform_product(row, lookup=False, variations=variations)
+    children = []
+    for child in variations:
+        with log_context(sku=child.get('SKU', ''), line=get_line_number(child)):
+            children.append(transform_product(child, product, lookup=False))
+    return product, children
+
+
+def migrate_stores(names=None, csv_file=None):
+    """Migrate the export into the stores called names (every configured store if empty); returns 1 if anything failed"""
+    from images import close_pipeline, prefetch_images
+    from migrate import create_collections, preflight_export
+    from product_graph import ProductGraph
+    from utilities import open_log_files, read_export, get_line_number, parse_images, TAGS
+    from woocommerce import refresh_export
+
+    config = get_config()
+    names = names or list(configured_stores())
+    if not names:
+        logger.error("❌ No stores to migrate to, add them to SHOPIFY_STORES in keys.py")
+        return 1
+    stores = [Store(name, config.for_store(name)) for name in dict.fromkeys(names)]
+
+    open_log_files()
+    RUN_STATS.reset()
+    TAGS.reset()
+    unusable = [store.name for store in stores if not store.start_run()]
+    if unusable:
+        logger.error(f"❌ Not migrating anything, these stores can't be used: {', '.join(unusable)}")
+        return 1
+    csv_file = refresh_export(csv_file)
+    if not csv_file:
+        return 1
+
+    with RUN_STATS.stage('read_csv'):
+        df = read_export(csv_file)
+    with RUN_STATS.stage('product_graph'):
+        graph = ProductGraph(df)
+    orphans = graph.report_orphans(df)
+    df, graph, preflight = preflight_export(df, graph)
+    RUN_STATS.set_total(len(graph) * len(stores), unit='uploads')
+    logger.info(f"🏬 Migrating {len(graph)} products into {len(stores)} stores: {', '.join(store.name for store in stores)}")
+
+    if config.rehost_images:
+        # Downloaded once for every store; each store gets its own upload of each file
+        prefetch_images([url for images in df.loc[graph.products, 'Images'] for url in parse_images(images)])
+
+    for store in stores:
+        store.start()
+    try:
+        for label in graph.products:
+            row = df.loc[label]
+            context = {"sku": graph.keys[label], "line": get_line_number(row)}
+            with log_context(**context):
+                try:
+                    product, children = transform_once(row, df, graph)
+                except Exception as e:
+                    logger.exception("❌ Failed to transform product")
+                    for store in stores:
+                        with store.active():
+                            FAILURES.record('product', type(e).__name__, e)
+                    RUN_STATS.advance(len(stores))
+                    continue
+            for store in stores:
+                if not store.put((product, children, context)):
+                    # The store's thread has stopped; finish() reports why
+                    RUN_STATS.advance()
+    finally:
+        for store in stores:
+            store.finish()
+
+    if config.create_smart_collections:
+        for store in stores:
+            with store.active(), log_context(store=store.name):
+                create_collections(TAGS.categories())
+
+    close_pipeline()
+    summaries = {store.name: store.close() for store in stores}
+    RUN_STATS.write_report(config.run_report_file, tag_vocabulary=TAGS.vocabulary(), orphans=orphans,
+                           preflight=preflight.summary(), stores=summaries)
+    return 1 if any(summary["failed"] or summary["error"] for summary in summaries.values()) else 0
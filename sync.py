@@ -0,0 +1,186 @@
+"""
+Fast stock and price sync.
+
+Reads only the SKU, stock and price columns of the export, finds each SKU's
+variant and inventory item in the cached SkuIndex and pushes absolute
+quantities and prices in batches. Titles, descriptions and media are never
+touched, and running it twice is harmless.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from config import get_config
+from instrumentation import RUN_STATS
+from log import get_logger, log_context
+
+logger = get_logger('sync')
+
+SYNC_COLUMNS = ['SKU', 'Stock', 'Regular price', 'Sale price']
+
+
+def sale_prices(row):
+    """
+    (price, compareAtPrice) for a row: on sale, the sale price is charged and
+    the regular price shown struck through.
+    """
+    regular = (row.get('Regular price') or '').strip()
+    sale = (row.get('Sale price') or '').strip()
+    if sale:
+        return sale, regular or None
+    return regular or None, None
+
+
+def same_amount(a, b):
+    """Compare prices as numbers, so 795 matches 795.00 from Shopify"""
+    if not a or not b:
+        return not a and not b
+    try:
+        return float(a) == float(b)
+    except ValueError:
+        return a == b
+
+
+def build_sync_plan(df, index, location_id):
+    """
+    Work out what to send: inventory quantities, price changes per product and
+    the SKUs we couldn't find in the store. Prices already matching the index
+    are left out.
+    """
+    quantities = []
+    prices = {}
+    missing = []
+
+    for row in df.to_dict('records'):
+        sku = row['SKU'].strip()
+        stock = row['Stock'].strip()
+        price, compare_at = sale_prices(row)
+        # Variable parents carry neither; their variants have their own rows
+        if not sku or (not stock and not price):
+            continue
+
+        entry = index.get(sku)
+        if not entry:
+            missing.append(sku)
+            continue
+
+        if stock:
+            # Whole numbers only, as preflight checks; a fractional stock isn't rounded into something else
+            try:
+                quantities.append({
+                    "inventoryItemId": entry["inventory_item_id"],
+                    "locationId": location_id,
+                    "quantity": int(stock)
+                })
+            except ValueError:
+                with log_context(sku=sku):
+                    logger.warning(f"⚠️ Stock '{stock}' is not a whole number, skipping")
+
+        if price and not (same_amount(price, entry.get("price")) and same_amount(compare_at, entry.get("compare_at_price"))):
+            prices.setdefault(entry["product_id"], []).append((sku, {
+                "id": entry["variant_id"],
+                "price": price,
+                "compareAtPrice": compare_at
+            }))
+
+    return quantities, prices, missing
+
+
+def sync_stock(csv_file=None, refresh_index=False):
+    """Push stock levels and prices from the export to the store"""
+    from spUtilities import get_locations, CONCURRENCY
+    from sku_index import SkuIndex
+    from utilities import read_export
+    from woocommerce import refresh_export
+
+    config = get_config()
+    RUN_STATS.reset()
+    CONCURRENCY.reset(config.concurrency, config.max_concurrency)
+
+    location_id = config.location_id or get_locations()
+    if not location_id:
+        logger.error("❌ Could not find a valid location ID. Please check your Shopify store settings.")
+        return 1
+
+    csv_file = refresh_export(csv_file)
+    if not csv_file:
+        return 1
+
+    with RUN_STATS.stage('read_csv'):
+        df = read_export(csv_file, columns=SYNC_COLUMNS)
+
+    try:
+        with RUN_STATS.stage('sku_index'):
+            index = SkuIndex(config.sku_index_file).ensure(refresh=refresh_index)
+    except RuntimeError as e:
+        logger.error(f"❌ Could not index the store's variants: {e}")
+        return 1
+
+    failed = push_stock(df, index, location_id, refreshed=refresh_index)
+    RUN_STATS.write_report(config.run_report_file, concurrency=CONCURRENCY.log_operating_point())
+    return 1 if failed else 0
+
+
+def push_stock(df, index, location_id, refreshed=False):
+    """
+    Send the stock levels and prices of df's rows to the store, leaving out
+    prices that already match index. Returns how many requests failed.
+    """
+    from spUtilities import set_inventory_quantities, update_variant_prices, INVENTORY_BATCH_SIZE
+
+    config = get_config()
+    quantities, prices, missing = build_sync_plan(df, index, location_id)
+    if missing and not refreshed:
+        # The cache may predate products created since; rebuild it once and retry those
+        logger.info(f"📇 {len(missing)} SKUs not in the cached index, refreshing it")
+        try:
+            with RUN_STATS.stage('sku_index'):
+                index.refresh()
+            quantities, prices, missing = build_sync_plan(df, index, location_id)
+        except RuntimeError as e:
+            logger.error(f"❌ Could not refresh the SKU index, syncing with the cached one: {e}")
+
+    for sku in missing:
+        with log_context(sku=sku):
+            logger.warning("⚠️ SKU not found in the store, skipping")
+
+    batches = [quantities[i:i + INVENTORY_BATCH_SIZE] for i in range(0, len(quantities), INVENTORY_BATCH_SIZE)]
+    RUN_STATS.set_total(len(batches) + len(prices), unit='requests', restart=True)
+    failed = 0
+
+    # Inventory goes in big batches; prices are per product, so spread those over a few workers
+    with ThreadPoolExecutor(max_workers=config.variant_workers) as executor:
+        inventory_futures = [executor.submit(set_inventory_quantities, batch) for batch in batches]
+        price_futures = {
+            product_id: executor.submit(update_variant_prices, product_id, [change for _, change in changes])
+            for product_id, changes in prices.items()
+        }
+        for future in inventory_futures:
+            try:
+                if future.result():
+                    failed += 1
+            except Exception:
+                logger.exception("❌ Inventory batch failed")
+                failed += 1
+            finally:
+                RUN_STATS.advance()
+        for product_id, future in price_futures.items():
+            try:
+                if future.result():
+                    failed += 1
+                    continue
+                # Keep the cached index current so the next sync skips these
+                for sku, change in prices[product_id]:
+                    entry = index.get(sku)
+                    index.add(sku, entry["product_id"], entry["variant_id"], entry["inventory_item_id"], change["price"], change["compareAtPrice"])
+            except Exception:
+                logger.exception("❌ Price update failed", extra={"product_id": product_id})
+                failed += 1
+            finally:
+                RUN_STATS.advance()
+    if prices:
+        index.save()
+
+    logger.info(
+        f"✅ Synced {len(quantities)} stock levels and {sum(len(changes) for changes in prices.values())} prices",
+        extra={"missing": len(missing), "failed_requests": failed}
+    )
+    return failed
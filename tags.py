@@ -0,0 +1,142 @@
+"""
+Tag normalisation shared by every product in a run.
+"""
+import sys
+import threading
+from collections import Counter
+
+
+class TagNormalizer:
+    """
+    Normalises tags (decade folding, title case) once per distinct string and
+    keeps the run's tag and category vocabulary with counts.
+
+    Normalised forms are interned and cached, so a tag seen on a thousand
+    products is processed once and stored once. Safe to share between
+    threads: reads of the cache need no lock, updates take one.
+    """
+
+    def __init__(self, fold=None):
+        # fold maps a raw tag to a canonical form, or None to keep it as is
+        self.fold = fold
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.tag_counts = Counter()
+        self.category_counts = Counter()
+
+    def normalize(self, tag):
+        """The normalised form of one tag, or None for tags that should be dropped"""
+        try:
+            return self.cache[tag]
+        except KeyError:
+            pass
+
+        value = tag.strip() if tag else ''
+        if value and self.fold:
+            value = self.fold(value) or value
+        value = value.title()
+        normalized = sys.intern(value) if value and value != '[]' else None
+
+        with self.lock:
+            self.cache[tag] = normalized
+        return normalized
+
+    def normalize_all(self, *tag_lists):
+        """
+        Normalise and de-duplicate several tag lists, keeping first-seen order,
+        and count the result towards the run's vocabulary.
+        """
+        unique = {}
+        for tags in tag_lists:
+            for tag in tags or ():
+                if not tag:
+                    continue
+                normalized = self.normalize(tag)
+                if normalized:
+                    unique[normalized] = None
+
+        tags = list(unique)
+        if tags:
+            with self.lock:
+                self.tag_counts.update(tags)
+        return tags
+
+    def add_categories(self, categories):
+        """Count categories that should become collections"""
+        with self.lock:
+            self.category_counts.update(sys.intern(category) for category in categories if category)
+
+    def categories(self):
+        """Every category seen this run, in first-seen order"""
+        with self.lock:
+            return list(self.category_counts)
+
+    def vocabulary(self):
+        """The run's tags with how many products carry each, most common first"""
+        with self.lock:
+            return dict(self.tag_counts.most_common())
+
+    def reset(self):
+        with self.lock:
+            self.tag_counts.clear()
+            self.category_counts.clear()
+
+
+class CategoryTree:
+    """
+    Parses WooCommerce category strings ("Designers > Hans Wegner, Furniture > Chairs")
+    into tags and a designer name, once per distinct string.
+
+    Most products share a handful of category strings, so each is split and
+    de-duplicated the first time it is seen and served from the cache after.
+    The category paths are kept as a tree for planning collections.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.root = {}
+
+    def parse(self, categories_str):
+        """(tags, designer name) for a Categories value; tags is a tuple, shared between callers"""
+        try:
+            return self.cache[categories_str]
+        except KeyError:
+            pass
+
+        paths = []
+        designer_name = ''
+        for category in categories_str.split(','):
+            # Split by ' > ' and add each part as a tag
+            parts = tuple(sys.intern(part.strip()) for part in category.split('>') if part.strip())
+            if not parts:
+                continue
+            # Check if the first part is "Designers" and use the second part as designer name
+            if len(parts) > 1 and parts[0].lower() == 'designers':
+                designer_name = parts[1]
+            paths.append(parts)
+
+        # Remove duplicates while preserving order
+        unique_tags = dict.fromkeys(part for parts in paths for part in parts)
+
+        # "Designers" is only the parent category; tag those products "Designer" instead
+        if "Designers" in unique_tags:
+            del unique_tags["Designers"]
+            unique_tags["Designer"] = None
+
+        parsed = (tuple(unique_tags), designer_name)
+        with self.lock:
+            for parts in paths:
+                node = self.root
+                for part in parts:
+                    node = node.setdefault(part, {})
+            self.cache[categories_str] = parsed
+        return parsed
+
+    def hierarchy(self):
+        """The category paths seen so far as nested {name: {child: {...}}} dicts"""
+        def copy(node):
+            return {name: copy(children) for name, children in node.items()}
+
+        with self.lock:
+            return copy(self.root)
@@ -1,9 +1,17 @@
 """
 Utility functions for the Shopify migration script.
 """
+import csv
+import html
 import re
-from vars import *
-from keys import *
+from functools import lru_cache
+from config import get_config
+from log import get_logger, current_context
+from instrumentation import profiled
+from metrics import ROWS_READ
+from tags import CategoryTree, TagNormalizer
+
+logger = get_logger('utilities')
 
 def parse_tags(tag_list, attr_tags):
     """
@@ -14,36 +22,10 @@ def parse_tags(tag_list, attr_tags):
         attr_tags: List of attribute tags
         
     Returns:
-        List of unique tags with proper formatting
+        List of unique tags with proper formatting, or None if there are none
     """
-    # Combine category tags and attribute tags, handling None values
-    decade_tag = None
-    unique_tags = []
-
-    all_tags = []
-    if tag_list:
-        all_tags.extend(tag_list)
-    if attr_tags:
-        all_tags.extend(attr_tags)
-    
-    # Remove duplicates while preserving order
-    for tag in all_tags:
-        if tag and tag not in unique_tags:  # Only add non-empty tags
-            # Check if tag is a decade and parse it
-            decade_tag = parse_decade(tag)
-            if decade_tag != None:
-                decade_tag = decade_tag.title()
-                unique_tags.append(decade_tag)
-            else:
-                # Apply normal title case
-                if tag.title() != '[]':
-                    unique_tags.append(tag.title())
-    
-    # Set tags to None if empty
-    if len(unique_tags) == 0:
-        unique_tags = None
-        
-    return unique_tags
+    # Decades are folded to one spelling and everything is title cased (see TagNormalizer)
+    return TAGS.normalize_all(tag_list, attr_tags) or None
 
 def parse_decade(value):
     """
@@ -132,35 +114,56 @@ def parse_decade(value):
     # If no pattern matches, return none
     return None
 
+# Tags and categories seen this run, shared by every product
+TAGS = TagNormalizer(fold=parse_decade)
+CATEGORIES = CategoryTree()
+
+# WooCommerce exports line breaks in descriptions as a literal backslash-n
+PARAGRAPH_BREAK = '\\n\\n'
+LINE_BREAK = '\\n'
+
+# The attribute table is styled inline unless DESCRIPTION_TABLE_CLASS names a class the theme styles
+INLINE_TABLE_STYLE = " style='border-collapse: collapse; width: 100%;'"
+INLINE_CELL_STYLE = " style='border: 1px solid #ddd; padding: 8px;'"
+
+# Distinct (text, attributes) pairs kept rendered; products sharing a description render it once
+DESCRIPTION_CACHE_SIZE = 4096
+
+@lru_cache(maxsize=None)
+def attribute_table_templates(css_class):
+    """The attribute table's opening and the opening of its cells, built once per styling"""
+    if css_class:
+        table, cell = f" class='{html.escape(css_class)}'", ''
+    else:
+        table, cell = INLINE_TABLE_STYLE, INLINE_CELL_STYLE
+    return f"<br/><br/><b>Product Attributes:</b><table{table}>", f"<td{cell}>"
+
+def escape_text(value):
+    """Escape an attribute name or value for an HTML text node (most have nothing to escape)"""
+    value = str(value)
+    if '&' in value or '<' in value or '>' in value:
+        return html.escape(value, quote=False)
+    return value
+
+@lru_cache(maxsize=DESCRIPTION_CACHE_SIZE)
+def render_description(text, attributes, css_class):
+    """The description HTML for text (already HTML) and attributes, a tuple of (name, value)"""
+    description = ''.join(
+        f"<p>{paragraph.replace(LINE_BREAK, '<br />')}</p>"
+        for paragraph in text.split(PARAGRAPH_BREAK) if paragraph.strip()
+    )
+    if attributes:
+        opening, cell = attribute_table_templates(css_class)
+        rows = ''.join([f"<tr>{cell}<b>{escape_text(name)}</b></td>{cell}{escape_text(value)}</td></tr>" for name, value in attributes])
+        description = f"{description}{opening}{rows}</table>"
+    return description
+
+@profiled('format_description')
 def format_description(text, product_attributes):
   """Format description text with proper HTML tags"""
   if not text:
       return ''
-  
-  # First split by double newlines to get paragraphs
-  paragraphs = text.split('\\n\\n')
-  
-  # Process each paragraph
-  formatted_paragraphs = []
-  for p in paragraphs:
-      # Replace single newlines with <br /> and wrap in <p> tags if not empty
-      if p.strip():
-          p = p.replace('\\n', '<br />')
-          formatted_paragraphs.append(f"<p>{p}</p>")
-  
-  # Join all paragraphs
-  description = ''.join(formatted_paragraphs)
-
-  # Add product attributes to the product input
-  if product_attributes:
-      # Create a formatted HTML table of attributes
-      attributes_html = "<br/><br/><b>Product Attributes:</b><table style='border-collapse: collapse; width: 100%;'>"
-      for attr_name, attr_value in product_attributes.items():
-          attributes_html += f"<tr><td style='border: 1px solid #ddd; padding: 8px;'><b>{attr_name}</b></td><td style='border: 1px solid #ddd; padding: 8px;'>{attr_value}</td></tr>"
-      attributes_html += "</table>"
-      description = f"{description}{attributes_html}"
-
-  return description
+  return render_description(text, tuple((product_attributes or {}).items()), get_config().description_table_class)
 
 def check_variant(row):
     """Helper function to check if a row represents a variant"""
@@ -172,52 +175,45 @@ def check_parent(row):
     product_type = row.get('Type', '').strip().lower()
     return product_type == 'variable'
 
+@profiled('process_categories')
 def process_categories(categories_str):
     """Process categories string into unique tags and extract designer name"""
     if not categories_str:
         return [], None
     
-    # Split by comma to get individual categories
-    categories = [cat.strip() for cat in categories_str.split(',') if cat.strip()]
-    
-    # Split each category by ' > ' and flatten the list
-    all_tags = []
-    designer_name = ''
-    
-    for category in categories:
-        # Split by ' > ' and add each part as a tag
-        parts = [part.strip() for part in category.split('>') if part.strip()]
-        
-        # Check if the first part is "Designers" and use the second part as designer name
-        if parts and len(parts) > 1 and parts[0].lower() == 'designers':
-            designer_name = parts[1]
-        # # Otherwise check if the first part looks like a designer name
-        # elif parts and designer_name == '':
-        #     # Check if this looks like a designer name (no spaces or camelCase)
-        #     if ' ' not in parts[0] or parts[0][0].isupper():
-        #         designer_name = parts[0]
-        
-        all_tags.extend(parts)
-    
-    # Remove duplicates while preserving order
-    unique_tags = []
-    for tag in all_tags:
-        if tag and tag not in unique_tags:  # Only add non-empty tags
-            unique_tags.append(tag)
-    
-    # Remove "Designers" tag if present
-    if "Designers" in unique_tags:
-        unique_tags.remove("Designers")
-        unique_tags.append("Designer")
+    # Parsed once per distinct string; most products share a few (see CategoryTree)
+    unique_tags, designer_name = CATEGORIES.parse(categories_str)
+    TAGS.add_categories(unique_tags)
     
-    # Add to global categories set
-    for tag in unique_tags:
-        ALL_CATEGORIES.add(tag)
-    
-    return unique_tags, designer_name
+    return list(unique_tags), designer_name
+
+def variation_options(variations):
+    """
+    Attribute name -> its values ("A, B"), over the attributes a parent's
+    variation rows set. Exports often only mark an attribute as used for
+    variations on the variation rows, with the parent showing it on the
+    product page (visible 1) or not listing it at all.
+    """
+    options = {}
+    for variation in variations:
+        for col in variation.keys():
+            if col.startswith('Attribute') and col.endswith(' name'):
+                attr_num = col.split(' ')[1]
+                attr_name = str(variation.get(col, '')).strip()
+                attr_value = str(variation.get(f'Attribute {attr_num} value(s)', '')).strip()
+                if attr_name and attr_value:
+                    values = options.setdefault(attr_name, [])
+                    if attr_value not in values:
+                        values.append(attr_value)
+    return options
 
-def process_attributes(row, parent_product=None):
-    """Process attribute fields and extract dimensions and designer name"""
+@profiled('process_attributes')
+def process_attributes(row, parent_product=None, variations=None):
+    """
+    Process attribute fields and extract dimensions and designer name. A
+    parent's options (variant attributes) are its attributes not shown on the
+    product page, and those its variation rows set, when they are given.
+    """
     all_tags = []
     dimensions = None
     designer_name = None
@@ -230,10 +226,10 @@ def process_attributes(row, parent_product=None):
     # Get parent variant attributes if available
     parent_variant_attrs = {}
     if parent_product and isinstance(parent_product, dict):
-        parent_variant_attrs = parent_product.get('variantAttributes', {})
+        parent_variant_attrs = parent_product.get('variantAttributes') or {}
     
     # Check for attribute columns (they start with 'Attribute')
-    for col in row.index:
+    for col in row.keys():
         if col.startswith('Attribute') and 'name' in col:
             attr_num = col.split(' ')[1]  # Get the attribute number
             # Convert to string before calling strip()
@@ -274,6 +270,14 @@ def process_attributes(row, parent_product=None):
                     if attr_value:  # Only add non-empty values
                         all_tags.append(attr_value)
     
+    if is_parent and variations:
+        for attr_name, values in variation_options(variations).items():
+            if attr_name in variant_attributes:
+                continue
+            # The parent's own list first, then whatever else its variations use
+            listed = [value.strip() for value in product_attributes.get(attr_name, '').split(',') if value.strip()]
+            variant_attributes[attr_name] = ', '.join(listed + [value for value in values if value not in listed])
+
     if len(all_tags) == 0:
         all_tags = None
         
@@ -305,6 +309,7 @@ def process_attributes(row, parent_product=None):
         
     return all_tags, dimension_metafields, designer_name, product_attributes, variant_attributes
 
+@profiled('parse_dimensions')
 def parse_dimensions(dim_str):
     """Parse dimensions string into width, height, depth"""
     if not dim_str:
@@ -377,24 +382,69 @@ def parse_dimensions(dim_str):
 
 def open_log_files():  
   # Create or clear the dimensions log file
-  with open(DIMENSIONS_LOG_FILE, 'w') as f:
+  with open(get_config().dimensions_log_file, 'w') as f:
       f.write("Line Number,SKU,Name,Dimensions\n")
   
   # Create or clear the image errors log file
-  with open(IMAGE_ERRORS_LOG_FILE, 'w') as f:
+  with open(get_config().image_errors_log_file, 'w') as f:
       f.write("Line Number,SKU,Name,Image URLs,Error Message\n")
     
+def get_line_number(row):
+    """Line of the export a row came from (the header is line 1)"""
+    try:
+        return int(getattr(row, 'name', None)) + 2
+    except (TypeError, ValueError):
+        return None
+
 def log_dimensions(sku, name, dimensions_str):
     """Log dimensions that couldn't be parsed for later processing"""
-    with open(DIMENSIONS_LOG_FILE, 'a') as f:
+    line_number = current_context().get('line', '')
+    logger.warning("📏 Could not parse dimensions", extra={"dimensions": dimensions_str})
+    with open(get_config().dimensions_log_file, 'a') as f:
         f.write(f"{line_number},{sku},{name},{dimensions_str}\n")
 
 def log_image_error(sku, name, image_urls, error_message, line_number):
     """Log image upload errors for a product"""
-    with open(IMAGE_ERRORS_LOG_FILE, 'a') as f:
+    logger.warning(f"🖼️ Image upload failed: {error_message}", extra={"image_urls": image_urls})
+    with open(get_config().image_errors_log_file, 'a') as f:
         urls = ','.join(image_urls)
         f.write(f"{line_number},{sku},{name},\"{urls}\",{error_message}\n")
 
+def read_export(csv_file, columns=None):
+    """
+    Read a WooCommerce export into a DataFrame of strings (blank cells are '').
+
+    columns limits the read to the named columns, for modes that only need a few.
+    The parsed export is cached in EXPORT_CACHE_DIR (see export_cache.py) and
+    reused until the file changes.
+    """
+    cache_dir = get_config().export_cache_dir
+    if not cache_dir:
+        df = parse_export(csv_file, columns)
+    else:
+        from export_cache import ExportCache
+        df = ExportCache(cache_dir).read(csv_file, parse_export, columns)
+    ROWS_READ.inc(len(df))
+    return df
+
+def parse_export(csv_file, columns=None):
+    """Parse a WooCommerce export with pandas, bypassing the cache"""
+    import pandas as pd
+
+    # Read CSV with all columns as strings to avoid type conversion issues
+    return pd.read_csv(csv_file, dtype=str, usecols=columns).fillna('')
+
+def read_export_rows(csv_file):
+    """
+    Yield the rows of a WooCommerce export as dicts, without pandas.
+
+    For the commands that only need a pass over a few columns; the export
+    starts with a byte order mark, hence utf-8-sig.
+    """
+    with open(csv_file, newline='', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            yield row
+
 def parse_images(images_str):
     """Parse images string into a list of image URLs"""
     if not images_str:
@@ -7,39 +7,108 @@ PROCESS_VARIANTS = True
 # Sync images
 SYNC_IMAGES = False
 
+# Download images and upload each distinct file to Shopify once (staged uploads), instead of
+# letting Shopify fetch every URL from the WooCommerce host; files are cached in IMAGE_CACHE_DIR
+REHOST_IMAGES = False
+IMAGE_CACHE_DIR = '.image_cache'
+IMAGE_WORKERS = 8
+
 # Create smart collections
 CREATE_SMART_COLLECTIONS = False
 
+# How many parents' variants to create at once
+VARIANT_WORKERS = 8
+
+# Shopify requests in flight at once, across the main loop and all workers. It starts at
+# CONCURRENCY and is tuned while the run goes (halved when throttled, raised while the API keeps
+# up) up to MAX_CONCURRENCY; set both the same to turn the tuning off
+CONCURRENCY = 2
+MAX_CONCURRENCY = 8
+
 # WooCommerce export file
 CSV_FILE = 'short.csv'
 
-line_number = 0
+# Where the export comes from: 'csv' reads CSV_FILE; 'woocommerce' pulls the catalogue from the
+# REST API of WOOCOMMERCE_URL (keys in keys.py) into WOOCOMMERCE_EXPORT_FILE before migrate and sync,
+# asking only for what changed since the last pull (kept in WOOCOMMERCE_CACHE_DIR)
+SOURCE = 'csv'
+WOOCOMMERCE_URL = ''
+WOOCOMMERCE_EXPORT_FILE = 'woocommerce_export.csv'
+WOOCOMMERCE_CACHE_DIR = '.woocommerce_cache'
+# Pages and variation lists fetched at once
+WOOCOMMERCE_WORKERS = 8
 
-# Shopify credentials
+# Class for the attribute table in product descriptions. Empty styles every cell inline; naming a
+# class the theme styles (e.g. 'product-attributes') makes every description smaller
+DESCRIPTION_TABLE_CLASS = ''
 
+# Shopify API version (credentials live in keys.py)
 API_VERSION = '2024-07'
 
-# Global variables
-DEFAULT_LOCATION_ID = None
-
-# GraphQL endpoint
-GRAPHQL_URL = f"https://{SHOPIFY_STORE}/admin/api/{API_VERSION}/graphql.json"
-
-# Headers for GraphQL requests
-HEADERS = {
-    'Content-Type': 'application/json',
-    'X-Shopify-Access-Token': SHOPIFY_API_ACCESS_TOKEN
-}
-
 # Log file for dimensions that couldn't be parsed
 DIMENSIONS_LOG_FILE = 'dimensions_to_process.csv'
 
-# Store the default location ID
-DEFAULT_LOCATION_ID = None
-
 # Image errors log file
 IMAGE_ERRORS_LOG_FILE = 'image_errors.csv'
 
+# Logging: DEBUG also dumps full GraphQL payloads; format is 'json' (JSON lines) or 'text'
+LOG_LEVEL = 'INFO'
+LOG_FORMAT = 'json'
+
+# Machine-readable summary of each run (stage timings, query cost, throttling)
+RUN_REPORT_FILE = 'run_report.json'
+
+# SKU, stage and error of everything that failed in the last run (redo them with `cli.py retry`)
+FAILURE_INDEX_FILE = 'failures.json'
+
+# `cli.py verify --reconcile`: the store's catalogue is saved to STORE_SNAPSHOT_FILE (JSONL from a
+# bulk query) and what differs from the export is written to VERIFY_REPORT_FILE
+STORE_SNAPSHOT_FILE = 'store_snapshot.jsonl'
+VERIFY_REPORT_FILE = 'verify_report.json'
+
+# Checks run over the whole export before a run; problems go to PREFLIGHT_REPORT_FILE and rows
+# with errors (bad prices or stock, duplicate SKUs, ...) are left out unless SKIP_INVALID_ROWS is False
+PREFLIGHT_REPORT_FILE = 'preflight_report.csv'
+SKIP_INVALID_ROWS = True
+
+# Products and collections each run creates are journalled here, one file per run (and per
+# worker), for `cli.py rollback`
+JOURNAL_DIR = 'journals'
+
+# Cache of the store's variants by WooCommerce SKU (rebuilt with `cli.py sync --refresh-index`)
+SKU_INDEX_FILE = 'sku_index.json'
+
+# Parsed exports are cached here (a memory-mapped .npy buffer) and reused until
+# the CSV changes; set to '' to parse the CSV every run
+EXPORT_CACHE_DIR = '.export_cache'
+
+# `cli.py watch`: poll WATCH_PATH (an export file, or a directory whose newest .csv is the export;
+# '' for CSV_FILE) every WATCH_INTERVAL seconds and send only the products that changed since the
+# last export, WATCH_WORKERS at a time. Fingerprints of the last export are kept in WATCH_STATE_FILE
+WATCH_PATH = ''
+WATCH_INTERVAL = 60
+WATCH_WORKERS = 4
+WATCH_STATE_FILE = 'watch_state.json'
+
+# Sharded runs (`cli.py worker`): products are split into SHARD_COUNT shards that workers lease
+# from LEASE_DB_FILE; a shard whose worker stops renewing for LEASE_SECONDS is handed to another
+SHARD_COUNT = 16
+LEASE_DB_FILE = 'shards.sqlite'
+LEASE_SECONDS = 120
+
+# Serve live counters (rows, products, failures, request latency, queues) for Prometheus on
+# http://METRICS_HOST:METRICS_PORT/metrics while a run goes (also `cli.py --metrics-port`); 0 is off
+METRICS_PORT = 0
+METRICS_HOST = '127.0.0.1'
+
+# Profile every stage of a run (also `cli.py --profile`): 'cpu' (cProfile), 'memory' (tracemalloc),
+# 'all' or '' for off. Stats files per stage and a summary go in PROFILE_DIR
+PROFILE = ''
+PROFILE_DIR = 'profile'
 
-# Store all unique categories for collection creation
-ALL_CATEGORIES = set()
\ No newline at end of file
+# Record every request of a run and its response (with timing) to a gzipped cassette, or replay a
+# cassette instead of talking to the store, waiting out the recorded latencies times
+# REPLAY_LATENCY_SCALE (also `cli.py --record/--replay`). Only one of the files should be set
+RECORD_FILE = ''
+REPLAY_FILE = ''
+REPLAY_LATENCY_SCALE = 1.0
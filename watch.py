@@ -0,0 +1,307 @@
+"""
+Keeping the store in step with a regularly regenerated export (`cli.py watch`).
+
+The watcher polls WATCH_PATH every WATCH_INTERVAL seconds. WATCH_PATH is an
+export file, or a directory whose newest .csv is the export, and defaults
+to CSV_FILE. A file counts as a new export once it has stopped changing for
+a whole interval, so one that is still being written is left alone. With
+SOURCE = 'woocommerce' every poll is an incremental pull instead.
+
+Each new export is compared with the last one, product by product (a
+product being its row and its variations' rows), through two fingerprints
+kept in WATCH_STATE_FILE: one over the stock and price columns and one over
+everything else. Only the differences are sent:
+
+    new products, and products whose other columns changed
+                    transformed and created or updated like `migrate`, by
+                    WATCH_WORKERS threads at once
+    stock or prices changed
+                    pushed like `sync` (inventory in batches)
+    gone from the export
+                    logged and left in the store
+
+A product that fails keeps its old fingerprint, so the next export sends it
+again; its failure is in FAILURE_INDEX_FILE for `cli.py retry` meanwhile.
+Without a state file the first export is sent in full, unless --baseline
+only records it (for a store that was just migrated from that export).
+Every export processed gets its own journal and run report.
+"""
+import glob
+import hashlib
+import json
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import get_config
+from export_cache import file_key
+from failures import FAILURES
+from instrumentation import RUN_STATS
+from journal import JOURNAL
+from log import get_logger, log_context
+from metafields import METAFIELDS
+from sync import SYNC_COLUMNS
+
+logger = get_logger('watch')
+
+# Compared separately, so a change in only these goes through the stock and price sync
+STOCK_COLUMNS = ['Stock', 'Regular price', 'Sale price']
+
+
+class ExportWatcher:
+    """Polls a file, or the newest .csv in a directory, for exports it hasn't seen"""
+
+    def __init__(self, path):
+        self.path = path
+        # (path, size, mtime) of the last export handed out, and of the last one seen changing
+        self.seen = None
+        self.pending = None
+
+    def latest(self):
+        if os.path.isdir(self.path):
+            exports = glob.glob(os.path.join(glob.escape(self.path), '*.csv'))
+            return max(exports, key=os.path.getmtime) if exports else None
+        return self.path if os.path.exists(self.path) else None
+
+    def poll(self, settle=True):
+        """The export to process, or None. With settle, a new file is only handed out once it's unchanged since the last poll"""
+        path = self.latest()
+        if path is None:
+            return None
+        stat = os.stat(path)
+        signature = (path, stat.st_size, stat.st_mtime_ns)
+        if signature == self.seen:
+            return None
+        if settle and signature != self.pending:
+            self.pending = signature
+            return None
+        self.seen = signature
+        return path
+
+
+class WatchState:
+    """The last export processed and the fingerprints of its products, by product key"""
+
+    def __init__(self, path):
+        self.path = path
+        self.export = None
+        self.products = None
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+            self.export = data.get("export")
+            self.products = {key: tuple(value) for key, value in data.get("products", {}).items()}
+        return self
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"export": self.export, "products": self.products or {}}, f)
+        os.replace(tmp_path, self.path)
+
+
+def fingerprints(df, graph):
+    """Product key -> (fingerprint of its other columns, of its stock and prices), over its row and its variations'"""
+    import pandas as pd
+
+    owners = dict(graph.keys)
+    for key, labels in graph.children.items():
+        owners.update((label, key) for label in labels)
+    owner = pd.Series([owners.get(label) for label in df.index], index=df.index)
+
+    stock_columns = [column for column in STOCK_COLUMNS if column in df]
+    other_columns = [column for column in df.columns if column not in stock_columns]
+
+    def combined(columns):
+        hashes = pd.util.hash_pandas_object(df[columns], index=False)
+        # Orphaned variations have no owner and drop out here
+        return hashes.groupby(owner, sort=False).agg(
+            lambda values: hashlib.blake2b(values.values.tobytes(), digest_size=8).hexdigest())
+
+    other, stock = combined(other_columns), combined(stock_columns)
+    return {key: (other[key], stock[key]) for key in other.index}
+
+
+class Delta:
+    """What changed between two sets of fingerprints"""
+
+    def __init__(self, previous, current):
+        self.new = [key for key in current if key not in previous]
+        self.changed = [key for key in current if key in previous and current[key][0] != previous[key][0]]
+        # Products that are sent anyway still need their variants' stock and prices pushed
+        self.stock = [key for key in current if key in previous and current[key][1] != previous[key][1]]
+        self.removed = [key for key in previous if key not in current]
+
+    def __bool__(self):
+        return bool(self.new or self.changed or self.stock or self.removed)
+
+    def summary(self):
+        return {"new": len(self.new), "changed": len(self.changed), "stock": len(self.stock), "removed": len(self.removed)}
+
+
+def start_cycle():
+    """Reset the per-export stats, logs and journal; failures of earlier exports are kept"""
+    from spUtilities import CONCURRENCY
+    from utilities import open_log_files, TAGS
+
+    config = get_config()
+    open_log_files()
+    RUN_STATS.reset()
+    CONCURRENCY.reset(config.concurrency, config.max_concurrency)
+    TAGS.reset()
+    FAILURES.open(config.failure_index_file, keep=True)
+    JOURNAL.open(config.journal_dir)
+
+
+def push_products(df, graph, labels, keys, variant_scheduler):
+    """Create or update the products with keys (labels maps them to their rows), WATCH_WORKERS at a time"""
+    from migrate import migrate_product
+    from utilities import get_line_number
+
+    def push(key):
+        row = df.loc[labels[key]]
+        with log_context(sku=key, line=get_line_number(row)):
+            try:
+                migrate_product(row, df, graph, variant_scheduler)
+            except Exception as e:
+                logger.exception("❌ Failed to migrate product")
+                FAILURES.record('product', type(e).__name__, e)
+        RUN_STATS.advance()
+
+    with ThreadPoolExecutor(max_workers=get_config().watch_workers, thread_name_prefix='watch') as executor:
+        list(executor.map(push, keys))
+
+
+def process_export(export, state, location_id, baseline=False):
+    """Send what changed in export since the last one; returns the Delta, or None for an export already seen (or a baseline)"""
+    from images import close_pipeline, prefetch_images
+    from migrate import preflight_export
+    from product_graph import ProductGraph
+    from sku_index import SkuIndex
+    from spUtilities import VariantScheduler, CONCURRENCY
+    from sync import push_stock
+    from utilities import read_export, parse_images, TAGS
+
+    config = get_config()
+    identity = file_key(export)
+    if identity == state.export:
+        logger.debug(f"Export {export} hasn't changed")
+        return None
+
+    start_cycle()
+    with RUN_STATS.stage('read_csv'):
+        df = read_export(export)
+    with RUN_STATS.stage('product_graph'):
+        graph = ProductGraph(df)
+    df, graph, preflight = preflight_export(df, graph)
+    with RUN_STATS.stage('fingerprint'):
+        current = fingerprints(df, graph)
+
+    if state.products is None and baseline:
+        state.export, state.products = identity, current
+        state.save()
+        logger.info(f"👀 Recorded {len(current)} products of {export} as the baseline, sending nothing")
+        return None
+
+    delta = Delta(state.products or {}, current)
+    if not delta:
+        state.export = identity
+        state.save()
+        logger.info(f"👀 {export}: no products changed")
+        return delta
+    logger.info(f"👀 {export}: {len(delta.new)} new, {len(delta.changed)} changed, {len(delta.stock)} with new stock "
+                f"or prices, {len(delta.removed)} gone", extra=delta.summary())
+    for key in delta.removed:
+        with log_context(sku=key):
+            logger.warning("⚠️ No longer in the export, left in the store")
+
+    pushed = list(dict.fromkeys(delta.new + delta.changed))
+    FAILURES.discard(pushed)
+    labels = {key: label for label, key in graph.keys.items()}
+    stock_failed = 0
+    if delta.stock:
+        rows = [label for key in delta.stock for label in [labels[key]] + graph.children.get(key, [])]
+        with RUN_STATS.stage('sku_index'):
+            index = SkuIndex(config.sku_index_file).ensure()
+        stock_failed = push_stock(df.loc[rows, SYNC_COLUMNS], index, location_id)
+
+    if pushed:
+        RUN_STATS.set_total(len(pushed), restart=True)
+        if config.rehost_images:
+            prefetch_images([url for key in pushed for url in parse_images(df.at[labels[key], 'Images'])])
+        with VariantScheduler(max_workers=config.variant_workers) as variant_scheduler:
+            push_products(df, graph, labels, pushed, variant_scheduler)
+        if config.create_smart_collections:
+            from migrate import create_collections
+            create_collections(TAGS.categories())
+    close_pipeline()
+    METAFIELDS.flush()
+
+    # Whatever failed keeps its old fingerprint (or none), so the next export sends it again
+    failed = FAILURES.skus() & set(pushed)
+    products = dict(state.products or {})
+    for key in delta.removed:
+        del products[key]
+    for key in pushed:
+        if key not in failed:
+            products[key] = current[key]
+    if not stock_failed:
+        for key in delta.stock:
+            products[key] = (products[key][0], current[key][1])
+    state.export, state.products = identity, products
+    state.save()
+
+    JOURNAL.close()
+    FAILURES.save()
+    RUN_STATS.write_report(config.run_report_file, watch=dict(delta.summary(), export=export, failed=len(failed)),
+                           preflight=preflight.summary(), concurrency=CONCURRENCY.log_operating_point())
+    return delta
+
+
+def watch(path=None, interval=None, once=False, baseline=False):
+    """Process new exports as they appear until stopped (Ctrl-C or SIGTERM); once processes the current one and returns"""
+    from spUtilities import get_locations
+    from woocommerce import refresh_export
+
+    config = get_config()
+    path = path or config.watch_path or config.csv_file
+    interval = interval or config.watch_interval
+    location_id = config.location_id = get_locations()
+    if not location_id:
+        logger.error("❌ Could not find a valid location ID. Please check your Shopify store settings.")
+        return 1
+
+    stop = threading.Event()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+
+    watcher = ExportWatcher(path)
+    state = WatchState(config.watch_state_file).load()
+    source = f"{config.woocommerce_url} (pulled into {config.csv_file})" if config.source == 'woocommerce' else path
+    logger.info(f"👀 Watching {source} every {interval}s", extra={"state": config.watch_state_file})
+    failed = False
+    try:
+        while not stop.is_set():
+            started = time.monotonic()
+            # A pull is written in one go, so it needn't settle
+            export = refresh_export() if config.source == 'woocommerce' else watcher.poll(settle=not once)
+            if export:
+                try:
+                    delta = process_export(export, state, location_id, baseline=baseline)
+                    failed = bool(delta is not None and len(FAILURES))
+                except Exception:
+                    # The next export gets another go
+                    logger.exception(f"❌ Processing {export} failed")
+                    failed = True
+            if once:
+                break
+            stop.wait(max(interval - (time.monotonic() - started), 0))
+    except KeyboardInterrupt:
+        pass
+    METAFIELDS.close()
+    logger.info("👀 Stopped watching")
+    return 1 if once and failed else 0
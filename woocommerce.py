@@ -0,0 +1,347 @@
+"""
+Pulling the catalogue straight from the WooCommerce REST API (SOURCE =
+'woocommerce', or `cli.py pull`) instead of exporting a CSV by hand.
+
+Products and variations are fetched from /wp-json/wc/v3 and written to
+WOOCOMMERCE_EXPORT_FILE in the layout of WooCommerce's own CSV exporter, so
+the rest of the migration (transform, pre-flight checks, export cache,
+retries by byte offset) reads it like any other export.
+
+Listings are paginated 100 at a time. The first page says how many there
+are and the rest are fetched concurrently. What was pulled is kept in
+WOOCOMMERCE_CACHE_DIR, and later pulls only ask for:
+
+    products       modified since the last pull (modified_after), plus a
+                   pass over the product IDs alone to drop deleted ones
+    variations     of the products that changed, with If-None-Match, so a
+                   list that hasn't changed costs a 304
+    categories     with If-None-Match (they give the Categories paths)
+
+Variation-only edits normally touch the parent too. When one hasn't, or the
+cache is in doubt, `cli.py pull --full` fetches everything again.
+"""
+import csv
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import get_config
+from instrumentation import RUN_STATS, timed
+from log import get_logger
+
+logger = get_logger('woocommerce')
+
+API_PATH = '/wp-json/wc/v3'
+# The most the REST API returns per page
+PAGE_SIZE = 100
+# Incremental pulls ask for changes since a little before the last one started, in case the clocks differ
+SYNC_OVERLAP = 300
+ATTRIBUTE_COLUMNS = 4
+
+PUBLISHED = {'publish': '1', 'private': '0', 'draft': '-1', 'pending': '-1', 'future': '-1'}
+
+
+def export_columns(attributes=ATTRIBUTE_COLUMNS):
+    """The columns of WooCommerce's CSV exporter that the migration reads"""
+    columns = ['ID', 'Type', 'SKU', 'GTIN, UPC, EAN, or ISBN', 'Name', 'Published', 'Short description', 'Description',
+               'Stock', 'Sale price', 'Regular price', 'Categories', 'Tags', 'Images', 'Parent', 'Brands']
+    for number in range(1, attributes + 1):
+        columns += [f'Attribute {number} name', f'Attribute {number} value(s)',
+                    f'Attribute {number} visible', f'Attribute {number} global']
+    return columns
+
+
+class WooCommerceClient:
+    """GET requests to the REST API with paging, conditional requests and a request count"""
+
+    def __init__(self, url, key, secret, max_workers=8):
+        from cassette import new_session
+
+        self.base_url = f"{url.rstrip('/')}{API_PATH}"
+        self.session = new_session(max_workers)
+        self.session.auth = (key, secret)
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+
+    def get(self, path, params=None, etag=None):
+        """(response, JSON body); the body is None when etag still matches (304)"""
+        headers = {'If-None-Match': etag} if etag else {}
+        response = self.session.get(f"{self.base_url}/{path}", params=params, headers=headers, timeout=60)
+        with self.lock:
+            self.requests += 1
+        if response.status_code == 304:
+            with self.lock:
+                self.not_modified += 1
+            return response, None
+        response.raise_for_status()
+        return response, response.json()
+
+    def get_all(self, path, params=None, etag=None):
+        """
+        Every page of a listing as (items, ETag). With an etag that still
+        matches, the first page answers 304 and (None, etag) comes back. Only
+        a listing that fits on one page has an ETag, as a page's ETag says
+        nothing about the pages after it.
+        """
+        params = dict(params or {}, per_page=PAGE_SIZE, page=1)
+        response, items = self.get(path, params, etag)
+        if items is None:
+            return None, etag
+        pages = int(response.headers.get('X-WP-TotalPages') or 1)
+        if pages > 1:
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='woocommerce') as executor:
+                for page in executor.map(lambda number: self.get(path, dict(params, page=number))[1], range(2, pages + 1)):
+                    items.extend(page)
+        return items, response.headers.get('ETag') if pages == 1 else None
+
+    def get_each(self, func, args):
+        """func(arg) for every arg, concurrently, in order"""
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='woocommerce') as executor:
+            return list(executor.map(func, args))
+
+
+class CatalogueCache:
+    """What the last pull fetched: products, variations by parent ID, categories and their ETags"""
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, 'catalogue.json') if directory else None
+        self.synced = None
+        self.source = None
+        self.products = {}
+        self.variations = {}
+        self.variation_etags = {}
+        self.categories = []
+        self.categories_etag = None
+
+    def load(self, source):
+        """False if there's no cache of source to build on"""
+        if not self.path or not os.path.exists(self.path):
+            return False
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get("source") != source:
+            return False
+        self.synced = data.get("synced")
+        self.source = source
+        self.products = {int(key): value for key, value in data.get("products", {}).items()}
+        self.variations = {int(key): value for key, value in data.get("variations", {}).items()}
+        self.variation_etags = {int(key): value for key, value in data.get("variation_etags", {}).items()}
+        self.categories = data.get("categories", [])
+        self.categories_etag = data.get("categories_etag")
+        return True
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "source": self.source,
+                "synced": self.synced,
+                "products": self.products,
+                "variations": self.variations,
+                "variation_etags": self.variation_etags,
+                "categories": self.categories,
+                "categories_etag": self.categories_etag
+            }, f)
+        os.replace(tmp_path, self.path)
+
+
+def category_paths(categories):
+    """Category ID -> "Parent > Child" path, as the exporter writes them"""
+    by_id = {category["id"]: category for category in categories}
+    paths = {}
+
+    def path(category_id, depth=0):
+        if category_id not in paths:
+            category = by_id[category_id]
+            parent = category.get("parent") or 0
+            # A parent that's missing (or a loop) ends the path
+            prefix = path(parent, depth + 1) + ' > ' if parent in by_id and depth < len(by_id) else ''
+            paths[category_id] = prefix + category["name"]
+        return paths[category_id]
+
+    for category_id in by_id:
+        path(category_id)
+    return paths
+
+
+def export_text(value):
+    """Line breaks as the exporter writes them: a literal backslash-n"""
+    return (value or '').replace('\r\n', '\n').replace('\n', '\\n')
+
+
+def stock_value(item):
+    if item.get("manage_stock") is True and item.get("stock_quantity") is not None:
+        return str(item["stock_quantity"])
+    return ''
+
+
+def product_row(product, paths):
+    types = [product.get("type", "simple")]
+    types += [flag for flag in ("virtual", "downloadable") if product.get(flag)]
+    row = {
+        'ID': str(product["id"]),
+        'Type': ', '.join(types),
+        'SKU': product.get("sku") or '',
+        'GTIN, UPC, EAN, or ISBN': product.get("global_unique_id") or '',
+        'Name': product.get("name") or '',
+        'Published': PUBLISHED.get(product.get("status"), '-1'),
+        'Short description': export_text(product.get("short_description")),
+        'Description': export_text(product.get("description")),
+        'Stock': stock_value(product),
+        'Sale price': product.get("sale_price") or '',
+        'Regular price': product.get("regular_price") or '',
+        'Categories': ', '.join(paths.get(category["id"], category.get("name", '')) for category in product.get("categories") or []),
+        'Tags': ', '.join(tag.get("name", '') for tag in product.get("tags") or []),
+        'Images': ', '.join(image["src"] for image in product.get("images") or [] if image.get("src")),
+        'Parent': '',
+        'Brands': ', '.join(brand.get("name", '') for brand in product.get("brands") or [])
+    }
+    for number, attribute in enumerate(sorted(product.get("attributes") or [], key=lambda a: a.get("position", 0)), 1):
+        row[f'Attribute {number} name'] = attribute.get("name", '')
+        row[f'Attribute {number} value(s)'] = ', '.join(attribute.get("options") or [])
+        row[f'Attribute {number} visible'] = '1' if attribute.get("visible") else '0'
+        row[f'Attribute {number} global'] = '1' if attribute.get("id") else '0'
+    return row
+
+
+def variation_row(variation, parent):
+    attributes = variation.get("attributes") or []
+    name = variation.get("name") or f"{parent.get('name', '')} - {', '.join(a.get('option', '') for a in attributes)}"
+    image = (variation.get("image") or {}).get("src") or ''
+    row = {
+        'ID': str(variation["id"]),
+        'Type': 'variation',
+        'SKU': variation.get("sku") or '',
+        'GTIN, UPC, EAN, or ISBN': variation.get("global_unique_id") or '',
+        'Name': name,
+        'Published': PUBLISHED.get(variation.get("status"), '-1'),
+        'Short description': '',
+        'Description': export_text(variation.get("description")),
+        'Stock': stock_value(variation),
+        'Sale price': variation.get("sale_price") or '',
+        'Regular price': variation.get("regular_price") or '',
+        'Categories': '',
+        'Tags': '',
+        'Images': image,
+        'Parent': parent.get("sku") or f"id:{parent['id']}",
+        'Brands': ''
+    }
+    for number, attribute in enumerate(attributes, 1):
+        row[f'Attribute {number} name'] = attribute.get("name", '')
+        row[f'Attribute {number} value(s)'] = attribute.get("option", '')
+        row[f'Attribute {number} visible'] = ''
+        row[f'Attribute {number} global'] = '1' if attribute.get("id") else '0'
+    return row
+
+
+def export_rows(cache):
+    """Rows in product ID order, each variable product followed by its variations"""
+    paths = category_paths(cache.categories)
+    rows = []
+    for product_id in sorted(cache.products):
+        product = cache.products[product_id]
+        rows.append(product_row(product, paths))
+        for variation in sorted(cache.variations.get(product_id, []), key=lambda v: v["id"]):
+            rows.append(variation_row(variation, product))
+    return rows
+
+
+@timed('woocommerce_write')
+def write_export(rows, path):
+    attributes = max([ATTRIBUTE_COLUMNS] + [int(key.split(' ')[1]) for row in rows for key in row if key.startswith('Attribute ')])
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    # With a byte order mark, like WooCommerce's own exports
+    with open(tmp_path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.DictWriter(f, fieldnames=export_columns(attributes), restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_path, path)
+    return path
+
+
+@timed('woocommerce_fetch')
+def fetch_catalogue(client, cache, full=False):
+    """Bring cache up to date with the store; returns how many products were fetched"""
+    started = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(time.time() - SYNC_OVERLAP))
+    incremental = cache.synced is not None and not full
+
+    categories, etag = client.get_all('products/categories', etag=cache.categories_etag if incremental else None)
+    if categories is not None:
+        cache.categories, cache.categories_etag = categories, etag
+
+    if incremental:
+        changed, _ = client.get_all('products', {"modified_after": cache.synced, "dates_are_gmt": "true"})
+        ids, _ = client.get_all('products', {"_fields": "id"})
+        current = {item["id"] for item in ids}
+        for product_id in set(cache.products) - current:
+            cache.products.pop(product_id, None)
+            cache.variations.pop(product_id, None)
+            cache.variation_etags.pop(product_id, None)
+    else:
+        changed, _ = client.get_all('products')
+        cache.products, cache.variations, cache.variation_etags = {}, {}, {}
+    for product in changed:
+        cache.products[product["id"]] = product
+
+    variable = [product["id"] for product in changed if product.get("type") == "variable"]
+
+    def variations(product_id):
+        return client.get_all(f'products/{product_id}/variations', etag=cache.variation_etags.get(product_id) if incremental else None)
+
+    for product_id, (items, etag) in zip(variable, client.get_each(variations, variable)):
+        if items is not None:
+            cache.variations[product_id] = items
+        cache.variation_etags[product_id] = etag
+    # A product that stopped being variable has no variations any more
+    for product in changed:
+        if product.get("type") != "variable":
+            cache.variations.pop(product["id"], None)
+            cache.variation_etags.pop(product["id"], None)
+
+    cache.synced = started
+    return len(changed)
+
+
+def pull_export(path=None, full=False):
+    """Fetch the catalogue from WOOCOMMERCE_URL and write it to path (WOOCOMMERCE_EXPORT_FILE); returns the path"""
+    config = get_config()
+    path = path or config.woocommerce_export_file
+    client = WooCommerceClient(config.woocommerce_url, config.woocommerce_key, config.woocommerce_secret,
+                               max_workers=config.woocommerce_workers)
+    cache = CatalogueCache(config.woocommerce_cache_dir)
+    if not cache.load(config.woocommerce_url) or full:
+        cache = CatalogueCache(config.woocommerce_cache_dir)
+        cache.source = config.woocommerce_url
+
+    with RUN_STATS.stage('woocommerce'):
+        fetched = fetch_catalogue(client, cache, full=full)
+        rows = export_rows(cache)
+        write_export(rows, path)
+        cache.save()
+    variations = sum(len(items) for items in cache.variations.values())
+    logger.info(f"🛒 Pulled {len(cache.products)} products and {variations} variations into {path}",
+                extra={"fetched": fetched, "requests": client.requests, "not_modified": client.not_modified})
+    return path
+
+
+def refresh_export(csv_file=None, full=False):
+    """
+    The export to read: csv_file (CSV_FILE), pulled from the store into it
+    first when SOURCE is 'woocommerce'. None if the pull failed.
+    """
+    config = get_config()
+    csv_file = csv_file or config.csv_file
+    if config.source != 'woocommerce':
+        return csv_file
+    try:
+        return pull_export(csv_file, full=full)
+    except Exception as e:
+        logger.exception(f"❌ Could not pull the catalogue from {config.woocommerce_url}: {e}")
+        return None
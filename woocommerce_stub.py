@@ -0,0 +1,279 @@
+"""
+A local stand-in for the WooCommerce REST API (wc/v3).
+
+Serves the products, variations and categories of a WooCommerce CSV export
+with the paging, filters, headers and conditional requests woocommerce.py
+relies on, so pulls can be tested and timed without a real shop:
+
+    with WooCommerceStub.from_export('full.csv') as woo:
+        set_config(replace(get_config(), source='woocommerce', woocommerce_url=woo.url,
+                           woocommerce_key=woo.key, woocommerce_secret=woo.secret))
+
+touch(), touch_variation() and delete() change the catalogue between pulls.
+"""
+import base64
+import csv
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+API_PATH = '/wp-json/wc/v3/'
+MAX_PAGE_SIZE = 100
+
+STATUSES = {'1': 'publish', '0': 'private', '-1': 'draft'}
+
+
+def now():
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())
+
+
+def import_text(value):
+    return (value or '').replace('\\n', '\n')
+
+
+def split_list(value):
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+
+class WooCommerceStub:
+    """In-memory catalogue plus the HTTP server that exposes it"""
+
+    def __init__(self, latency=0.0, key='ck_stub', secret='cs_stub'):
+        self.latency = latency
+        self.key = key
+        self.secret = secret
+        self.lock = threading.RLock()
+        self.products = {}
+        # Variations by parent product ID
+        self.variations = {}
+        self.categories = {}
+        # Category ID by "Parent > Child" path
+        self.category_paths = {}
+        self.request_count = 0
+        self.not_modified = 0
+        self.server = None
+        self.thread = None
+
+    @classmethod
+    def from_export(cls, csv_file, **kwargs):
+        stub = cls(**kwargs)
+        with open(csv_file, newline='', encoding='utf-8-sig') as f:
+            stub.load(list(csv.DictReader(f)))
+        return stub
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        stub = self
+
+        class Handler(WooCommerceRequestHandler):
+            pass
+        Handler.stub = stub
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def category_ids(self, paths):
+        """The IDs of "Parent > Child" paths, creating the categories along them"""
+        ids = []
+        for path in split_list(paths):
+            parent = 0
+            names = [name.strip() for name in path.split('>')]
+            for depth in range(len(names)):
+                key = ' > '.join(names[:depth + 1])
+                if key not in self.category_paths:
+                    category_id = len(self.categories) + 1
+                    self.categories[category_id] = {
+                        "id": category_id,
+                        "name": names[depth],
+                        "parent": parent,
+                        "slug": re.sub(r'[^a-z0-9]+', '-', names[depth].lower()).strip('-')
+                    }
+                    self.category_paths[key] = category_id
+                parent = self.category_paths[key]
+            ids.append(parent)
+        return ids
+
+    def load(self, rows, modified='2024-01-01T00:00:00'):
+        """The products and variations of export rows, as the REST API returns them, last modified at modified"""
+        by_sku = {}
+        variations = []
+        for row in rows:
+            types = split_list(row.get('Type'))
+            item = {
+                "id": int(row['ID']),
+                "type": types[0] if types else 'simple',
+                "sku": row.get('SKU', ''),
+                "global_unique_id": row.get('GTIN, UPC, EAN, or ISBN', ''),
+                "name": row.get('Name', ''),
+                "status": STATUSES.get(row.get('Published', ''), 'draft'),
+                "virtual": 'virtual' in types,
+                "downloadable": 'downloadable' in types,
+                "description": import_text(row.get('Description')),
+                "short_description": import_text(row.get('Short description')),
+                "regular_price": row.get('Regular price', ''),
+                "sale_price": row.get('Sale price', ''),
+                "manage_stock": bool(row.get('Stock', '').strip()),
+                "stock_quantity": int(float(row['Stock'])) if row.get('Stock', '').strip() else None,
+                "date_modified_gmt": modified
+            }
+            attributes = []
+            number = 1
+            while f'Attribute {number} name' in row:
+                name = row[f'Attribute {number} name']
+                if name:
+                    attributes.append((number, name, row.get(f'Attribute {number} value(s)', ''),
+                                       row.get(f'Attribute {number} visible', ''), row.get(f'Attribute {number} global', '')))
+                number += 1
+
+            if item["type"] == 'variation':
+                item.pop("short_description")
+                item["image"] = {"src": split_list(row.get('Images'))[0]} if split_list(row.get('Images')) else None
+                item["attributes"] = [{"id": number if is_global == '1' else 0, "name": name, "option": value}
+                                      for number, name, value, _, is_global in attributes]
+                item["parent"] = row.get('Parent', '')
+            else:
+                item["categories"] = [{"id": category_id, "name": self.categories[category_id]["name"]}
+                                      for category_id in self.category_ids(row.get('Categories'))]
+                item["tags"] = [{"name": tag} for tag in split_list(row.get('Tags'))]
+                item["brands"] = [{"name": brand} for brand in split_list(row.get('Brands'))]
+                item["images"] = [{"src": src} for src in split_list(row.get('Images'))]
+                item["attributes"] = [{"id": number if is_global == '1' else 0, "name": name, "position": position,
+                                       "visible": visible == '1', "variation": visible != '1',
+                                       "options": [option.strip() for option in value.split(', ')] if value else []}
+                                      for position, (number, name, value, visible, is_global) in enumerate(attributes)]
+                if item["sku"]:
+                    by_sku[item["sku"]] = item["id"]
+
+            if item["type"] == 'variation':
+                variations.append(item)
+            else:
+                self.products[item["id"]] = item
+        # Parents are named by SKU, and needn't come before their variations
+        for item in variations:
+            parent = item.pop("parent")
+            parent_id = int(parent[3:]) if parent.startswith('id:') else by_sku.get(parent)
+            if parent_id is not None:
+                self.variations.setdefault(parent_id, []).append(item)
+        return self
+
+    def touch(self, product_id, **changes):
+        """Change a product as an edit in the admin would"""
+        with self.lock:
+            self.products[product_id].update(changes, date_modified_gmt=now())
+
+    def touch_variation(self, product_id, variation_id, **changes):
+        """Change a variation; WooCommerce marks its parent modified too"""
+        with self.lock:
+            for variation in self.variations[product_id]:
+                if variation["id"] == variation_id:
+                    variation.update(changes, date_modified_gmt=now())
+            self.products[product_id]["date_modified_gmt"] = now()
+
+    def delete(self, product_id):
+        with self.lock:
+            self.products.pop(product_id, None)
+            self.variations.pop(product_id, None)
+
+    def listing(self, path):
+        """The full list a path returns, or None if nothing is there"""
+        parts = path.strip('/').split('/')
+        with self.lock:
+            if parts == ['products']:
+                return sorted(self.products.values(), key=lambda item: item["id"])
+            if parts == ['products', 'categories']:
+                return sorted(self.categories.values(), key=lambda item: item["id"])
+            if len(parts) == 3 and parts[0] == 'products' and parts[2] == 'variations' and parts[1].isdigit():
+                if int(parts[1]) not in self.products:
+                    return None
+                return sorted(self.variations.get(int(parts[1]), []), key=lambda item: item["id"])
+        return None
+
+
+class WooCommerceRequestHandler(BaseHTTPRequestHandler):
+    stub = None
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, each response waits on a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        expected = base64.b64encode(f"{self.stub.key}:{self.stub.secret}".encode()).decode()
+        return self.headers.get('Authorization') == f"Basic {expected}"
+
+    def do_GET(self):
+        if self.stub.latency:
+            time.sleep(self.stub.latency)
+        with self.stub.lock:
+            self.stub.request_count += 1
+        url = urlsplit(self.path)
+        if not url.path.startswith(API_PATH):
+            self.send_json({"code": "rest_no_route"}, status=404)
+            return
+        if not self.authorized():
+            self.send_json({"code": "woocommerce_rest_cannot_view", "message": "Sorry, you cannot list resources."}, status=401)
+            return
+        items = self.stub.listing(url.path[len(API_PATH):])
+        if items is None:
+            self.send_json({"code": "rest_no_route"}, status=404)
+            return
+
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if params.get('modified_after'):
+            items = [item for item in items if item.get("date_modified_gmt", '') > params['modified_after']]
+        per_page = min(int(params.get('per_page', 10)), MAX_PAGE_SIZE)
+        page = int(params.get('page', 1))
+        selected = items[(page - 1) * per_page:page * per_page]
+        if params.get('_fields'):
+            names = params['_fields'].split(',')
+            selected = [{name: item[name] for name in names if name in item} for item in selected]
+
+        etag = '"' + hashlib.sha1(json.dumps(selected, sort_keys=True).encode()).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            with self.stub.lock:
+                self.stub.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_json(selected, headers={
+            'X-WP-Total': str(len(items)),
+            'X-WP-TotalPages': str(max(math.ceil(len(items) / per_page), 1)),
+            'ETag': etag
+        })